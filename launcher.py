@@ -1,15 +1,30 @@
 """ Запустить WServer, извлекая из переменной окружения данные для доступа
-к GDB."""
+к GDB. Если WSERVER_WORKERS больше 1, запускается несколько процессов
+WServer на одном порту под присмотром супервизора."""
 
 
 from wserver_compound.main import WServer
+from wserver_compound import prefork
+from wserver_compound import settings
 import os
+import sys
 
 dbname = os.environ.get('GDBNAME')
 dbuser = os.environ.get('GDBUSER')
 dbpass = os.environ.get('GDBPASS')
 dbhost = os.environ.get('GDBHOST')
 
-inst = WServer(8888, dbname=dbname, user=dbuser, password=dbpass,
-               host=dbhost)
-inst.start()
+
+def run_worker(listen_socket=None):
+    inst = WServer(8888, dbname=dbname, user=dbuser, password=dbpass,
+                   host=dbhost, listen_socket=listen_socket)
+    return inst.start()
+
+
+if settings.WSERVER_WORKERS > 1:
+    server_socket = prefork.create_listen_socket('0.0.0.0', 8888)
+    supervisor = prefork.Supervisor(settings.WSERVER_WORKERS,
+                                    lambda: run_worker(server_socket))
+    sys.exit(supervisor.run())
+else:
+    sys.exit(run_worker())
@@ -14,4 +14,7 @@ setup(
         'gc_qdk',
         'wta'
     ],
+    extras_require={
+        'photos': ['Pillow']
+    },
 )
\ No newline at end of file
@@ -0,0 +1,190 @@
+""" Модуль содержит очередь отложенной обработки актов.
+
+В режиме settings.ACT_POST_PROCESSING_DEFERRED set_act одной командой
+сохраняет акт в records и ставит его в очередь acts_post_processing_queue,
+после чего сразу отвечает AR. Заполнение external_systems_acts_sending_control
+выполняют фоновые обработчики ActPostProcessor пачками.
+
+Очередь хранится в GDB:
+    CREATE TABLE acts_post_processing_queue (
+        record integer PRIMARY KEY REFERENCES records (id) ON DELETE CASCADE,
+        polygon integer,
+        attempts integer NOT NULL DEFAULT 0,
+        next_try timestamp NOT NULL DEFAULT now(),
+        last_error text
+    );
+"""
+import threading
+import traceback
+
+import psycopg2
+import psycopg2.extras
+
+from wserver_compound import functions
+
+
+def get_enqueue_command(insert_command):
+    """
+    Обернуть команду INSERT INTO records ... (без RETURNING) так, чтобы
+    вставленные акты в той же команде попадали в очередь обработки.
+    Команда возвращает строки (id, inserted), где inserted - был ли акт
+    вставлен (а не найден по ON CONFLICT) этой командой.
+
+    :param insert_command: Команда INSERT INTO records.
+    :return:
+    """
+    return """WITH new_records AS ({} RETURNING id, polygon,
+                                              (xmax = 0) AS inserted),
+              queued AS (INSERT INTO acts_post_processing_queue
+                         (record, polygon)
+                         SELECT id, polygon FROM new_records WHERE inserted)
+              SELECT id, inserted FROM new_records""".format(insert_command)
+
+
+def get_queue_stats(sql_shell):
+    """
+    Вернуть размер очереди и время ожидания самого старого акта в ней.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :return:
+    """
+    command = "SELECT count(*), count(*) FILTER (WHERE attempts > 0), " \
+              "extract(epoch FROM now() - min(next_try))::float " \
+              "FROM acts_post_processing_queue"
+    response = sql_shell.try_execute_get(command)
+    if isinstance(response, dict):
+        return response
+    size, failed, oldest = response[0]
+    return {'status': 'success',
+            'info': {'size': size, 'failed': failed, 'oldest_age': oldest}}
+
+
+class ActPostProcessor:
+    """ Пул фоновых обработчиков очереди acts_post_processing_queue.
+    Каждый обработчик забирает пачку актов (FOR UPDATE SKIP LOCKED, так что
+    пачки разных обработчиков и разных процессов не пересекаются),
+    заполняет для нее external_systems_acts_sending_control и удаляет ее из
+    очереди в одной транзакции. Акты, обработка которых провалилась,
+    остаются в очереди и повторяются через retry_delay секунд. """
+
+    def __init__(self, sql_shell, workers=2, batch_size=100,
+                 poll_interval=1, retry_delay=30):
+        """
+        Инициализация.
+
+        :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+        :param workers: Количество потоков-обработчиков.
+        :param batch_size: Сколько актов забирать за раз.
+        :param poll_interval: Пауза между опросами пустой очереди (сек.)
+        :param retry_delay: Через сколько секунд повторить акт после ошибки.
+        """
+        self.sql_shell = sql_shell
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.processed = 0
+        self.failed = 0
+        self.counters_lock = threading.Lock()
+
+    def start(self):
+        """ Запустить обработчиков. """
+        self.stop_event.clear()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.mainloop, daemon=True,
+                                      name='ActPostProcessor-{}'.format(
+                                          number))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """ Остановить обработчиков, дождавшись завершения текущих пачек. """
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = [thread for thread in self.threads
+                        if thread.is_alive()]
+
+    def mainloop(self):
+        while not self.stop_event.is_set():
+            try:
+                with functions.connection_scope(self.sql_shell):
+                    processed = self.process_batch()
+            except Exception:
+                print(traceback.format_exc())
+                processed = 0
+            if processed < self.batch_size:
+                self.stop_event.wait(self.poll_interval)
+
+    def process_batch(self):
+        """ Обработать одну пачку актов из очереди.
+
+        :return: Сколько актов было забрано из очереди. """
+        cursor, conn = self.sql_shell.get_cursor_conn()
+        try:
+            cursor.execute("SELECT record, polygon "
+                           "FROM acts_post_processing_queue "
+                           "WHERE next_try <= now() ORDER BY record LIMIT %s "
+                           "FOR UPDATE SKIP LOCKED", (self.batch_size,))
+            records = cursor.fetchall()
+            if not records:
+                conn.rollback()
+                return 0
+            try:
+                self.process_records(cursor, records)
+                succeeded, failed = records, []
+            except psycopg2.Error:
+                # Пачка не прошла - обработать акты по одному, чтобы
+                # отложить только те, на которых ошибка
+                conn.rollback()
+                cursor.execute("SELECT record, polygon "
+                               "FROM acts_post_processing_queue "
+                               "WHERE record = ANY(%s) "
+                               "FOR UPDATE SKIP LOCKED",
+                               ([record for record, _ in records],))
+                records = cursor.fetchall()
+                succeeded, failed = [], []
+                for record in records:
+                    cursor.execute("SAVEPOINT act_record")
+                    try:
+                        self.process_records(cursor, [record])
+                        succeeded.append(record)
+                    except psycopg2.Error:
+                        cursor.execute("ROLLBACK TO SAVEPOINT act_record")
+                        failed.append((record, traceback.format_exc()))
+                for (record, _), error in failed:
+                    cursor.execute("UPDATE acts_post_processing_queue "
+                                   "SET attempts = attempts + 1, "
+                                   "next_try = now() + %s * interval '1 sec', "
+                                   "last_error = %s WHERE record = %s",
+                                   (self.retry_delay, error, record))
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        with self.counters_lock:
+            self.processed += len(succeeded)
+            self.failed += len(failed)
+        return len(records)
+
+    def process_records(self, cursor, records):
+        """ Заполнить external_systems_acts_sending_control для актов records
+        и удалить их из очереди (в текущей транзакции cursor). """
+        command, values_list, template = \
+            functions.get_acts_send_settings_command(self.sql_shell, records)
+        if values_list:
+            psycopg2.extras.execute_values(cursor, command, values_list,
+                                           template,
+                                           page_size=len(values_list))
+        cursor.execute("DELETE FROM acts_post_processing_queue "
+                       "WHERE record = ANY(%s)",
+                       ([record for record, _ in records],))
+
+    def get_stats(self):
+        """ Вернуть счетчики обработчиков. """
+        return {'workers': len(self.threads), 'processed': self.processed,
+                'failed': self.failed}
@@ -0,0 +1,201 @@
+""" Модуль содержит AsyncQPI - альтернативу QPI на asyncio. Говорит на том же
+протоколе (8 байт длины '>Q', затем pickle-объект вида
+{'method': ..., 'data': {...}}), берет методы из get_api_support_methods
+ядра и супер-методы QPI (hello_world, get_methods, subscribe, unsubscribe,
+auth_me) и отвечает так же, как QPI. Вместо потока на каждого клиента и каждую
+команду все соединения обслуживаются одним циклом событий, а блокирующие
+методы ядра (работа с GDB) выполняются в ограниченном пуле потоков. """
+import asyncio
+import concurrent.futures
+import pickle
+import struct
+import threading
+from qpi.super_methods import super_methods_description
+from traceback import format_exc
+
+
+class AsyncQPI:
+    """ Серверное API на asyncio. """
+
+    def __init__(self, core, my_ip, my_port, sock=None, max_workers=16,
+                 max_pending=256, max_connections=5000, name='AsyncQPI'):
+        """
+        Инициализация.
+
+        :param core: Ядро (WServer), методы которого открываются клиентам.
+        :param my_ip: Адрес.
+        :param my_port: Порт.
+        :param sock: Уже открытый слушающий сокет (вместо my_ip, my_port).
+        :param max_workers: Сколько методов ядра выполнять одновременно.
+        :param max_pending: Сколько команд может ждать выполнения, сверх
+            этого числа команды клиентов перестают читаться из сокетов.
+        :param max_connections: Максимум одновременно подключенных клиентов.
+        :param name: Имя для вывода.
+        """
+        self.core = core
+        self.my_ip = my_ip
+        self.my_port = my_port
+        self.sock = sock
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_connections = max_connections
+        self.name = name
+        self.methods = dict(super_methods_description.super_methods)
+        self.methods['get_methods'] = dict(self.methods['get_methods'],
+                                           method=self.get_methods)
+        self.methods.update(core.get_api_support_methods())
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix=name)
+        self.loop = None
+        self.server = None
+        self.pending = None
+        # {writer: {'auth': ..., 'subscriber': ...}}, как в QPI
+        self.connections_dict = {}
+        self.started = threading.Event()
+        self.thread = None
+        self.commands = 0
+        self.rejected_connections = 0
+
+    def start(self):
+        """ Запустить цикл событий в отдельном потоке и дождаться, пока
+        сервер начнет принимать клиентов. """
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name=self.name)
+        self.thread.start()
+        self.started.wait()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.launch_server())
+            self.started.set()
+            self.loop.run_forever()
+        finally:
+            self.started.set()
+            self.loop.close()
+
+    async def launch_server(self):
+        self.pending = asyncio.Semaphore(self.max_pending)
+        if self.sock:
+            self.server = await asyncio.start_server(self.dispatcher,
+                                                     sock=self.sock)
+        else:
+            self.server = await asyncio.start_server(self.dispatcher,
+                                                     self.my_ip, self.my_port)
+        print('\n[{}] Waiting for new connections on {}:{}'.format(
+            self.name, self.my_ip, self.my_port))
+
+    async def dispatcher(self, reader, writer):
+        """ Обслуживание подключения: читает команды клиента и запускает их
+        выполнение, не дожидаясь ответа на предыдущие (как и QPI). """
+        if len(self.connections_dict) >= self.max_connections:
+            self.rejected_connections += 1
+            writer.close()
+            return
+        self.connections_dict[writer] = {'auth': True, 'subscriber': False}
+        send_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                packet = await reader.readexactly(8)
+                (data_length,) = struct.unpack('>Q', packet)
+                command = pickle.loads(await reader.readexactly(data_length))
+                await self.pending.acquire()
+                task = asyncio.ensure_future(
+                    self.command_execute(command, writer, send_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.connections_dict.pop(writer, None)
+            writer.close()
+
+    async def command_execute(self, command, writer, send_lock):
+        self.commands += 1
+        try:
+            response = await self.loop.run_in_executor(
+                self.executor, self.execute_command, command['method'],
+                command.get('data') or {}, writer)
+            try:
+                pickled_response = pickle.dumps(response)
+            except Exception:
+                pickled_response = pickle.dumps({'status': False,
+                                                 'info': format_exc()})
+            async with send_lock:
+                writer.write(struct.pack('>Q', len(pickled_response)))
+                writer.write(pickled_response)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.pending.release()
+
+    def execute_command(self, comm, values, connection=None):
+        """ Выполнить метод comm с аргументами values от клиента connection
+        и вернуть ответ в формате QPI. Как и QPI, добавляет к аргументам
+        сведения о подключении (их принимают супер-методы). """
+        values.update(connections_dict=self.connections_dict,
+                      connection=connection, users_table_name=None,
+                      user_name_column=None, sql_shell=None, self_qpi=self,
+                      methods_dict=self.methods, command=comm,
+                      qpi_name=self.name)
+        response_dict = {}
+        try:
+            method = self.methods[comm]['method']
+        except KeyError:
+            return {'status': True, 'core_method': comm,
+                    'info': {'status': False,
+                             'info': 'Метод {} не поддерживается на стороне '
+                                     '{}'.format(comm, self.name)}}
+        try:
+            response = method(**values)
+            response_dict['status'] = True
+            response_dict['info'] = response
+            response_dict['core_method'] = comm
+        except:
+            response_dict['status'] = False
+            response_dict['info'] = format_exc()
+        return response_dict
+
+    def stop_listening(self):
+        """ Перестать принимать новых клиентов. """
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    def close_connections(self):
+        """ Закрыть все соединения с клиентами и остановить цикл событий. """
+        if not self.loop or self.loop.is_closed():
+            return
+
+        def close_all():
+            for writer in list(self.connections_dict):
+                writer.close()
+            self.loop.call_later(0.1, self.loop.stop)
+
+        self.loop.call_soon_threadsafe(close_all)
+        self.thread.join(5)
+        self.executor.shutdown(wait=False)
+
+    def get_methods(self, *args, **kwargs):
+        """ Супер-метод get_methods: описания методов без самих функций
+        (функции не передаются по сети). """
+        return {'status': True,
+                'info': {name: {key: value
+                                for key, value in description.items()
+                                if key != 'method'}
+                         for name, description in self.methods.items()}}
+
+    def after_auth_execute(self, *args, **kwargs):
+        """ Вызывается супер-методом auth_me после авторизации. """
+        pass
+
+    def get_stats(self):
+        """ Вернуть счетчики сервера. """
+        return {'connections': len(self.connections_dict),
+                'commands': self.commands,
+                'rejected_connections': self.rejected_connections,
+                'max_workers': self.max_workers}
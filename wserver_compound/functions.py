@@ -1,17 +1,28 @@
 """ Здесь содержатся функции, необходимые для выполнения основного функционала
 WServer (methods.py) """
 
-import ast
 import base64
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
 import os
 import inspect
+import json
+import select
+import threading
+import time
 import uuid
 import traceback
 
+import psycopg2
+import psycopg2.extras
 import wsqluse.wsqluse
-from wtas.operators import WTA
+from wserver_compound import photo_store
 from wserver_compound import settings
+from wserver_compound import statements
+from wserver_compound import wta_clients
 
 
 def format_wsqluse_response(func):
@@ -25,6 +36,7 @@ def format_wsqluse_response(func):
             {'status': False, info: Python Traceback}
     """
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         response = func(*args, **kwargs)
         new_response = response
@@ -58,6 +70,219 @@ def operate_mask(sql_shell, mask: str, table_name: str, record_id: int):
     return sql_shell.update_record(command)
 
 
+def connection_scope(sql_shell):
+    """
+    Вернуть контекст, внутри которого все команды sql_shell выполняются
+    через одно соединение из пула (если sql_shell поддерживает пул,
+    см. pool.PooledWsqluse).
+
+    :param sql_shell: Объект типа WSQluse для работы с БД.
+    :return:
+    """
+    if hasattr(sql_shell, 'request_scope'):
+        return sql_shell.request_scope()
+    return contextlib.nullcontext()
+
+
+def try_execute_batch(sql_shell, command, values_list, template=None):
+    """
+    Выполнить многострочную команду (INSERT ... VALUES %s RETURNING ...) для
+    всех строк values_list одним запросом в одной транзакции. Если запрос
+    проваливается целиком, строки вставляются по одной под SAVEPOINT, чтобы
+    ошибка одной строки не отменяла остальные.
+
+    :param sql_shell: Объект типа WSQluse для работы с БД.
+    :param command: Комманда с одним %s на месте VALUES.
+    :param values_list: Список кортежей со значениями.
+    :param template: Шаблон одной строки VALUES (см. psycopg2 execute_values).
+    :return: Список ответов в формате WSQLuse, по одному на каждую строку
+        values_list, в том же порядке.
+    """
+    if not values_list:
+        return []
+    cursor, conn = sql_shell.get_cursor_conn()
+    try:
+        try:
+            records = psycopg2.extras.execute_values(
+                cursor, command, values_list, template,
+                page_size=len(values_list), fetch=True)
+            response = [{'status': 'success', 'info': [record]}
+                        for record in records]
+        except psycopg2.Error:
+            conn.rollback()
+            response = []
+            for values in values_list:
+                cursor.execute("SAVEPOINT batch_row")
+                try:
+                    record = psycopg2.extras.execute_values(
+                        cursor, command, [values], template, fetch=True)
+                    response.append({'status': 'success', 'info': record})
+                except psycopg2.Error:
+                    cursor.execute("ROLLBACK TO SAVEPOINT batch_row")
+                    response.append({'status': 'failed',
+                                     'info': traceback.format_exc()})
+        conn.commit()
+    except psycopg2.Error:
+        failed = sql_shell.transaction_fail(cursor)
+        response = [failed for _ in values_list]
+    finally:
+        conn.close()
+    return response
+
+
+def try_execute_values(sql_shell, command, values_list, template=None):
+    """
+    Выполнить команду с одним %s на месте VALUES для всех строк values_list
+    одним запросом.
+
+    :param sql_shell: Объект типа WSQluse для работы с БД.
+    :param command: Комманда с одним %s на месте VALUES.
+    :param values_list: Список кортежей со значениями.
+    :param template: Шаблон одной строки VALUES (см. psycopg2 execute_values).
+    :return: Ответ в формате WSQLuse, в info - количество затронутых строк.
+    """
+    if not values_list:
+        return {'status': 'success', 'info': 0}
+    cursor, conn = sql_shell.get_cursor_conn()
+    try:
+        psycopg2.extras.execute_values(cursor, command, values_list, template,
+                                       page_size=len(values_list))
+        conn.commit()
+        response = {'status': 'success', 'info': cursor.rowcount}
+    except psycopg2.Error:
+        response = sql_shell.transaction_fail(cursor)
+    finally:
+        conn.close()
+    return response
+
+
+class LRUCache:
+    """ Потокобезопасный словарь ограниченного размера. При переполнении
+    вытесняет ключи, к которым дольше всего не обращались. """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def put(self, key, value):
+        if not self.max_size:
+            return
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def __len__(self):
+        return len(self.items)
+
+
+# Недавно принятые акты {(полигон, ex_id): records.id}, чтобы отвечать на
+# повторы set_act, не обращаясь к GDB
+recent_acts = LRUCache(settings.ACT_DEDUP_CACHE_SIZE)
+
+# Уникальный индекс records (polygon, ex_id), по которому set_act узнает
+# повторно присланный акт (ON CONFLICT)
+ACT_UNIQUE_INDEX = 'records_polygon_ex_id'
+CREATE_ACT_UNIQUE_INDEX = "CREATE UNIQUE INDEX CONCURRENTLY {} " \
+                          "ON records (polygon, ex_id)".format(
+                              ACT_UNIQUE_INDEX)
+# Advisory lock создания индекса (процессы prefork создают его по очереди)
+ACT_UNIQUE_INDEX_LOCK = (21, 0)
+
+
+class ActUniqueIndex:
+    """ Наличие уникального индекса records (polygon, ex_id). Пока индекса
+    нет, set_act вставляет акты без ON CONFLICT, и повторы отсекает только
+    recent_acts. Проверяется при запуске WServer (check). """
+
+    def __init__(self):
+        self.present = False
+
+    def check(self, sql_shell, create=False):
+        """
+        Проверить наличие индекса и, если create, создать его
+        (CONCURRENTLY, без блокировки записи в records). Индекс не
+        создается, если в records уже есть повторы (polygon, ex_id), - их
+        надо разобрать вручную, в ответе перечислены первые из них.
+
+        :param sql_shell: Объект типа WSQluse для работы с БД.
+        :param create: Создать индекс, если его нет.
+        :return: {'status': есть ли индекс, 'info': описание}
+        """
+        cursor, conn = sql_shell.get_cursor_conn()
+        try:
+            # CREATE INDEX CONCURRENTLY нельзя выполнять в транзакции
+            conn.autocommit = True
+            self.present = self.find(cursor)
+            if self.present:
+                return {'status': True, 'info': 'Индекс {} есть'.format(
+                    ACT_UNIQUE_INDEX)}
+            if create:
+                cursor.execute("SELECT pg_advisory_lock(%s, %s)",
+                               ACT_UNIQUE_INDEX_LOCK)
+                self.present = self.find(cursor)
+                if self.present:
+                    return {'status': True, 'info': 'Индекс {} есть'.format(
+                        ACT_UNIQUE_INDEX)}
+            cursor.execute("SELECT polygon, ex_id, count(*) FROM records "
+                           "WHERE polygon IS NOT NULL AND ex_id IS NOT NULL "
+                           "GROUP BY polygon, ex_id HAVING count(*) > 1 "
+                           "ORDER BY count(*) DESC LIMIT 20")
+            duplicates = cursor.fetchall()
+            if duplicates:
+                return {'status': False,
+                        'info': 'Индекс {} не создан: в records есть повторы '
+                                '(polygon, ex_id, количество): {}'.format(
+                                    ACT_UNIQUE_INDEX, duplicates)}
+            if not create:
+                return {'status': False,
+                        'info': 'Нет индекса {}, повторы актов не '
+                                'отсекаются. Создать: {}'.format(
+                                    ACT_UNIQUE_INDEX,
+                                    CREATE_ACT_UNIQUE_INDEX)}
+            # Недостроенный индекс, оставшийся от прерванного создания
+            cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(
+                ACT_UNIQUE_INDEX))
+            cursor.execute(CREATE_ACT_UNIQUE_INDEX)
+            self.present = True
+            return {'status': True, 'info': 'Индекс {} создан'.format(
+                ACT_UNIQUE_INDEX)}
+        except psycopg2.Error as error:
+            return {'status': False, 'info': str(error)}
+        finally:
+            conn.close()
+
+    def find(self, cursor):
+        """ Есть ли действующий уникальный индекс records (polygon, ex_id)
+        (под любым именем). """
+        cursor.execute(
+            "SELECT 1 FROM pg_index i "
+            "WHERE i.indrelid = 'records'::regclass AND i.indisunique "
+            "AND i.indisvalid AND i.indpred IS NULL "
+            "AND i.indexprs IS NULL AND i.indnatts = 2 "
+            "AND (SELECT array_agg(a.attname::text ORDER BY a.attname) "
+            "     FROM pg_attribute a WHERE a.attrelid = i.indrelid "
+            "     AND a.attnum = ANY(i.indkey)) = ARRAY['ex_id', 'polygon']")
+        return bool(cursor.fetchall())
+
+
+act_unique_index = ActUniqueIndex()
+
+
 def format_act_time(time, time_mask='%Y.%m.%d %H:%M:%S'):
     """ Получает дату-время, в виде строки, конвертирует его в объект
         datetime.datetime и возвращает результат.
@@ -83,22 +308,127 @@ def generate_photo_name(record_id=None):
     return full_photo_name
 
 
+# Хранилище фото и сеансы загрузки фото частями
+photo_storage = photo_store.get_photo_store(
+    settings.PHOTO_STORE, settings.PHOTOS_DIR, settings.PHOTO_MAX_SIZE,
+    segment_size=settings.PHOTO_PACK_SEGMENT_SIZE)
+photo_uploads = photo_store.PhotoUploads(photo_storage,
+                                         settings.PHOTO_UPLOAD_TTL)
+photo_cache = photo_store.PhotoCache(settings.PHOTO_CACHE_SIZE,
+                                     settings.PHOTO_CACHE_MAX_PHOTO)
+# Потоки для параллельной записи фото одного акта (set_photos_batch)
+photo_executor = concurrent.futures.ThreadPoolExecutor(
+    settings.PHOTO_BATCH_WORKERS, thread_name_prefix='PhotoBatch')
+# Общий пул доставки данных на полигоны (WTA)
+delivery_executor = concurrent.futures.ThreadPoolExecutor(
+    settings.WTA_DELIVERY_WORKERS, thread_name_prefix='WTADelivery')
+# Клиенты полигонов, переиспользуемые всеми доставками
+wta_client_pool = wta_clients.WTAClientPool(
+    settings.WTA_CLIENT_MAX_IDLE, settings.WTA_CONNECT_TIMEOUT,
+    settings.WTA_RESPONSE_TIMEOUT, settings.WTA_BREAKER_FAILURES,
+    settings.WTA_BREAKER_RESET_TIMEOUT)
+
+
 def save_photo(photo_obj, photo_path):
-    """ Сохранить фотографию по указанному пути
-    :param photo_obj: Объект фотографии в кодировке base64
+    """ Сохранить фотографию по указанному пути. Фото декодируется и
+    пишется частями по settings.PHOTO_DECODE_CHUNK_SIZE символов.
+    :param photo_obj: Объект фотографии в кодировке base64, в виде строки
     :param photo_path: Путь, по которому сохранить фото"""
-    with open(photo_path, 'wb') as fobj:
-        photo_obj = ast.literal_eval(photo_obj)
-        fobj.write(base64.decodebytes(photo_obj))
-    return photo_path
+    writer = photo_store.PhotoWriter(photo_path, settings.PHOTO_MAX_SIZE)
+    try:
+        photo_store.write_base64_repr(writer, photo_obj,
+                                      settings.PHOTO_DECODE_CHUNK_SIZE)
+    except Exception:
+        writer.abort()
+        raise
+    return writer.commit()
+
+
+def save_photo_to_store(record, photo_obj):
+    """
+    Сохранить фото в хранилище фото.
+
+    :param record: ID заезда
+    :param photo_obj: Фото в двоичном виде (bytes) или в старом формате
+        set_photos (base64 в виде строки)
+    :return: Путь (photo_path) сохраненного фото.
+    """
+    if isinstance(photo_obj, bytes):
+        return photo_storage.save(record, photo_obj)
+    return photo_storage.save_base64_repr(record, photo_obj,
+                                          settings.PHOTO_DECODE_CHUNK_SIZE)
+
+
+def discard_photos(sql_shell, photo_paths, written_at):
+    """
+    Удалить фото, сохраненные в хранилище, но не зарегистрированные в
+    act_photos (например, INSERT не прошел). Файл, на который уже ссылается
+    act_photos (ShardedPhotoStore хранит одинаковые фото одним файлом), или
+    переиспользованный после written_at, не удаляется. Если GDB недоступна,
+    общие файлы не удаляются вовсе.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :param photo_paths: Пути (photo_path) фото.
+    :param written_at: Время (time.time()) окончания записи фото.
+    :return: Сколько файлов удалено.
+    """
+    if not photo_paths:
+        return 0
+    referenced = set()
+    if photo_storage.shared_files:
+        try:
+            cursor, conn = sql_shell.get_cursor_conn()
+        except psycopg2.Error:
+            return 0
+        try:
+            cursor.execute("SELECT photo_path FROM act_photos "
+                           "WHERE photo_path = ANY(%s)", (photo_paths,))
+            referenced = {row[0] for row in cursor.fetchall()}
+            conn.rollback()
+        except psycopg2.Error:
+            return 0
+        finally:
+            conn.close()
+    removed = 0
+    for photo_path in set(photo_paths) - referenced:
+        try:
+            removed += photo_storage.remove(photo_path,
+                                            time.time() - written_at)
+        except OSError:
+            print(traceback.format_exc())
+    return removed
+
+
+def read_photo(photo_path, offset=0, length=None):
+    """
+    Прочитать фото (или его часть) из хранилища. Небольшие фото читаются
+    целиком и кэшируются в photo_cache, большие читаются только в
+    запрошенном диапазоне.
+
+    :param photo_path: act_photos.photo_path
+    :param offset: Смещение от начала фото.
+    :param length: Сколько байт прочитать (None - до конца фото).
+    :return: (данные, размер всего фото)
+    """
+    offset = max(offset, 0)
+    data = photo_cache.get(photo_path)
+    if data is None:
+        if photo_storage.photo_size(photo_path) > photo_cache.max_photo_size:
+            return photo_storage.read_range(photo_path, offset, length)
+        data, _ = photo_storage.read_range(photo_path)
+        photo_cache.put(photo_path, data)
+    end = len(data) if length is None else offset + length
+    return data[offset:end], len(data)
 
 
 def save_photo_database(sql_shell, record: int, photo_path, photo_type: int):
     command = """INSERT INTO act_photos 
                 (record, photo_path, photo_type)
-                VALUES (%s, %s, %s)"""
+                VALUES (%s, %s, %s)
+                RETURNING id"""
     values = (record, photo_path, photo_type)
-    response = sql_shell.try_execute_double(command, values)
+    response = statements.try_execute(sql_shell, 'save_photo_database',
+                                      command, values)
     return response
 
 
@@ -142,32 +472,37 @@ def send_data_to_core(data_type, table_name):
     """
 
     def decorator(func):
+        signature = inspect.signature(func)
+        # Если полигон - обязательный аргумент метода (set_*), запись
+        # создается с ним, и перечитывать его из GDB незачем
+        polygon_arg = signature.parameters.get('polygon')
+        lookup_polygon = (polygon_arg is None or
+                          polygon_arg.default is not inspect.Parameter.empty)
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            if settings.WTA_OUTBOX:
+                return enqueue_to_core(func, signature, lookup_polygon,
+                                       data_type, table_name, *args,
+                                       **kwargs)
             response = func(*args, **kwargs)
             if response['status']:
-                all_args = collect_args(func, *args, **kwargs)
-                polygon = get_polygon_id(args[0], table_name, response['info'])
-                # Если полигон не указан, отправить данные по всем
-                if not polygon:
-                    all_polygons = get_all_polygon_ids(args[0])
-                else:
-                    all_polygons = [polygon]
-                for polygon in all_polygons:
-                    try:
-                        wta = WTA(data_type, args[0].dbname, args[0].user,
-                                  args[0].password, args[0].host, polygon)
-                        wta_response = wta.deliver(wserver_id=response['info'],
-                                                   **all_args)
-                        response.update(wta_response)
-                    except ConnectionRefusedError:
-                        response.update({'ar_deliver_status': False,
-                                        'error_info': 'Нет доступа к полигону!'})
-                    except TypeError:
-                        response.update({'ar_deliver_status': False,
-                                        'error_info':
-                                            'Внесите данные о полигоне {} в '
-                                            'wta_connection_info!'.format(polygon)})
-                        print(traceback.format_exc())
+                all_args = bind_args(signature, *args, **kwargs)
+                all_polygons = get_target_polygons(
+                    args[0], table_name, response['info'],
+                    all_args.get('polygon'), lookup_polygon)
+                if wta_coalescer.window and wta_coalescer.submit(
+                        args[0], data_type, all_polygons, response['info'],
+                        all_args) is not None:
+                    response['delivery_pending'] = True
+                    return response
+                deliveries = deliver_to_polygons(
+                    args[0], data_type, all_polygons, response['info'],
+                    all_args)
+                response['deliveries'] = deliveries
+                response['ar_deliver_status'] = all(
+                    delivery.get('ar_deliver_status', True)
+                    for delivery in deliveries.values())
             return response
 
         return wrapper
@@ -175,6 +510,208 @@ def send_data_to_core(data_type, table_name):
     return decorator
 
 
+def bind_args(signature, *args, **kwargs):
+    """
+    Собрать аргументы вызова метода в словарь по его сигнатуре, с
+    значениями по умолчанию для непереданных.
+
+    :param signature: inspect.Signature метода.
+    :return:
+    """
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    all_args = dict(bound.arguments)
+    for name, parameter in signature.parameters.items():
+        if parameter.kind is inspect.Parameter.VAR_KEYWORD:
+            all_args.update(all_args.pop(name))
+        elif parameter.kind is inspect.Parameter.VAR_POSITIONAL:
+            all_args.pop(name)
+    return all_args
+
+
+def get_target_polygons(sql_shell, table_name, record_id, polygon=None,
+                        lookup_polygon=True):
+    """
+    Вернуть полигоны, на которые надо доставить запись record_id таблицы
+    table_name: ее полигон, а если он не указан - все полигоны
+    (polygon_directory).
+
+    :param sql_shell: Объект WSqluse для доступа к GDB.
+    :param table_name: Имя таблицы.
+    :param record_id: ID записи.
+    :param polygon: Полигон из аргументов метода, если он известен.
+    :param lookup_polygon: Если полигон не передан, прочитать его из записи
+        (для изменений, которые полигон записи не меняют).
+    :return: Список ID полигонов.
+    """
+    if not polygon and lookup_polygon:
+        polygon = get_polygon_id(sql_shell, table_name, record_id)
+    if not polygon:
+        return polygon_directory.get_polygon_ids(sql_shell)
+    return [polygon]
+
+
+def transaction_scope(sql_shell):
+    """
+    Вернуть контекст, все команды sql_shell внутри которого выполняются в
+    одной транзакции (если sql_shell это поддерживает, см.
+    pool.PooledWsqluse.transaction).
+
+    :param sql_shell: Объект типа WSQluse для работы с БД.
+    :return:
+    """
+    if hasattr(sql_shell, 'transaction'):
+        return sql_shell.transaction()
+    return contextlib.nullcontext()
+
+
+def enqueue_to_core(func, signature, lookup_polygon, data_type, table_name,
+                    *args, **kwargs):
+    """
+    Выполнить метод func и в той же транзакции поставить его данные в
+    wta_outbox (по строке на каждый целевой полигон). Доставку выполняет
+    wta_outbox.OutboxDispatcher. Если какая-либо команда внутри не удалась
+    (в том числе через transaction_fail, см. pool.PooledWsqluse), вся
+    транзакция откатывается и возвращается ошибка.
+
+    :param func: Метод WServer (send_data_to_core).
+    :param signature: inspect.Signature метода.
+    :param lookup_polygon: См. get_target_polygons.
+    :param data_type: Вид данных (operator, auto etc).
+    :param table_name: Имя таблицы, в которой происходит работа с данными.
+    :return: Ответ func, дополненный ID строк wta_outbox ('outbox').
+    """
+    sql_shell = args[0]
+    try:
+        with transaction_scope(sql_shell):
+            response = func(*args, **kwargs)
+            if response['status']:
+                all_args = bind_args(signature, *args, **kwargs)
+                all_args.pop('sql_shell', None)
+                polygons = get_target_polygons(
+                    sql_shell, table_name, response['info'],
+                    all_args.get('polygon'), lookup_polygon)
+                response['outbox'] = enqueue_wta_outbox(
+                    sql_shell, data_type, polygons, response['info'],
+                    all_args)
+    except Exception:
+        print(traceback.format_exc())
+        return {'status': False, 'info': traceback.format_exc()}
+    return response
+
+
+def enqueue_wta_outbox(sql_shell, data_type, polygons, wserver_id, payload):
+    """
+    Поставить данные в wta_outbox (в текущей транзакции sql_shell).
+
+    :param sql_shell: Объект WSqluse для доступа к GDB.
+    :param data_type: Вид данных (operator, auto etc).
+    :param polygons: ID полигонов.
+    :param wserver_id: ID данных в GDB.
+    :param payload: Аргументы метода WServer, с которыми вызвать WTA.deliver.
+    :return: ID строк wta_outbox.
+    """
+    if not polygons:
+        return []
+    payload = json.dumps(payload, default=str)
+    cursor, conn = sql_shell.get_cursor_conn()
+    try:
+        # Доставка откладывается на окно склейки, чтобы изменения записи в
+        # этом окне ушли на полигон одной доставкой
+        records = psycopg2.extras.execute_values(
+            cursor, "INSERT INTO wta_outbox "
+                    "(data_type, polygon, wserver_id, payload, next_try) "
+                    "VALUES %s RETURNING id",
+            [(data_type, polygon, wserver_id, payload)
+             for polygon in polygons],
+            template="(%s, %s, %s, %s, now() + {} * interval '1 sec')".format(
+                float(settings.WTA_COALESCE_WINDOW)), fetch=True)
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return [record[0] for record in records]
+
+
+def deliver_to_polygon(sql_shell, data_type, polygon, wserver_id, all_args):
+    """
+    Доставить данные на один полигон через WTA.
+
+    :param sql_shell: Объект WSqluse для доступа к GDB.
+    :param data_type: Вид данных (operator, auto etc).
+    :param polygon: ID полигона.
+    :param wserver_id: ID данных в GDB.
+    :param all_args: Аргументы метода WServer.
+    :return: Ответ WTA или {'ar_deliver_status': False, 'error_info': ...}
+        ('permanent': True, если повтор доставки не поможет).
+    """
+    kwargs = {name: value for name, value in all_args.items()
+              if name != 'sql_shell'}
+    try:
+        with connection_scope(sql_shell):
+            return wta_client_pool.deliver(sql_shell, data_type, polygon,
+                                           wserver_id, kwargs)
+    except OSError:
+        return {'ar_deliver_status': False,
+                'error_info': 'Нет доступа к полигону!'}
+    except (wta_clients.NoConnectionInfo, wta_clients.CircuitOpen,
+            psycopg2.Error) as error:
+        return {'ar_deliver_status': False, 'error_info': str(error)}
+    except Exception as error:
+        # Неизвестный вид данных, неподходящие аргументы и т.п.
+        print(traceback.format_exc())
+        return {'ar_deliver_status': False, 'error_info': str(error),
+                'permanent': True}
+
+
+def deliver_to_polygons(sql_shell, data_type, polygons, wserver_id, all_args,
+                        timeout=None):
+    """
+    Доставить данные на полигоны параллельно (через delivery_executor).
+    Полигон, не ответивший за timeout секунд, получает ответ с ошибкой,
+    а его доставка завершается в фоне, не задерживая запрос.
+
+    :param sql_shell: Объект WSqluse для доступа к GDB.
+    :param data_type: Вид данных (operator, auto etc).
+    :param polygons: ID полигонов.
+    :param wserver_id: ID данных в GDB.
+    :param all_args: Аргументы метода WServer.
+    :param timeout: Сколько секунд ждать ответа полигона (по умолчанию -
+        settings.WTA_DELIVERY_TIMEOUT).
+    :return: {polygon: ответ доставки}
+    """
+    if timeout is None:
+        timeout = settings.WTA_DELIVERY_TIMEOUT
+    futures = {polygon: delivery_executor.submit(
+        deliver_to_polygon, sql_shell, data_type, polygon, wserver_id,
+        all_args) for polygon in polygons}
+    deadline = time.monotonic() + timeout
+    deliveries = {}
+    for polygon, future in futures.items():
+        try:
+            deliveries[polygon] = future.result(
+                max(deadline - time.monotonic(), 0))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            deliveries[polygon] = {
+                'ar_deliver_status': False,
+                'error_info': 'Полигон не ответил за {} сек.'.format(
+                    timeout)}
+    return deliveries
+
+
+# Склейка частых изменений одной записи перед доставкой на полигоны
+wta_coalescer = wta_clients.DeliveryCoalescer(deliver_to_polygon,
+                                              delivery_executor,
+                                              settings.WTA_COALESCE_WINDOW)
+
+
+# Выборка ID всех полигонов (get_all_polygon_ids, PolygonDirectory)
+ALL_POLYGON_IDS_COMMAND = "SELECT polygon FROM duo_polygons WHERE duo_role=1"
+
+
 def get_all_polygon_ids(sql_shell):
     """
     Вернуть ID всех полигонов.
@@ -182,26 +719,68 @@ def get_all_polygon_ids(sql_shell):
     :param sql_shell: Объект WSqluse для доступа к GDB.
     :return:
     """
-    command = "SELECT polygon FROM duo_polygons WHERE duo_role=1"
-    response = sql_shell.try_execute_get(command)
+    response = sql_shell.try_execute_get(ALL_POLYGON_IDS_COMMAND)
     if response:
         return [x[0] for x in response]
 
 
-def collect_args(func, *args, **kwargs):
-    """ Собирает все аргументы функции в словарь.
-    :param func: функция, которую необходимо изучить и извлечь аргументы
-    :return: возвращает словарь. """
-    argspec = inspect.getfullargspec(func).args
-    default_values = {
-        k: v.default
-        for k, v in inspect.signature(func).parameters.items()
-        if v.default is not inspect.Parameter.empty
-    }
-    all_args = dict(zip(argspec, locals()['args']))
-    all_args.update(kwargs)
-    all_args.update(default_values)
-    return all_args
+class PolygonDirectory:
+    """ Кэш списка полигонов (get_all_polygon_ids), на которые доставляются
+    справочные данные без полигона. Перечитывается из GDB по истечению ttl
+    или после сброса (invalidate). """
+
+    def __init__(self, ttl):
+        """
+        Инициализация.
+
+        :param ttl: Время жизни кэша в секундах. 0 - кэш отключен.
+        """
+        self.ttl = ttl
+        self.polygons = []
+        self.load_time = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def is_fresh(self):
+        return (self.load_time is not None
+                and time.monotonic() - self.load_time < self.ttl)
+
+    def load(self, sql_shell):
+        """ Перечитать список из GDB. Возвращает True, если удалось. """
+        response = sql_shell.try_execute_get(ALL_POLYGON_IDS_COMMAND)
+        if isinstance(response, dict):
+            return False
+        self.polygons = [polygon for polygon, in response]
+        self.load_time = time.monotonic()
+        return True
+
+    def get_polygon_ids(self, sql_shell):
+        """ Вернуть ID всех полигонов (копию списка). Если GDB недоступна и
+        в кэше ничего нет - пустой список. """
+        with self.lock:
+            if self.ttl and self.is_fresh():
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.load(sql_shell)
+            return list(self.polygons)
+
+    def invalidate(self):
+        """ Сбросить кэш, при следующем обращении он будет перечитан. """
+        with self.lock:
+            self.load_time = None
+            self.invalidations += 1
+
+    def get_stats(self):
+        """ Вернуть счетчики попаданий и промахов кэша. """
+        return {'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations,
+                'polygons': list(self.polygons), 'fresh': self.is_fresh()}
+
+
+polygon_directory = PolygonDirectory(settings.POLYGON_DIRECTORY_TTL)
 
 
 def set_record_unactive(sql_shell, table_name, record_id, active=False):
@@ -255,13 +834,193 @@ def id_converter(table_name, wserver_id):
 def set_all_external_systems_act_send_settings(sql_shell, polygon, record):
     """ Устанавливает статус отправки акта во все внешние системы исходя
     из их текущего статуса """
-    response = []
-    all_external_systems = get_all_external_systems(sql_shell)
-    for external_system in all_external_systems['info']:
-        result = set_act_send_settings(sql_shell, external_system['id'],
-                                       polygon, record)
-        response.append(result)
-    return response
+    return set_acts_send_settings(sql_shell, [(record, polygon)])
+
+
+def set_acts_send_settings(sql_shell, records):
+    """ Устанавливает статус отправки актов во все внешние системы исходя из
+    текущих настроек external_systems_act_send_settings их полигонов.
+    Выполняется одной командой, сколько бы ни было актов и внешних систем.
+
+    :param sql_shell: Объект типа WSQluse для работы с БД.
+    :param records: Список пар (ID акта, ID полигона).
+    :return: Ответ в формате WSQLuse, в info - количество записей в
+        external_systems_acts_sending_control."""
+    command, values_list, template = get_acts_send_settings_command(
+        sql_shell, records)
+    return try_execute_values(sql_shell, command, values_list, template)
+
+
+def get_acts_send_settings_command(sql_shell, records):
+    """ Вернуть команду для заполнения external_systems_acts_sending_control
+    по актам records, в виде (command, values_list, template) для
+    psycopg2 execute_values. Настройки берутся из act_send_settings_cache,
+    если же кэш недоступен - читаются из GDB в той же команде.
+
+    :param sql_shell: Объект типа WSQluse для работы с БД.
+    :param records: Список пар (ID акта, ID полигона).
+    :return: """
+    rows = get_acts_send_control_rows(sql_shell, records)
+    if rows is not None:
+        command = """INSERT INTO external_systems_acts_sending_control
+                    (record, external_system, must_be_send)
+                    VALUES %s
+                    ON CONFLICT (record, external_system)
+                    DO UPDATE SET must_be_send = EXCLUDED.must_be_send"""
+        return command, rows, None
+    command = """INSERT INTO external_systems_acts_sending_control
+                (record, external_system, must_be_send)
+                SELECT acts.record, ss.external_system, ss.send_acts
+                FROM (VALUES %s) AS acts (record, polygon),
+                    external_systems_act_send_settings ss
+                WHERE ss.polygon = acts.polygon
+                AND ss.external_system IN (SELECT id FROM external_systems)
+                ON CONFLICT (record, external_system)
+                DO UPDATE SET must_be_send = EXCLUDED.must_be_send"""
+    return command, records, '(%s::bigint, %s::bigint)'
+
+
+def get_acts_send_control_rows(sql_shell, records):
+    """ Собрать строки (акт, внешняя система, must_be_send) для
+    external_systems_acts_sending_control по кэшу настроек отправки.
+
+    :param sql_shell: Объект типа WSQluse для работы с БД.
+    :param records: Список пар (ID акта, ID полигона).
+    :return: Список строк или None, если кэш недоступен. """
+    rows = []
+    for record, polygon in records:
+        polygon_settings = act_send_settings_cache.get_polygon_settings(
+            sql_shell, polygon)
+        if polygon_settings is None:
+            return None
+        rows += [(record, external_system, send_acts)
+                 for external_system, send_acts in polygon_settings]
+    return rows
+
+
+class ActSendSettingsCache:
+    """ Кэш матрицы настроек отправки актов во внешние системы вида
+    {(полигон, внешняя система): send_acts}. Перечитывается из GDB по
+    истечению ttl или после сброса (invalidate). """
+
+    def __init__(self, ttl):
+        """
+        Инициализация.
+
+        :param ttl: Время жизни кэша в секундах. 0 - кэш отключен.
+        """
+        self.ttl = ttl
+        self.matrix = {}
+        self.polygons = {}
+        self.load_time = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def is_fresh(self):
+        return (self.load_time is not None
+                and time.monotonic() - self.load_time < self.ttl)
+
+    def load(self, sql_shell):
+        """ Перечитать матрицу из GDB. Возвращает True, если удалось. """
+        command = "SELECT polygon, external_system, send_acts " \
+                  "FROM external_systems_act_send_settings " \
+                  "WHERE external_system IN (SELECT id FROM external_systems)"
+        response = sql_shell.try_execute_get(command)
+        if isinstance(response, dict):
+            return False
+        matrix = {}
+        polygons = {}
+        for polygon, external_system, send_acts in response:
+            matrix[(polygon, external_system)] = send_acts
+            polygons.setdefault(polygon, []).append((external_system,
+                                                     send_acts))
+        self.matrix = matrix
+        self.polygons = polygons
+        self.load_time = time.monotonic()
+        return True
+
+    def refresh(self, sql_shell):
+        """ Перечитать матрицу, если она устарела. Возвращает False, если
+        кэш отключен или недоступен. """
+        if not self.ttl:
+            return False
+        with self.lock:
+            if self.is_fresh():
+                self.hits += 1
+                return True
+            self.misses += 1
+            return self.load(sql_shell)
+
+    def get(self, sql_shell, polygon, external_system):
+        """ Вернуть send_acts для пары (полигон, внешняя система). Если
+        настройки нет или кэш недоступен - None. """
+        if self.refresh(sql_shell):
+            return self.matrix.get((polygon, external_system))
+
+    def get_polygon_settings(self, sql_shell, polygon):
+        """ Вернуть список пар (внешняя система, send_acts) для полигона,
+        либо None, если кэш недоступен. """
+        if self.refresh(sql_shell):
+            return self.polygons.get(polygon, [])
+
+    def invalidate(self):
+        """ Сбросить кэш, при следующем обращении он будет перечитан. """
+        with self.lock:
+            self.load_time = None
+            self.invalidations += 1
+
+    def get_stats(self):
+        """ Вернуть счетчики попаданий и промахов кэша. """
+        return {'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations,
+                'size': len(self.matrix), 'fresh': self.is_fresh()}
+
+
+act_send_settings_cache = ActSendSettingsCache(
+    settings.ACT_SEND_SETTINGS_CACHE_TTL)
+
+
+def listen_invalidations(sql_shell, channel, cache, reconnect_timeout=5,
+                         stop_event=None):
+    """
+    Слушать канал PostgreSQL LISTEN/NOTIFY и сбрасывать кэш по каждому
+    уведомлению, а также после каждого (пере)подключения. Уведомления
+    должен посылать триггер на таблицы, из которых читается кэш
+    (NOTIFY <channel>). Блокирует поток выполнения до установки stop_event.
+
+    :param sql_shell: Объект типа WSQluse для работы с БД.
+    :param channel: Имя канала.
+    :param cache: Кэш с методом invalidate() (act_send_settings_cache,
+        polygon_directory).
+    :param reconnect_timeout: Пауза перед переподключением при обрыве.
+    :param stop_event: threading.Event, по которому прекратить слушать.
+    :return:
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    while not stop_event.is_set():
+        conn = None
+        try:
+            cursor, conn = sql_shell.get_cursor_conn()
+            conn.autocommit = True
+            cursor.execute("LISTEN {}".format(channel))
+            # Пока не слушали, могли пропустить изменения
+            cache.invalidate()
+            while not stop_event.is_set():
+                if not select.select([conn], [], [], 1)[0]:
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    cache.invalidate()
+        except psycopg2.Error:
+            print(traceback.format_exc())
+            stop_event.wait(reconnect_timeout)
+        finally:
+            if conn is not None:
+                conn.close()
 
 
 def get_all_external_systems(sql_shell,
@@ -0,0 +1,119 @@
+""" Модуль содержит управление жизненным циклом процесса WServer: ожидание
+сигнала на остановку, учет выполняющихся запросов и корректное завершение. """
+import signal
+import threading
+import traceback
+
+
+class Lifecycle:
+    """ Жизненный цикл процесса. Основной поток блокируется в run() (без
+    нагрузки на процессор) до вызова request_shutdown() или получения
+    SIGTERM/SIGINT, после чего по порядку выполняются зарегистрированные
+    шаги остановки (add_cleanup), и run() возвращает код выхода:
+    0 - если все шаги прошли успешно, 1 - если какой-то шаг провалился или
+    не уложился в отведенное время. """
+
+    def __init__(self, drain_timeout=30):
+        """
+        Инициализация.
+
+        :param drain_timeout: Сколько секунд ждать завершения выполняющихся
+            запросов при остановке.
+        """
+        self.drain_timeout = drain_timeout
+        self.shutdown_event = threading.Event()
+        self.in_flight = 0
+        self.in_flight_cond = threading.Condition()
+        self.cleanups = []
+        self.signum = None
+
+    def install_signal_handlers(self, signals=(signal.SIGTERM,
+                                               signal.SIGINT)):
+        """ Остановиться по сигналам signals. Вызывать из основного потока.
+        """
+        for signum in signals:
+            signal.signal(signum, self.request_shutdown)
+
+    def request_shutdown(self, signum=None, *args, **kwargs):
+        """ Запросить остановку (годится как обработчик сигнала). """
+        self.signum = signum
+        self.shutdown_event.set()
+
+    def is_shutting_down(self):
+        return self.shutdown_event.is_set()
+
+    def add_cleanup(self, func, name=None):
+        """
+        Добавить шаг остановки. Шаги выполняются в порядке добавления.
+
+        :param func: Функция без аргументов. Если она вернет False или
+            выбросит исключение, код выхода будет 1.
+        :param name: Имя шага для вывода.
+        """
+        self.cleanups.append((name or func.__name__, func))
+
+    def track(self, func):
+        """
+        Декоратор метода API: учитывает выполняющиеся запросы, чтобы при
+        остановке дождаться их, и отклоняет новые запросы после начала
+        остановки.
+
+        :param func: Метод API.
+        :return:
+        """
+
+        def wrapper(*args, **kwargs):
+            with self.in_flight_cond:
+                if self.is_shutting_down():
+                    return {'status': False,
+                            'info': 'WServer останавливается, повторите '
+                                    'запрос позже.'}
+                self.in_flight += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.in_flight_cond:
+                    self.in_flight -= 1
+                    self.in_flight_cond.notify_all()
+
+        return wrapper
+
+    def wait_drained(self, timeout=None):
+        """ Дождаться завершения выполняющихся запросов.
+
+        :return: True, если все запросы завершились за timeout. """
+        if timeout is None:
+            timeout = self.drain_timeout
+        with self.in_flight_cond:
+            return self.in_flight_cond.wait_for(lambda: self.in_flight == 0,
+                                                timeout)
+
+    def run(self):
+        """
+        Блокировать поток до запроса на остановку, затем выполнить шаги
+        остановки.
+
+        :return: Код выхода процесса.
+        """
+        self.shutdown_event.wait()
+        print('\n[WServer] Остановка (сигнал {})...'.format(self.signum))
+        return self.shutdown()
+
+    def shutdown(self):
+        """ Выполнить шаги остановки.
+
+        :return: Код выхода процесса. """
+        self.shutdown_event.set()
+        exit_code = 0
+        for name, func in self.cleanups:
+            try:
+                if func() is False:
+                    print('\t[WServer] Шаг остановки {} не завершен'.format(
+                        name))
+                    exit_code = 1
+            except Exception:
+                print('\t[WServer] Шаг остановки {} провалился:\n{}'.format(
+                    name, traceback.format_exc()))
+                exit_code = 1
+        print('[WServer] Остановлен. Код выхода: {}'.format(exit_code))
+        return exit_code
@@ -1,53 +1,204 @@
 """ Модуль содержит основной класс WServer """
+import socket
+import threading
+
 from qpi.main import QPI
+from wserver_compound import act_queue
+from wserver_compound import async_qpi
+from wserver_compound import functions
+from wserver_compound import lifecycle
 from wserver_compound import methods
-from wsqluse.wsqluse import Wsqluse
+from wserver_compound import photo_writer
+from wserver_compound import pool
+from wserver_compound import registry
+from wserver_compound import settings
+from wserver_compound import statements
+from wserver_compound import wta_outbox
+
+# Методы WServer, открытые для QPI
+api = registry.MethodRegistry()
 
 
-class WServer(Wsqluse):
+class WServer(pool.PooledWsqluse):
     """ Класс WServer. С помощью QPI принимает клиентов,
     выполняет их команды, взаимодействуя с базой данных (GDB, global data base)
     """
 
-    def __init__(self, port, *args, **kwargs):
+    def __init__(self, port, *args, listen_socket=None, **kwargs):
+        kwargs.setdefault('pool_min', settings.DB_POOL_MIN)
+        kwargs.setdefault('pool_max', settings.DB_POOL_MAX)
+        kwargs.setdefault('checkout_timeout',
+                          settings.DB_POOL_CHECKOUT_TIMEOUT)
+        kwargs.setdefault('check_interval', settings.DB_POOL_CHECK_INTERVAL)
         super(WServer, self).__init__(*args, **kwargs)
         """
         Инициация WServer
 
         :param port: порт, на котором он будет ожидать клиентов
-        :pself (wsqluse) для подключения к GDB
+        :param listen_socket: уже открытый слушающий сокет (в режиме prefork
+            его открывает супервизор и делит между процессами), иначе сокет
+            открывается на port
+        :pself (wsqluse) для подключения к GDB, каждый запрос клиента
+            получает соединение из пула (pool.PooledWsqluse)
         """
-        self.qpi = QPI('0.0.0.0', port, self,
-                       without_auth=True, auto_start=True,
-                       mark_disconnect=False, name='WServer QPI')
+        self.lifecycle = lifecycle.Lifecycle(settings.SHUTDOWN_DRAIN_TIMEOUT)
+        self.shared_listen_socket = listen_socket is not None
+        # Без уникального индекса records (polygon, ex_id) set_act вставляет
+        # акты без ON CONFLICT
+        index_check = functions.act_unique_index.check(
+            self, settings.ACT_CREATE_UNIQUE_INDEX)
+        if not index_check['status']:
+            print('[WServer] {}'.format(index_check['info']))
+        if settings.WSERVER_FRONTEND == 'asyncio':
+            self.qpi = async_qpi.AsyncQPI(
+                self, '0.0.0.0', port, sock=listen_socket,
+                max_workers=settings.ASYNC_QPI_MAX_WORKERS,
+                max_pending=settings.ASYNC_QPI_MAX_PENDING,
+                max_connections=settings.ASYNC_QPI_MAX_CONNECTIONS,
+                name='WServer AsyncQPI')
+            self.qpi.start()
+        else:
+            self.qpi = QPI('0.0.0.0', 0 if listen_socket else port, self,
+                           without_auth=True, auto_start=False,
+                           mark_disconnect=False, name='WServer QPI')
+            if listen_socket:
+                # QPI всегда открывает свой сокет - подменить его общим
+                self.qpi.server.close()
+                self.qpi.server = listen_socket
+                self.qpi.my_port = port
+            threading.Thread(target=self.serve, daemon=True).start()
+        self.listener_stop_event = threading.Event()
+        if settings.ACT_SEND_SETTINGS_CHANNEL:
+            threading.Thread(target=functions.listen_invalidations,
+                             args=(self, settings.ACT_SEND_SETTINGS_CHANNEL,
+                                   functions.act_send_settings_cache),
+                             kwargs={'stop_event': self.listener_stop_event},
+                             daemon=True).start()
+        if settings.POLYGON_DIRECTORY_CHANNEL:
+            threading.Thread(target=functions.listen_invalidations,
+                             args=(self, settings.POLYGON_DIRECTORY_CHANNEL,
+                                   functions.polygon_directory),
+                             kwargs={'stop_event': self.listener_stop_event},
+                             daemon=True).start()
+        self.act_post_processor = None
+        if settings.ACT_POST_PROCESSING_DEFERRED:
+            self.act_post_processor = act_queue.ActPostProcessor(
+                self, workers=settings.ACT_QUEUE_WORKERS,
+                batch_size=settings.ACT_QUEUE_BATCH_SIZE,
+                poll_interval=settings.ACT_QUEUE_POLL_INTERVAL,
+                retry_delay=settings.ACT_QUEUE_RETRY_DELAY)
+            self.act_post_processor.start()
+        self.photo_writer = None
+        if settings.PHOTO_WRITER_WORKERS:
+            self.photo_writer = photo_writer.PhotoWriterPool(
+                self, functions.photo_storage,
+                workers=settings.PHOTO_WRITER_WORKERS,
+                queue_size=settings.PHOTO_WRITER_QUEUE_SIZE,
+                queue_bytes=settings.PHOTO_WRITER_QUEUE_BYTES or None,
+                batch_size=settings.PHOTO_WRITER_BATCH_SIZE,
+                flush_interval=settings.PHOTO_WRITER_FLUSH_INTERVAL)
+            self.photo_writer.start()
+        self.outbox_dispatcher = None
+        if settings.WTA_OUTBOX:
+            self.outbox_dispatcher = wta_outbox.OutboxDispatcher(
+                self, workers=settings.WTA_OUTBOX_WORKERS,
+                batch_size=settings.WTA_OUTBOX_BATCH_SIZE,
+                poll_interval=settings.WTA_OUTBOX_POLL_INTERVAL,
+                retry_delay=settings.WTA_OUTBOX_RETRY_DELAY,
+                max_retry_delay=settings.WTA_OUTBOX_MAX_RETRY_DELAY,
+                max_attempts=settings.WTA_OUTBOX_MAX_ATTEMPTS,
+                lease=settings.WTA_OUTBOX_LEASE)
+            self.outbox_dispatcher.start()
+        self.lifecycle.add_cleanup(self.stop_listening)
+        self.lifecycle.add_cleanup(self.lifecycle.wait_drained)
+        self.lifecycle.add_cleanup(functions.photo_uploads.abort_all,
+                                   'abort_photo_uploads')
+        self.lifecycle.add_cleanup(self.flush_wta_coalescer)
+        self.lifecycle.add_cleanup(self.stop_background_workers)
+        self.lifecycle.add_cleanup(self.close_client_connections)
+        self.lifecycle.add_cleanup(functions.wta_client_pool.close_all,
+                                   'close_wta_clients')
+        self.lifecycle.add_cleanup(self.close_db)
+
+    def serve(self):
+        """ Принимать клиентов QPI, пока WServer не начнет остановку. """
+        try:
+            self.qpi.launch_mainloop()
+        except OSError:
+            if not self.lifecycle.is_shutting_down():
+                raise
 
     def start(self):
-        while True:
-            pass
+        """
+        Работать до получения SIGTERM/SIGINT (или вызова stop), после чего
+        корректно остановиться: перестать принимать клиентов, дождаться
+        выполняющихся запросов, остановить фоновые очереди, закрыть
+        соединения.
+
+        :return: Код выхода процесса.
+        """
+        if threading.current_thread() is threading.main_thread():
+            self.lifecycle.install_signal_handlers()
+        return self.lifecycle.run()
+
+    def stop(self):
+        """ Запросить остановку WServer. """
+        self.lifecycle.request_shutdown()
+
+    def stop_listening(self):
+        """ Перестать принимать новых клиентов. """
+        if isinstance(self.qpi, async_qpi.AsyncQPI):
+            return self.qpi.stop_listening()
+        # Общий сокет prefork (его делят супервизор и все обработчики)
+        # только закрывается в этом процессе: shutdown остановил бы прием
+        # клиентов во всех процессах
+        if not self.shared_listen_socket:
+            try:
+                self.qpi.server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.qpi.server.close()
+
+    def stop_background_workers(self):
+        """ Остановить фоновые обработчики. Возвращает False, если кто-то из
+        них не успел завершиться. """
+        self.listener_stop_event.set()
+        stopped = True
+        for workers in (self.act_post_processor, self.photo_writer,
+                        self.outbox_dispatcher):
+            if workers:
+                workers.stop(self.lifecycle.drain_timeout)
+                stopped = stopped and not workers.threads
+        return stopped
+
+    def flush_wta_coalescer(self):
+        """ Доставить склеиваемые изменения на полигоны. Возвращает False,
+        если доставки не завершились за drain_timeout. """
+        return functions.wta_coalescer.flush(self.lifecycle.drain_timeout)
+
+    def close_client_connections(self):
+        """ Закрыть соединения с клиентами QPI. """
+        if isinstance(self.qpi, async_qpi.AsyncQPI):
+            return self.qpi.close_connections()
+        for conn in list(self.qpi.connections_dict):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close_db(self):
+        """ Закрыть соединения с GDB. """
+        self.pool.closeall()
 
     def get_api_support_methods(self):
         """ Открыть методы для QPI. """
-        api_methods = {'set_act': {'method': self.set_act},
-                       'set_auto': {'method': self.set_auto},
-                       'update_auto': {'method': self.update_auto},
-                       'set_photos': {'method': self.set_photos},
-                       'set_notes': {'method': self.add_operator_notes},
-                       'set_company': {'method': self.set_company},
-                       'update_company': {'method': self.update_company},
-                       'get_auto_id': {'method': self.get_auto_id},
-                       'get_company_id': {'method': self.get_company_id},
-                       'set_operator': {'method': self.set_operator},
-                       'update_operator': {'method': self.update_operator},
-                       'set_trash_cat': {'method': self.set_trash_cat},
-                       'update_trash_cat': {'method': self.update_trash_cat},
-                       'set_trash_type': {'method': self.set_trash_type},
-                       'update_trash_type': {'method': self.update_trash_type},
-                       'get_rfid_id': {'method': self.get_rfid_id},
-                       'set_alerts': {'method': self.set_alerts},
-                       'check_legit': {'method': self.check_legit}
-                       }
+        api_methods = api.bind(self)
+        for description in api_methods.values():
+            description['method'] = self.lifecycle.track(
+                self.pooled(description['method']))
         return api_methods
 
+    @api.method()
     def set_act(self, auto_id, gross, tare, cargo,
                 time_in, time_out,
                 carrier_id, trash_cat_id, trash_type_id,
@@ -79,6 +230,25 @@ class WServer(Wsqluse):
                                    polygon_id, operator, ex_id)
         return response
 
+    @api.method()
+    def set_acts(self, acts: list, *args, **kwargs):
+        """
+        Добавить пачку актов на WServer за один вызов (например, при выгрузке
+        накопившихся на AR актов после обрыва связи).
+
+        :param acts: Список актов, каждый акт - словарь с ключами, как у
+            аргументов set_act.
+        :return:
+            {'status': True, 'info': [*ответ по каждому акту*]}, где ответ по
+            акту, в порядке следования acts:
+                В случае успеха:
+                    {'status': True, 'info': *id: int*)
+                В случае провала:
+                    {'status': False, 'info': Python Traceback}
+        """
+        return methods.set_acts(self, acts)
+
+    @api.method()
     def set_auto(self, car_number, polygon, id_type, rg_weight, model, rfid_id,
                  *args, **kwargs):
         """
@@ -101,6 +271,7 @@ class WServer(Wsqluse):
                                     id_type, rg_weight, model, rfid_id)
         return response
 
+    @api.method()
     def update_auto(self, auto_id: int, new_car_number=None,
                     new_id_type: str = None, new_rg_weight: int = 0,
                     new_model: int = 0, new_rfid_id: int = None, active=True,
@@ -109,10 +280,13 @@ class WServer(Wsqluse):
                                    new_id_type, new_rg_weight,
                                    new_model, new_rfid_id, active)
 
+    @api.method()
     def set_photos(self, record: int, photo_obj: str, photo_type: int,
                    *args, **kwargs):
         """
-        Сохранить фотографии на WServer.
+        Сохранить фотографии на WServer. При фоновой записи фото
+        (PHOTO_WRITER_WORKERS) в info сразу возвращается ID фото, а фото
+        пишется в фоне, состояние - get_photo_status.
 
         :param record: ID заезда
         :param photo_obj: Объект фото в кодировке base64, но в виде строки
@@ -123,9 +297,159 @@ class WServer(Wsqluse):
             В случае провала:
                 {'status': False, 'info': Python Traceback}
         """
+        if self.photo_writer:
+            return methods.queue_photos(self, self.photo_writer, record,
+                                        photo_obj, photo_type)
         return methods.set_photos(self, record, photo_obj,
                                   photo_type)
 
+    @api.method()
+    def set_photo_bytes(self, record: int, photo_data: bytes, photo_type: int,
+                        *args, **kwargs):
+        """
+        Сохранить фото, переданное в двоичном виде (bytes, без base64).
+
+        :param record: ID заезда
+        :param photo_data: Фото (bytes)
+        :param photo_type: Тип фотографии (gdb.photo_types)
+        :return:
+            В случае успеха:
+                {'status': True, 'info': *id: int*)
+            В случае провала:
+                {'status': False, 'info': Python Traceback}
+        """
+        if self.photo_writer:
+            return methods.queue_photo_bytes(self, self.photo_writer, record,
+                                             photo_data, photo_type)
+        return methods.set_photo_bytes(self, record, photo_data, photo_type)
+
+    @api.method()
+    def set_photos_batch(self, record: int, photos: list, *args, **kwargs):
+        """
+        Сохранить несколько фото одного заезда за один вызов.
+
+        :param record: ID заезда
+        :param photos: Список пар (фото, тип фото), фото - bytes или base64 в
+            виде строки (как в set_photos)
+        :return: {'status': True, 'info': [*ответ по каждому фото*]}
+        """
+        if self.photo_writer:
+            return methods.queue_photos_batch(self, self.photo_writer, record,
+                                              photos)
+        return methods.set_photos_batch(self, record, photos)
+
+    @api.method()
+    def open_photo_upload(self, record: int, photo_type: int, *args,
+                          **kwargs):
+        """
+        Начать загрузку большого фото частями.
+
+        :param record: ID заезда
+        :param photo_type: Тип фотографии (gdb.photo_types)
+        :return: {'status': True, 'info': *ID сеанса загрузки: str*}
+        """
+        return methods.open_photo_upload(self, record, photo_type)
+
+    @api.method()
+    def upload_photo_chunk(self, upload_id: str, chunk: bytes, offset: int,
+                           *args, **kwargs):
+        """
+        Передать очередную часть фото (bytes).
+
+        :param upload_id: ID сеанса загрузки
+        :param chunk: Часть фото
+        :param offset: Смещение части в фото (сколько байт передано до нее)
+        :return: {'status': True, 'info': *сколько байт получено: int*}
+        """
+        return methods.upload_photo_chunk(self, upload_id, chunk, offset)
+
+    @api.method()
+    def finish_photo_upload(self, upload_id: str, *args, **kwargs):
+        """
+        Завершить загрузку фото частями.
+
+        :param upload_id: ID сеанса загрузки
+        :return:
+            В случае успеха:
+                {'status': True, 'info': *id: int*)
+            В случае провала:
+                {'status': False, 'info': Python Traceback}
+        """
+        return methods.finish_photo_upload(self, upload_id)
+
+    @api.method()
+    def abort_photo_upload(self, upload_id: str, *args, **kwargs):
+        """ Отменить загрузку фото частями. """
+        return methods.abort_photo_upload(self, upload_id)
+
+    @api.method()
+    def get_act_photo(self, photo_id: int, *args, **kwargs):
+        """
+        Вернуть фото по ID из act_photos.
+
+        :param photo_id: ID фото
+        :return: {'status': True, 'info': *фото: bytes*}
+        """
+        return methods.get_act_photo(self, photo_id)
+
+    @api.method()
+    def get_photo(self, photo_id: int, offset: int = 0, length: int = None,
+                  *args, **kwargs):
+        """
+        Вернуть фото (или его часть) по ID из act_photos.
+
+        :param photo_id: ID фото
+        :param offset: Смещение от начала фото
+        :param length: Сколько байт вернуть
+        :return: {'status': True, 'info': {'photo_id': ..., 'record': ...,
+            'photo_type': ..., 'offset': ..., 'size': ..., 'data': ...}}
+        """
+        return methods.get_photo(self, photo_id, offset, length)
+
+    @api.method()
+    def get_record_photos(self, record: int, with_data: bool = True, *args,
+                          **kwargs):
+        """
+        Вернуть фото заезда.
+
+        :param record: ID заезда
+        :param with_data: Возвращать ли сами фото
+        :return: {'status': True, 'info': [{'photo_id': ..., 'photo_type': ...,
+            'size': ..., 'data': ...}, ...]}
+        """
+        return methods.get_record_photos(self, record, with_data)
+
+    @api.method()
+    def get_photo_cache_stats(self, *args, **kwargs):
+        """ Вернуть счетчики кэша фото. """
+        return {'status': True, 'info': functions.photo_cache.get_stats()}
+
+    @api.method()
+    def get_photo_status(self, photo_id: int, *args, **kwargs):
+        """
+        Вернуть состояние записи фото (при фоновой записи фото set_photos
+        возвращает ID фото сразу, до записи).
+
+        :param photo_id: ID фото
+        :return: {'status': True, 'info': {'state': ..., 'photo_path': ...,
+            'error': ...}}
+        """
+        return methods.get_photo_status(self, self.photo_writer, photo_id)
+
+    @api.method()
+    def get_photo_writer_stats(self, *args, **kwargs):
+        """ Вернуть метрики фоновой записи фото (глубина очереди, задержка
+        записи и т.д.). """
+        if not self.photo_writer:
+            return {'status': False, 'info': 'Фоновая запись фото выключена'}
+        return {'status': True, 'info': self.photo_writer.get_stats()}
+
+    @api.method()
+    def compact_photo_packs(self, *args, **kwargs):
+        """ Уплотнить пачки фото (PHOTO_STORE='pack'). """
+        return methods.compact_photo_packs(self)
+
+    @api.method('set_notes')
     def add_operator_notes(self, record, note, note_type, *args, **kwargs):
         """
         Добавить комментарии весовщика к заезду.
@@ -141,6 +465,7 @@ class WServer(Wsqluse):
         """
         return methods.add_operator_notes(self, record, note, note_type)
 
+    @api.method()
     def set_company(self, name, inn, kpp,
                     polygon, status, ex_id,
                     active, *args, **kwargs):
@@ -164,6 +489,7 @@ class WServer(Wsqluse):
                                    polygon, status, ex_id,
                                    active)
 
+    @api.method()
     def update_company(self, company_id, name: str = None, inn: str = None,
                        kpp: str = None, polygon: int = None,
                        status: bool = None,
@@ -171,6 +497,7 @@ class WServer(Wsqluse):
         return methods.update_company(self, company_id, name, inn, kpp,
                                       polygon, status, ex_id, active)
 
+    @api.method()
     def set_trash_cat(self, name, polygon, active=True, *args, **kwargs):
         """
           Добавить новую категорию груза.
@@ -186,6 +513,7 @@ class WServer(Wsqluse):
           """
         return methods.set_trash_cat(self, name, polygon, active)
 
+    @api.method()
     def update_trash_cat(self, cat_id, polygon=None, new_name=None,
                          active=True, *args, **kwargs):
         """
@@ -204,6 +532,7 @@ class WServer(Wsqluse):
         return methods.update_trash_cat(self, cat_id, polygon, new_name,
                                         active)
 
+    @api.method()
     def set_trash_type(self, name: str, polygon: int, category: int = None,
                        active: bool = True, *args, **kwargs):
         """
@@ -222,6 +551,7 @@ class WServer(Wsqluse):
         return methods.set_trash_type(self, name=name, polygon=polygon,
                                       trash_cat_id=category, active=active)
 
+    @api.method()
     def update_trash_type(self, type_id: int, polygon: int = None,
                           new_name: str = None, new_cat_id: int = None,
                           active: bool = True,
@@ -239,6 +569,7 @@ class WServer(Wsqluse):
         return methods.update_trash_type(self, type_id, polygon,
                                          new_name, new_cat_id, active)
 
+    @api.method()
     def set_operator(self, full_name: str, login: str, password: str,
                      polygon: int, active: bool = True, *args, **kwargs):
         """
@@ -258,6 +589,7 @@ class WServer(Wsqluse):
         return methods.set_operator(self, full_name, login, password,
                                     polygon, active)
 
+    @api.method()
     def update_operator(self, operator_id: int, full_name: str = None,
                         login: str = None, password: str = None,
                         polygon: int = None, active: bool = True,
@@ -277,6 +609,7 @@ class WServer(Wsqluse):
                                        login, password,
                                        polygon, active)
 
+    @api.method()
     def get_auto_id(self, car_number: str, *args, **kwargs):
         """ Вернуть ID авто по его гос.номеру.
 
@@ -284,6 +617,7 @@ class WServer(Wsqluse):
         :return: ID авто. """
         return methods.get_auto_id(self, car_number)
 
+    @api.method()
     def get_company_id(self, company_name: str, *args, **kwargs):
         """
         Вернуть ID компании по его названию.
@@ -295,6 +629,7 @@ class WServer(Wsqluse):
         """
         return methods.get_company_id(self, company_name)
 
+    @api.method()
     def get_rfid_id(self, rfid: str, *args, **kwargs):
         """
         Вернуть ID RFID метки по его коду. (10 символов)
@@ -305,6 +640,7 @@ class WServer(Wsqluse):
         """
         return methods.get_rfid_id(self, rfid=rfid)
 
+    @api.method()
     def set_alerts(self, wserver_id: int, alerts: str, **kwargs):
         """
         Принимает alert от AR.
@@ -315,6 +651,86 @@ class WServer(Wsqluse):
         return methods.set_alerts(sql_shell=self, wserver_id=wserver_id, alerts=alerts)
 
 
+    @api.method()
     def check_legit(self, mac_addr: str):
         """Проверяет легитимность мак адреса AR"""
-        return methods.check_legit(sql_shell=self, mac_addr=mac_addr)
\ No newline at end of file
+        return methods.check_legit(sql_shell=self, mac_addr=mac_addr)
+
+    @api.method()
+    def invalidate_act_send_settings(self, *args, **kwargs):
+        """ Сбросить кэш настроек отправки актов во внешние системы. """
+        return methods.invalidate_act_send_settings(self)
+
+    @api.method()
+    def get_act_send_settings_cache_stats(self, *args, **kwargs):
+        """ Вернуть счетчики кэша настроек отправки актов. """
+        return methods.get_act_send_settings_cache_stats(self)
+
+    @api.method()
+    def get_act_queue_stats(self, *args, **kwargs):
+        """ Вернуть состояние очереди отложенной обработки актов и счетчики
+        ее обработчиков. """
+        response = methods.get_act_queue_stats(self)
+        if response['status'] and self.act_post_processor:
+            response['info'].update(self.act_post_processor.get_stats())
+        return response
+
+    @api.method()
+    def get_db_pool_stats(self, *args, **kwargs):
+        """ Вернуть метрики пула соединений с GDB (время ожидания
+        соединения, загрузку и т.д.). """
+        return {'status': True, 'info': self.pool.get_stats()}
+
+    @api.method()
+    def get_statements_stats(self, *args, **kwargs):
+        """ Вернуть счетчики выполнений подготовленных команд. """
+        return {'status': True, 'info': statements.get_stats()}
+
+    @api.method()
+    def get_wta_outbox(self, polygon=None, limit=100, *args, **kwargs):
+        """ Вернуть состояние очереди доставки справочных данных на полигоны
+        и счетчики ее обработчиков. """
+        response = methods.get_wta_outbox(self, polygon, limit)
+        if response['status'] and self.outbox_dispatcher:
+            response['info'].update(self.outbox_dispatcher.get_stats())
+        return response
+
+    @api.method()
+    def replay_wta_outbox(self, polygon=None, outbox_id=None, *args,
+                          **kwargs):
+        """ Повторить доставку строк очереди wta_outbox сейчас. """
+        return methods.replay_wta_outbox(self, polygon, outbox_id)
+
+    @api.method()
+    def get_wta_clients_stats(self, *args, **kwargs):
+        """ Вернуть состояние соединений с полигонами. """
+        return {'status': True, 'info': functions.wta_client_pool.get_stats()}
+
+    @api.method()
+    def get_wta_coalescer_stats(self, *args, **kwargs):
+        """ Вернуть счетчики склейки изменений перед доставкой на полигоны
+        (сколько изменений поглощено более поздними - superseded). """
+        return {'status': True, 'info': functions.wta_coalescer.get_stats()}
+
+    @api.method()
+    def get_polygons_health(self, *args, **kwargs):
+        """ Вернуть состояние доставки на полигоны: замкнут ли автомат
+        (closed - доставки идут, open - приостановлены, half_open - идет
+        пробная доставка), число неудач подряд и последнюю ошибку. """
+        return {'status': True, 'info': functions.wta_client_pool.get_health()}
+
+    @api.method()
+    def invalidate_polygon_directory(self, *args, **kwargs):
+        """ Сбросить кэш списка полигонов. """
+        return methods.invalidate_polygon_directory(self)
+
+    @api.method()
+    def get_polygon_directory_stats(self, *args, **kwargs):
+        """ Вернуть счетчики кэша списка полигонов. """
+        return methods.get_polygon_directory_stats(self)
+
+    @api.method()
+    def get_methods_catalog(self, *args, **kwargs):
+        """ Вернуть описание методов API: аргументы, их типы,
+        обязательность и значения по умолчанию. """
+        return {'status': True, 'info': api.get_catalog()}
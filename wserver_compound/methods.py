@@ -3,9 +3,23 @@
  а в модуле functions, находятся небольшие функции, которые необходимы для
  выполнения функционала, изложенного здесь."""
 
+import time
+
+import psycopg2
 import wsqluse.wsqluse
 
+from wserver_compound import act_queue
 from wserver_compound import functions
+from wserver_compound import photo_store
+from wserver_compound import photo_writer
+from wserver_compound import settings
+from wserver_compound import statements
+from wserver_compound import wta_outbox
+
+# Поля акта в порядке колонок records, в которые они сохраняются
+ACT_FIELDS = ('auto_id', 'gross', 'tare', 'cargo', 'time_in', 'time_out',
+              'carrier_id', 'trash_cat_id', 'trash_type_id', 'polygon_id',
+              'operator', 'ex_id')
 
 
 @functions.send_data_to_core('auto', 'auto')
@@ -36,9 +50,10 @@ def set_auto(sql_shell, car_number: str, polygon: int, id_type: str,
     command = """INSERT INTO auto 
                 (car_number, id_type, rg_weight, auto_model, polygon, rfid_id) 
                 VALUES 
-                (%s, %s, %s, %s, %s, %s)"""
+                (%s, %s, %s, %s, %s, %s)
+                RETURNING id"""
     values = (car_number, id_type, rg_weight, model, polygon, rfid_id)
-    response = sql_shell.try_execute_double(command, values)
+    response = statements.try_execute(sql_shell, 'set_auto', command, values)
     return response
 
 
@@ -68,7 +83,9 @@ def set_act(sql_shell, auto_id: int, gross: int, tare: int, cargo: int,
             carrier_id: int, trash_cat_id: int, trash_type_id: int,
             polygon_id: int, operator: int, ex_id: int):
     """
-    Добавить новый акт на WServer.
+    Добавить новый акт на WServer. Повторная отправка акта с теми же
+    polygon_id и ex_id не создает новую запись, а возвращает ID уже
+    сохраненной.
 
     :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
     :param auto_id: ID автомобиля
@@ -89,18 +106,129 @@ def set_act(sql_shell, auto_id: int, gross: int, tare: int, cargo: int,
         В случае провала:
             {'status': 'failed', 'info': Python Traceback}
     """
-    command = """INSERT INTO records
-                (car, brutto, tara, cargo, time_in, time_out, carrier, 
-                trash_cat, trash_type, polygon, operator, ex_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s)"""
+    key = get_act_key(polygon_id, ex_id)
+    record_id = functions.recent_acts.get(key)
+    if record_id:
+        # AR повторил акт, не дождавшись ответа - вернуть уже выданный ID
+        return {'status': 'success', 'info': [(record_id,)]}
+    command = get_act_command("""(%s, %s, %s, %s, %s, %s, %s,
+                                  %s, %s, %s, %s, %s)""")
     values = (auto_id, gross, tare, cargo, time_in, time_out, carrier_id,
               trash_cat_id, trash_type_id, polygon_id, operator, ex_id)
-    response = sql_shell.try_execute_double(command, values)
-    fix_act_asc(sql_shell, polygon_id, response['info'][0][0])
+    response = statements.try_execute(sql_shell, 'set_act', command, values)
+    if response['status'] == 'success':
+        record_id, inserted = response['info'][0]
+        if key:
+            functions.recent_acts.put(key, record_id)
+        if inserted and not settings.ACT_POST_PROCESSING_DEFERRED:
+            fix_act_asc(sql_shell, polygon_id, record_id)
     return response
 
 
+def set_acts(sql_shell, acts: list):
+    """
+    Добавить пачку актов на WServer. Все акты вставляются в records одним
+    многострочным запросом в одной транзакции.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param acts: Список актов, каждый акт - словарь с ключами, как у аргументов
+        set_act (auto_id, gross, tare, cargo, time_in, time_out, carrier_id,
+        trash_cat_id, trash_type_id, polygon_id, operator, ex_id)
+    :return:
+        {'status': True, 'info': [*ответ по каждому акту*]}, где ответ по
+        акту, в порядке следования acts:
+            В случае успеха:
+                {'status': True, 'info': *id: int*)
+            В случае провала:
+                {'status': False, 'info': Python Traceback}
+    """
+    response = [None] * len(acts)
+    values_list = []
+    positions = []
+    # Позиция первого вхождения ключа акта в пачке, для повторов внутри пачки
+    batch_keys = {}
+    repeats = []
+    for position, act in enumerate(acts):
+        missing = [field for field in ACT_FIELDS if field not in act]
+        if missing:
+            response[position] = {'status': False,
+                                   'info': 'Не указаны поля акта: {}'.format(
+                                       ', '.join(missing))}
+            continue
+        key = get_act_key(act['polygon_id'], act['ex_id'])
+        record_id = functions.recent_acts.get(key)
+        if record_id:
+            response[position] = {'status': True, 'info': record_id}
+            continue
+        if key in batch_keys:
+            repeats.append((position, batch_keys[key]))
+            continue
+        if key:
+            batch_keys[key] = position
+        values_list.append(tuple(act[field] for field in ACT_FIELDS))
+        positions.append(position)
+    command = get_act_command("%s")
+    results = functions.try_execute_batch(sql_shell, command, values_list)
+    inserted = []
+    for position, result in zip(positions, results):
+        if result['status'] == 'success':
+            record_id, is_new = result['info'][0]
+            act = acts[position]
+            key = get_act_key(act['polygon_id'], act['ex_id'])
+            if key:
+                functions.recent_acts.put(key, record_id)
+            if is_new:
+                inserted.append((record_id, act['polygon_id']))
+            response[position] = {'status': True, 'info': record_id}
+        else:
+            response[position] = {'status': False, 'info': result['info']}
+    for position, original_position in repeats:
+        response[position] = response[original_position]
+    if not settings.ACT_POST_PROCESSING_DEFERRED:
+        fix_acts_asc(sql_shell, inserted)
+    return {'status': True, 'info': response}
+
+
+def get_act_key(polygon_id, ex_id):
+    """
+    Вернуть ключ идемпотентности акта - (полигон, ID акта в wdb), или None,
+    если ex_id не указан и акт нельзя отличить от повтора.
+
+    :param polygon_id: ID полигона.
+    :param ex_id: ID записи в wdb.
+    :return:
+    """
+    if ex_id is not None and polygon_id is not None:
+        return polygon_id, ex_id
+
+
+def get_act_command(values_mask):
+    """
+    Вернуть команду сохранения актов в records. Если в GDB есть уникальный
+    индекс records (polygon, ex_id) (functions.act_unique_index), акт с уже
+    существующей парой (polygon, ex_id) не вставляется повторно -
+    возвращается ID имеющегося. Команда возвращает строки (id, inserted),
+    где inserted - был ли акт вставлен этой командой. В режиме
+    ACT_POST_PROCESSING_DEFERRED новые акты той же командой ставятся в
+    очередь act_queue.
+
+    :param values_mask: Маска VALUES ("(%s, ...)" для одного акта или "%s"
+        для execute_values).
+    :return:
+    """
+    command = """INSERT INTO records
+                (car, brutto, tara, cargo, time_in, time_out, carrier, 
+                trash_cat, trash_type, polygon, operator, ex_id)
+                VALUES {}""".format(values_mask)
+    if functions.act_unique_index.present:
+        command += """
+                ON CONFLICT (polygon, ex_id)
+                DO UPDATE SET ex_id = EXCLUDED.ex_id"""
+    if settings.ACT_POST_PROCESSING_DEFERRED:
+        return act_queue.get_enqueue_command(command)
+    return command + " RETURNING id, (xmax = 0) AS inserted"
+
+
 @functions.format_wsqluse_response
 def set_photos(sql_shell, record: int, photo_obj: str, photo_type: int):
     """
@@ -116,15 +244,424 @@ def set_photos(sql_shell, record: int, photo_obj: str, photo_type: int):
         В случае провала:
             {'status': 'failed', 'info': Python Traceback}
     """
-    # Сгенерировать название фото
-    photo_name = functions.generate_photo_name(record)
     # Сохранить фото на винте
-    result = functions.save_photo(photo_obj, photo_name)
-    if result:
-        # Сохранить данные о фото в БД
-        response = functions.save_photo_database(sql_shell, record, photo_name,
-                                                 photo_type)
-        return response
+    try:
+        photo_path = functions.photo_storage.save_base64_repr(
+            record, photo_obj, settings.PHOTO_DECODE_CHUNK_SIZE)
+    except ValueError as error:
+        # Фото слишком большое или не в base64
+        return {'status': 'failed', 'info': str(error)}
+    # Сохранить данные о фото в БД
+    response = functions.save_photo_database(sql_shell, record, photo_path,
+                                             photo_type)
+    return response
+
+
+@functions.format_wsqluse_response
+def set_photo_bytes(sql_shell, record: int, photo_data: bytes,
+                    photo_type: int):
+    """
+    Сохранить фото, переданное в двоичном виде (bytes, без base64).
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param record: ID заезда
+    :param photo_data: Фото (bytes)
+    :param photo_type: Тип фотографии (gdb.photo_types)
+    :return:
+        В случае успеха:
+            {'status': 'success', 'info': *id: int*)
+        В случае провала:
+            {'status': 'failed', 'info': Python Traceback}
+    """
+    try:
+        photo_path = functions.photo_storage.save(record, photo_data)
+    except photo_store.PhotoTooLarge as error:
+        return {'status': 'failed', 'info': str(error)}
+    return functions.save_photo_database(sql_shell, record, photo_path,
+                                         photo_type)
+
+
+def set_photos_batch(sql_shell, record: int, photos: list):
+    """
+    Сохранить несколько фото одного заезда за один вызов: фото пишутся
+    параллельно, сбрасываются на диск и регистрируются в act_photos одним
+    многострочным запросом. Фото, которые не удалось зарегистрировать,
+    удаляются из хранилища (functions.discard_photos).
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param record: ID заезда
+    :param photos: Список пар (фото, тип фото), фото - bytes или base64 в
+        виде строки (как в set_photos)
+    :return:
+        {'status': True, 'info': [*ответ по каждому фото*]}, где ответ по
+        фото, в порядке следования photos:
+            В случае успеха:
+                {'status': True, 'info': *id: int*)
+            В случае провала:
+                {'status': False, 'info': *описание ошибки*}
+    """
+    response = [None] * len(photos)
+    futures = []
+    for position, photo in enumerate(photos):
+        try:
+            photo_obj, photo_type = photo
+        except (TypeError, ValueError):
+            response[position] = {'status': False,
+                                  'info': 'Ожидается пара (фото, тип фото)'}
+            continue
+        futures.append((position, photo_type, functions.photo_executor.submit(
+            functions.save_photo_to_store, record, photo_obj)))
+    values_list = []
+    positions = []
+    for position, photo_type, future in futures:
+        try:
+            photo_path = future.result()
+        except ValueError as error:
+            # Фото слишком большое или не в base64
+            response[position] = {'status': False, 'info': str(error)}
+            continue
+        except OSError as error:
+            # Не удалось записать фото (нет места, нет прав на папку)
+            response[position] = {'status': False, 'info': str(error)}
+            continue
+        values_list.append((record, photo_path, photo_type))
+        positions.append(position)
+    written_at = time.time()
+    try:
+        functions.photo_storage.sync([values[1] for values in values_list])
+        results = functions.try_execute_batch(
+            sql_shell, "INSERT INTO act_photos "
+                       "(record, photo_path, photo_type) "
+                       "VALUES %s RETURNING id", values_list)
+    except (OSError, psycopg2.Error) as error:
+        # Фото не сбросились на диск или GDB недоступна
+        results = [{'status': 'failed', 'info': str(error)}
+                   for _ in values_list]
+    failed = []
+    for position, values, result in zip(positions, values_list, results):
+        if result['status'] == 'success':
+            response[position] = {'status': True,
+                                  'info': result['info'][0][0]}
+        else:
+            response[position] = {'status': False, 'info': result['info']}
+            failed.append(values[1])
+    functions.discard_photos(sql_shell, failed, written_at)
+    return {'status': True, 'info': response}
+
+
+def queue_photos_batch(sql_shell, writer_pool, record: int, photos: list):
+    """
+    Поставить несколько фото одного заезда в очередь фоновой записи.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param writer_pool: photo_writer.PhotoWriterPool
+    :param record: ID заезда
+    :param photos: Список пар (фото, тип фото), как у set_photos_batch
+    :return: Как у set_photos_batch, id - зарезервированные ID фото.
+    """
+    response = []
+    for photo in photos:
+        try:
+            photo_obj, photo_type = photo
+        except (TypeError, ValueError):
+            response.append({'status': False,
+                             'info': 'Ожидается пара (фото, тип фото)'})
+            continue
+        if isinstance(photo_obj, bytes):
+            response.append(queue_photo_bytes(sql_shell, writer_pool, record,
+                                              photo_obj, photo_type))
+        else:
+            response.append(queue_photos(sql_shell, writer_pool, record,
+                                         photo_obj, photo_type))
+    return {'status': True, 'info': response}
+
+
+def queue_photos(sql_shell, writer_pool, record: int, photo_obj: str,
+                 photo_type: int):
+    """
+    Поставить фото в старом формате set_photos в очередь фоновой записи.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param writer_pool: photo_writer.PhotoWriterPool
+    :param record: ID заезда
+    :param photo_obj: Объект фото в кодировке base64, но в виде строки
+    :param photo_type: Тип фотографии (gdb.photo_types)
+    :return:
+        В случае успеха:
+            {'status': True, 'info': *зарезервированный id фото: int*}
+        В случае провала (очередь переполнена):
+            {'status': False, 'info': *описание ошибки*}
+    """
+    return submit_photo(writer_pool, record, photo_type,
+                        lambda writer: photo_store.write_base64_repr(
+                            writer, photo_obj,
+                            settings.PHOTO_DECODE_CHUNK_SIZE),
+                        len(photo_obj))
+
+
+def queue_photo_bytes(sql_shell, writer_pool, record: int, photo_data: bytes,
+                      photo_type: int):
+    """
+    Поставить фото в двоичном виде в очередь фоновой записи.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param writer_pool: photo_writer.PhotoWriterPool
+    :param record: ID заезда
+    :param photo_data: Фото (bytes)
+    :param photo_type: Тип фотографии (gdb.photo_types)
+    :return: Как у queue_photos.
+    """
+    if functions.photo_storage.max_size is not None and \
+            len(photo_data) > functions.photo_storage.max_size:
+        return {'status': False, 'info': 'Фото больше {} байт'.format(
+            functions.photo_storage.max_size)}
+    return submit_photo(writer_pool, record, photo_type,
+                        lambda writer: writer.write(photo_data),
+                        len(photo_data))
+
+
+def submit_photo(writer_pool, record, photo_type, fill, size):
+    try:
+        photo_id = writer_pool.submit(record, photo_type, fill, size)
+    except (photo_writer.QueueFull, psycopg2.Error) as error:
+        return {'status': False, 'info': str(error)}
+    return {'status': True, 'info': photo_id}
+
+
+def get_photo_status(sql_shell, writer_pool, photo_id: int):
+    """
+    Вернуть состояние записи фото.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param writer_pool: photo_writer.PhotoWriterPool или None
+    :param photo_id: ID фото
+    :return:
+        {'status': True, 'info': {'state': ..., 'photo_path': ...,
+                                  'error': ...}}, где state:
+            queued - фото ждет записи,
+            written - фото записано и сброшено на диск,
+            saved - фото зарегистрировано в act_photos,
+            failed - запись провалилась (error - причина).
+        Если фото не найдено: {'status': False, 'info': ...}
+    """
+    status = writer_pool.get_status(photo_id) if writer_pool else None
+    if status:
+        return {'status': True, 'info': status}
+    response = statements.try_execute(
+        sql_shell, 'get_act_photo',
+        "SELECT photo_path FROM act_photos WHERE id = %s", (photo_id,))
+    if response['status'] != 'success':
+        return {'status': False, 'info': response['info']}
+    if not response['info']:
+        return {'status': False,
+                'info': 'Фото {} не найдено'.format(photo_id)}
+    return {'status': True, 'info': {'state': photo_writer.SAVED,
+                                     'photo_path': response['info'][0][0],
+                                     'error': None}}
+
+
+def open_photo_upload(sql_shell, record: int, photo_type: int):
+    """
+    Начать загрузку фото частями. Части передаются в upload_photo_chunk,
+    затем загрузка завершается finish_photo_upload.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param record: ID заезда
+    :param photo_type: Тип фотографии (gdb.photo_types)
+    :return: {'status': True, 'info': *ID сеанса загрузки: str*}
+    """
+    upload_id = functions.photo_uploads.open(record, photo_type)
+    return {'status': True, 'info': upload_id}
+
+
+def upload_photo_chunk(sql_shell, upload_id: str, chunk: bytes, offset: int):
+    """
+    Передать очередную часть фото.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param upload_id: ID сеанса загрузки
+    :param chunk: Часть фото (bytes)
+    :param offset: Смещение части в фото (сколько байт передано до нее).
+        Часть принимается, только если оно равно числу уже полученных байт
+    :return:
+        В случае успеха:
+            {'status': True, 'info': *сколько байт фото получено: int*}
+        В случае провала (сеанс не найден, фото слишком большое, часть не
+        по порядку):
+            {'status': False, 'info': *описание ошибки*}
+    """
+    try:
+        size = functions.photo_uploads.write(upload_id, chunk, offset)
+    except (photo_store.UploadNotFound, photo_store.PhotoTooLarge,
+            photo_store.UploadOffsetMismatch) as error:
+        return {'status': False, 'info': str(error)}
+    return {'status': True, 'info': size}
+
+
+@functions.format_wsqluse_response
+def finish_photo_upload(sql_shell, upload_id: str):
+    """
+    Завершить загрузку фото частями и сохранить данные о фото в GDB.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param upload_id: ID сеанса загрузки
+    :return:
+        В случае успеха:
+            {'status': 'success', 'info': *id: int*)
+        В случае провала:
+            {'status': 'failed', 'info': Python Traceback}
+    """
+    try:
+        record, photo_path, photo_type = functions.photo_uploads.finish(
+            upload_id)
+    except photo_store.UploadNotFound as error:
+        return {'status': 'failed', 'info': str(error)}
+    return functions.save_photo_database(sql_shell, record, photo_path,
+                                         photo_type)
+
+
+def abort_photo_upload(sql_shell, upload_id: str):
+    """
+    Отменить загрузку фото частями.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param upload_id: ID сеанса загрузки
+    :return: {'status': True, 'info': None}
+    """
+    functions.photo_uploads.abort(upload_id)
+    return {'status': True, 'info': None}
+
+
+def get_act_photo(sql_shell, photo_id: int):
+    """
+    Вернуть фото по ID из act_photos, в каком бы хранилище оно ни лежало.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param photo_id: ID фото (act_photos.id)
+    :return:
+        В случае успеха:
+            {'status': True, 'info': *фото: bytes*}
+        В случае провала:
+            {'status': False, 'info': *описание ошибки*}
+    """
+    response = statements.try_execute(
+        sql_shell, 'get_act_photo',
+        "SELECT photo_path FROM act_photos WHERE id = %s", (photo_id,))
+    if response['status'] != 'success':
+        return {'status': False, 'info': response['info']}
+    if not response['info']:
+        return {'status': False,
+                'info': 'Фото {} не найдено'.format(photo_id)}
+    try:
+        data, _ = functions.read_photo(response['info'][0][0])
+    except OSError as error:
+        return {'status': False, 'info': str(error)}
+    return {'status': True, 'info': data}
+
+
+def get_photo(sql_shell, photo_id: int, offset: int = 0, length: int = None):
+    """
+    Вернуть фото (или его часть) по ID из act_photos. За один вызов
+    возвращается не больше settings.PHOTO_READ_MAX_CHUNK байт, большие фото
+    клиент читает частями, увеличивая offset, пока не дойдет до size.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param photo_id: ID фото (act_photos.id)
+    :param offset: Смещение от начала фото (не меньше 0)
+    :param length: Сколько байт вернуть (больше 0, по умолчанию - сколько
+        можно)
+    :return:
+        В случае успеха:
+            {'status': True, 'info': {'photo_id': ..., 'record': ...,
+                                      'photo_type': ..., 'offset': ...,
+                                      'size': *размер всего фото*,
+                                      'data': *часть фото: bytes*}}
+        В случае провала:
+            {'status': False, 'info': *описание ошибки*}
+    """
+    if offset is None:
+        offset = 0
+    if offset < 0:
+        return {'status': False,
+                'info': 'offset должен быть не меньше 0, получено {}'.format(
+                    offset)}
+    if length is not None and length <= 0:
+        return {'status': False,
+                'info': 'length должен быть больше 0, получено {}'.format(
+                    length)}
+    if length is None or length > settings.PHOTO_READ_MAX_CHUNK:
+        length = settings.PHOTO_READ_MAX_CHUNK
+    response = statements.try_execute(
+        sql_shell, 'get_photo',
+        "SELECT record, photo_path, photo_type FROM act_photos "
+        "WHERE id = %s", (photo_id,))
+    if response['status'] != 'success':
+        return {'status': False, 'info': response['info']}
+    if not response['info']:
+        return {'status': False,
+                'info': 'Фото {} не найдено'.format(photo_id)}
+    record, photo_path, photo_type = response['info'][0]
+    try:
+        data, size = functions.read_photo(photo_path, offset, length)
+    except OSError as error:
+        return {'status': False, 'info': str(error)}
+    return {'status': True, 'info': {'photo_id': photo_id, 'record': record,
+                                     'photo_type': photo_type,
+                                     'offset': offset, 'size': size,
+                                     'data': data}}
+
+
+def get_record_photos(sql_shell, record: int, with_data: bool = True):
+    """
+    Вернуть фото заезда.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :param record: ID заезда
+    :param with_data: Возвращать ли сами фото. Фото больше
+        settings.PHOTO_READ_MAX_CHUNK не возвращаются (data - None), их
+        нужно читать частями через get_photo.
+    :return:
+        {'status': True, 'info': [{'photo_id': ..., 'photo_type': ...,
+                                   'size': ..., 'data': ...}, ...]}
+    """
+    response = statements.try_execute(
+        sql_shell, 'get_record_photos',
+        "SELECT id, photo_path, photo_type FROM act_photos "
+        "WHERE record = %s ORDER BY id", (record,))
+    if response['status'] != 'success':
+        return {'status': False, 'info': response['info']}
+    photos = []
+    for photo_id, photo_path, photo_type in response['info']:
+        photo = {'photo_id': photo_id, 'photo_type': photo_type,
+                 'size': None, 'data': None}
+        try:
+            photo['size'] = functions.photo_storage.photo_size(photo_path)
+            if with_data and photo['size'] <= settings.PHOTO_READ_MAX_CHUNK:
+                photo['data'], _ = functions.read_photo(photo_path)
+        except OSError as error:
+            photo['error'] = str(error)
+        photos.append(photo)
+    return {'status': True, 'info': photos}
+
+
+def compact_photo_packs(sql_shell):
+    """
+    Уплотнить пачки фото (только для хранилища PHOTO_STORE='pack'): фото из
+    пачек, где мало живых данных, переписываются в новую пачку, старые
+    пачки удаляются.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB
+    :return: {'status': True, 'info': {'segments': ..., 'compacted': ...,
+        'photos_moved': ..., 'bytes_freed': ...}}
+    """
+    if not isinstance(functions.photo_storage, photo_store.PackPhotoStore):
+        return {'status': False,
+                'info': 'Хранилище фото {} не использует пачки'.format(
+                    settings.PHOTO_STORE)}
+    stats = functions.photo_storage.compact(
+        sql_shell, settings.PHOTO_PACK_MIN_LIVE_RATIO,
+        settings.PHOTO_PACK_COMPACT_MIN_AGE)
+    return {'status': True, 'info': stats}
 
 
 @functions.format_wsqluse_response
@@ -143,9 +680,11 @@ def add_operator_notes(sql_shell, record, note, note_type):
     """
     command = """INSERT INTO operator_notes
                 (record, note, type)
-                VALUES (%s, %s, %s)"""
+                VALUES (%s, %s, %s)
+                RETURNING id"""
     values = (record, note, note_type)
-    response = sql_shell.try_execute_double(command, values)
+    response = statements.try_execute(
+        sql_shell, 'add_operator_notes', command, values)
     return response
 
 
@@ -173,9 +712,10 @@ def set_company(sql_shell, name: str, inn: str, kpp: str,
     command = """INSERT INTO companies
                 (name, inn, kpp, ex_id, polygon, status, active)
                 VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """
+                RETURNING id"""
     values = (name, inn, kpp, ex_id, polygon, status, active)
-    response = sql_shell.try_execute_double(command, values)
+    response = statements.try_execute(
+        sql_shell, 'set_company', command, values)
     return response
 
 
@@ -219,9 +759,11 @@ def set_trash_cat(sql_shell, name, polygon, active=True):
     """
     command = """INSERT INTO trash_cats
                 (name, polygon, active)
-                VALUES (%s, %s, %s)"""
+                VALUES (%s, %s, %s)
+                RETURNING id"""
     values = (name, polygon, active)
-    response = sql_shell.try_execute_double(command, values)
+    response = statements.try_execute(
+        sql_shell, 'set_trash_cat', command, values)
     return response
 
 
@@ -267,9 +809,11 @@ def set_trash_type(sql_shell, name: str, polygon: int,
     """
     command = """INSERT INTO trash_types
                 (name, category, polygon, active)
-                VALUES (%s, %s, %s, %s)"""
+                VALUES (%s, %s, %s, %s)
+                RETURNING id"""
     values = (name, trash_cat_id, polygon, active)
-    response = sql_shell.try_execute_double(command, values)
+    response = statements.try_execute(
+        sql_shell, 'set_trash_type', command, values)
     return response
 
 
@@ -320,9 +864,11 @@ def set_operator(sql_shell, full_name: str, login: str, password: str,
     """
     command = """INSERT INTO operators 
                 (full_name, username, password, polygon, active)
-                VALUES (%s, %s, %s, %s, %s)"""
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id"""
     values = (full_name, login, password, polygon, active)
-    response = sql_shell.try_execute_double(command, values)
+    response = statements.try_execute(
+        sql_shell, 'set_operator', command, values)
     return response
 
 
@@ -402,9 +948,10 @@ def add_rfid(sql_shell, rfid_num: str, rfid_type: int, owner: int):
     :return:
     """
     command = """INSERT INTO rfid_marks (rfid, owner_id, rfid_type) 
-                VALUES (%s, %s, %s)"""
+                VALUES (%s, %s, %s)
+                RETURNING id"""
     values = (rfid_num, owner, rfid_type)
-    response = sql_shell.try_execute_double(command, values)
+    response = statements.try_execute(sql_shell, 'add_rfid', command, values)
     return response
 
 
@@ -455,17 +1002,126 @@ def get_record_info(sql_shell, record_id: int, table_name: str):
 def set_alerts(sql_shell, wserver_id: int, alerts: str):
     command = """INSERT INTO alerts
                 (record, alerts)
-                VALUES (%s, %s)"""
+                VALUES (%s, %s)
+                RETURNING id"""
     values = (wserver_id, alerts)
-    response = sql_shell.try_execute_double(command, values)
+    response = statements.try_execute(sql_shell, 'set_alerts', command, values)
     return response
 
 
 
 def fix_act_asc(sql_shell, polygon_id, record_id):
-    functions.set_all_external_systems_act_send_settings(sql_shell,
-                                                         polygon_id,
-                                                         record_id)
+    return fix_acts_asc(sql_shell, [(record_id, polygon_id)])
+
+
+def fix_acts_asc(sql_shell, records):
+    """
+    Зафиксировать для актов, нужно ли отправлять их во внешние системы.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :param records: Список пар (ID акта, ID полигона).
+    :return:
+    """
+    return functions.set_acts_send_settings(sql_shell, records)
+
+
+def invalidate_act_send_settings(sql_shell):
+    """
+    Сбросить кэш настроек отправки актов во внешние системы (вызывать после
+    изменения external_systems или external_systems_act_send_settings).
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :return: Счетчики кэша.
+    """
+    functions.act_send_settings_cache.invalidate()
+    return {'status': True,
+            'info': functions.act_send_settings_cache.get_stats()}
+
+
+def get_act_send_settings_cache_stats(sql_shell):
+    """
+    Вернуть счетчики попаданий и промахов кэша настроек отправки актов.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :return:
+    """
+    return {'status': True,
+            'info': functions.act_send_settings_cache.get_stats()}
+
+
+def invalidate_polygon_directory(sql_shell):
+    """
+    Сбросить кэш списка полигонов (вызывать после изменения duo_polygons).
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :return: Счетчики кэша.
+    """
+    functions.polygon_directory.invalidate()
+    return {'status': True,
+            'info': functions.polygon_directory.get_stats()}
+
+
+def get_polygon_directory_stats(sql_shell):
+    """
+    Вернуть счетчики попаданий и промахов кэша списка полигонов.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :return:
+    """
+    return {'status': True,
+            'info': functions.polygon_directory.get_stats()}
+
+
+def get_act_queue_stats(sql_shell):
+    """
+    Вернуть состояние очереди отложенной обработки актов.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :return:
+        {'status': True, 'info': {'size': ..., 'failed': ...,
+                                  'oldest_age': ...}}
+    """
+    response = act_queue.get_queue_stats(sql_shell)
+    return {'status': response['status'] == 'success',
+            'info': response['info']}
+
+
+def get_wta_outbox(sql_shell, polygon: int = None, limit: int = 100):
+    """
+    Вернуть состояние очереди доставки справочных данных на полигоны
+    (wta_outbox): размер по полигонам и самые старые строки.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :param polygon: Только строки этого полигона.
+    :param limit: Сколько строк вернуть.
+    :return:
+        {'status': True, 'info': {'size': ..., 'polygons': {...},
+                                  'entries': [...]}}
+    """
+    response = wta_outbox.get_outbox_stats(sql_shell)
+    if response['status'] != 'success':
+        return {'status': False, 'info': response['info']}
+    entries = wta_outbox.get_outbox_entries(sql_shell, polygon, limit)
+    if entries['status'] != 'success':
+        return {'status': False, 'info': entries['info']}
+    response['info']['entries'] = entries['info']
+    return {'status': True, 'info': response['info']}
+
+
+def replay_wta_outbox(sql_shell, polygon: int = None, outbox_id: int = None):
+    """
+    Повторить доставку строк wta_outbox сейчас, не дожидаясь следующей
+    попытки.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :param polygon: Только строки этого полигона.
+    :param outbox_id: Только эту строку.
+    :return: {'status': True, 'info': [ID строк]}
+    """
+    response = wta_outbox.replay_outbox(sql_shell, polygon, outbox_id)
+    return {'status': response['status'] == 'success',
+            'info': response['info']}
+
 
 @wsqluse.wsqluse.tryExecuteGetStripper
 def check_legit(sql_shell, mac_addr: str):
@@ -0,0 +1,391 @@
+""" Модуль содержит обработку старых фото (PhotoPipeline): перекодирование в
+сжатый формат, уменьшение и удаление фото по сроку хранения.
+
+Возраст фото считается по времени въезда заезда (records.time_in). Фото
+обходятся по возрастанию (time_in, act_photos.id), после каждой пачки
+позиция сохраняется в файл контрольной точки, так что прерванный проход
+продолжается с того же места, а следующий проход берет только фото,
+ставшие достаточно старыми с прошлого раза, и фото, пришедшие с прошлого
+раза с опозданием (time_in позади контрольной точки). Скорость обработки
+ограничивается, чтобы не мешать приему фото.
+
+Для перекодирования и уменьшения нужен Pillow (pip install Pillow), без
+него выполняется только удаление по сроку хранения.
+
+Запуск (доступ к GDB - как у launcher.py, через GDBNAME, GDBUSER, GDBPASS,
+GDBHOST):
+    python -m wserver_compound.photo_pipeline [--once]
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import threading
+import time
+import traceback
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from wserver_compound import functions
+from wserver_compound import photo_store
+from wserver_compound import pool
+from wserver_compound import settings
+
+# Расширения файлов фото по формату
+FORMAT_SUFFIXES = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+# Фото старше заданного числа дней (условия обхода дописываются)
+SELECT_PHOTOS = "SELECT ap.id, ap.photo_path, ap.record, r.time_in " \
+                "FROM act_photos ap JOIN records r ON r.id = ap.record " \
+                "WHERE r.time_in < now() - %s * interval '1 day' "
+
+
+class PhotoPipeline:
+    """ Обработка старых фото. Этапы (каждый включается своим сроком):
+    delete - удалить фото старше retention_days,
+    downscale - уменьшить фото старше downscale_after_days до max_side
+        точек по большей стороне (и перекодировать),
+    transcode - перекодировать фото старше transcode_after_days в
+        image_format с качеством quality. """
+
+    def __init__(self, sql_shell, store, checkpoint_path,
+                 transcode_after_days=None, image_format='WEBP', quality=80,
+                 downscale_after_days=None, max_side=1280,
+                 retention_days=None, batch_size=100, max_photos_per_sec=5,
+                 blob_min_age=3600, stop_event=None):
+        """
+        Инициализация.
+
+        :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+        :param store: Хранилище фото (photo_store).
+        :param checkpoint_path: Файл контрольной точки.
+        :param transcode_after_days: Возраст (дней) для перекодирования.
+        :param image_format: Формат Pillow (WEBP, JPEG).
+        :param quality: Качество сжатия.
+        :param downscale_after_days: Возраст (дней) для уменьшения.
+        :param max_side: Размер большей стороны уменьшенного фото.
+        :param retention_days: Возраст (дней) для удаления.
+        :param batch_size: Сколько фото забирать из GDB за раз.
+        :param max_photos_per_sec: Ограничение скорости (0 - без
+            ограничения).
+        :param blob_min_age: Не удалять файлы фото, сохраненные или
+            переиспользованные последние blob_min_age секунд (фото с таким
+            же содержимым может как раз сохраняться в ShardedPhotoStore).
+        :param stop_event: threading.Event для остановки.
+        """
+        self.sql_shell = sql_shell
+        self.store = store
+        self.checkpoint_path = checkpoint_path
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.max_side = max_side
+        self.batch_size = batch_size
+        self.max_photos_per_sec = max_photos_per_sec
+        self.blob_min_age = blob_min_age
+        self.stop_event = stop_event or threading.Event()
+        self.stages = []
+        if retention_days is not None:
+            self.stages.append(('delete', retention_days))
+        if Image is None and (transcode_after_days is not None or
+                              downscale_after_days is not None):
+            print('[PhotoPipeline] Pillow не установлен, перекодирование и '
+                  'уменьшение фото выключены')
+        elif Image is not None:
+            if downscale_after_days is not None:
+                self.stages.append(('downscale', downscale_after_days))
+            if transcode_after_days is not None:
+                self.stages.append(('transcode', transcode_after_days))
+        self.checkpoint = self.load_checkpoint()
+        self.stats = {'processed': 0, 'deleted': 0, 'downscaled': 0,
+                      'transcoded': 0, 'skipped': 0, 'failed': 0,
+                      'bytes_before': 0, 'bytes_after': 0}
+        self.started = None
+        self.done = 0
+
+    def load_checkpoint(self):
+        """ Загрузить контрольную точку {этап: {'position': [time_in, id],
+        'max_id': ..., 'high': ...}} (см. get_stage_checkpoint). """
+        try:
+            with open(self.checkpoint_path) as fobj:
+                return json.load(fobj)
+        except FileNotFoundError:
+            return {}
+
+    def save_checkpoint(self):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as fobj:
+            json.dump(self.checkpoint, fobj)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def get_stage_checkpoint(self, stage):
+        """ Вернуть контрольную точку этапа:
+        position - (time_in, id) последнего обработанного фото,
+        max_id - наибольший act_photos.id на начало предыдущего прохода:
+            фото с большим id могли прийти с опозданием (акты с полигонов,
+            бывших без связи) с time_in позади position, их забирает
+            догоняющий обход (fetch_batch с catch_up),
+        high - наибольший act_photos.id на начало текущего прохода (пока
+            проход не завершен). """
+        checkpoint = self.checkpoint.get(stage)
+        if checkpoint is None:
+            checkpoint = {'position': [datetime.datetime.min.isoformat(), 0],
+                          'max_id': 0}
+        elif isinstance(checkpoint, list):
+            # Контрольная точка без max_id: опоздавшие до нее фото не найти
+            checkpoint = {'position': checkpoint, 'max_id': None}
+        self.checkpoint[stage] = checkpoint
+        return checkpoint
+
+    def run_once(self):
+        """ Пройти все этапы до текущего момента: сначала догнать фото,
+        пришедшие с прошлого прохода позади контрольной точки, затем
+        продолжить с контрольной точки.
+
+        :return: Счетчики. """
+        self.started = time.monotonic()
+        self.done = 0
+        for stage, after_days in self.stages:
+            checkpoint = self.get_stage_checkpoint(stage)
+            if checkpoint.get('high') is None:
+                with functions.connection_scope(self.sql_shell):
+                    checkpoint['high'] = self.get_max_photo_id()
+            phases = (True, False) if checkpoint['max_id'] is not None \
+                else (False,)
+            for catch_up in phases:
+                self.run_phase(stage, after_days, catch_up)
+            if self.stop_event.is_set():
+                break
+            checkpoint['max_id'] = checkpoint.pop('high')
+            self.save_checkpoint()
+        return self.stats
+
+    def run_phase(self, stage, after_days, catch_up):
+        """ Обработать все фото этапа stage по контрольной точке (или
+        опоздавшие, если catch_up). """
+        checkpoint = self.checkpoint[stage]
+        while not self.stop_event.is_set():
+            with functions.connection_scope(self.sql_shell):
+                rows = self.fetch_batch(stage, after_days, catch_up)
+                for row in rows:
+                    if self.stop_event.is_set():
+                        break
+                    self.process(stage, row)
+                    if catch_up:
+                        checkpoint['max_id'] = row[0]
+                    else:
+                        checkpoint['position'] = [row[3].isoformat(),
+                                                  row[0]]
+                    self.throttle()
+            self.save_checkpoint()
+            if len(rows) < self.batch_size:
+                break
+
+    def run_forever(self, interval=3600):
+        """ Повторять проходы каждые interval секунд до остановки. """
+        while not self.stop_event.is_set():
+            try:
+                print('[PhotoPipeline] {}'.format(self.run_once()))
+            except Exception:
+                print(traceback.format_exc())
+            self.stop_event.wait(interval)
+
+    def get_max_photo_id(self):
+        cursor, conn = self.sql_shell.get_cursor_conn()
+        try:
+            cursor.execute("SELECT coalesce(max(id), 0) FROM act_photos")
+            max_id = cursor.fetchone()[0]
+            conn.rollback()
+        finally:
+            conn.close()
+        return max_id
+
+    def fetch_batch(self, stage, after_days, catch_up=False):
+        """ Забрать следующую пачку фото этапа stage, старше after_days
+        дней, после контрольной точки. Если catch_up - пачку опоздавших
+        фото: добавленных после max_id (до high), но с time_in не позже
+        контрольной точки, по возрастанию id.
+
+        :return: [(id, photo_path, record, time_in)] """
+        checkpoint = self.checkpoint[stage]
+        time_in, photo_id = checkpoint['position']
+        if catch_up:
+            command = SELECT_PHOTOS + \
+                "AND ap.id > %s AND ap.id <= %s " \
+                "AND (r.time_in, ap.id) <= (%s::timestamp, %s) " \
+                "ORDER BY ap.id LIMIT %s"
+            values = (after_days, checkpoint['max_id'], checkpoint['high'],
+                      time_in, photo_id, self.batch_size)
+        else:
+            command = SELECT_PHOTOS + \
+                "AND (r.time_in, ap.id) > (%s::timestamp, %s) " \
+                "ORDER BY r.time_in, ap.id LIMIT %s"
+            values = (after_days, time_in, photo_id, self.batch_size)
+        cursor, conn = self.sql_shell.get_cursor_conn()
+        try:
+            cursor.execute(command, values)
+            rows = cursor.fetchall()
+            conn.rollback()
+        finally:
+            conn.close()
+        return rows
+
+    def process(self, stage, row):
+        photo_id, photo_path, record, _ = row
+        self.stats['processed'] += 1
+        try:
+            if stage == 'delete':
+                self.delete_photo(photo_id, photo_path)
+                self.stats['deleted'] += 1
+            elif self.reencode_photo(photo_id, photo_path, record,
+                                     resize=stage == 'downscale'):
+                self.stats['downscaled' if stage == 'downscale'
+                           else 'transcoded'] += 1
+            else:
+                self.stats['skipped'] += 1
+        except Exception:
+            self.stats['failed'] += 1
+            print('[PhotoPipeline] Фото {} ({}) не обработано:\n{}'.format(
+                photo_id, stage, traceback.format_exc()))
+
+    def delete_photo(self, photo_id, photo_path):
+        """ Удалить фото из act_photos и, если на файл больше никто не
+        ссылается, из хранилища. """
+        self.update_photo("DELETE FROM act_photos WHERE id = %s",
+                          (photo_id,))
+        self.remove_unreferenced(photo_path)
+
+    def reencode_photo(self, photo_id, photo_path, record, resize=False):
+        """ Перекодировать (и уменьшить) фото и перевести на него запись
+        act_photos.
+
+        :return: True, если фото заменено. """
+        try:
+            data, _ = self.store.read_range(photo_path)
+        except FileNotFoundError:
+            return False
+        new_data = self.reencode(data, resize)
+        if new_data is None:
+            return False
+        new_path = self.store.save(
+            record, new_data, FORMAT_SUFFIXES.get(self.image_format, '.img'))
+        # Старое фото удаляется, только когда новое уже на диске и запись
+        # переведена на него
+        self.store.sync([new_path])
+        try:
+            updated = self.update_photo(
+                "UPDATE act_photos SET photo_path = %s "
+                "WHERE id = %s AND photo_path = %s",
+                (new_path, photo_id, photo_path))
+        except Exception:
+            self.remove_unreferenced(new_path, min_age=0)
+            raise
+        if not updated:
+            # Фото за это время заменили или удалили
+            self.remove_unreferenced(new_path, min_age=0)
+            return False
+        self.remove_unreferenced(photo_path)
+        self.stats['bytes_before'] += len(data)
+        self.stats['bytes_after'] += len(new_data)
+        return True
+
+    def reencode(self, data, resize=False):
+        """ Перекодировать фото.
+
+        :return: Новое фото или None, если перекодирование ничего не дает
+            (фото уже в нужном формате и размере или не стало бы меньше).
+        """
+        image = Image.open(io.BytesIO(data))
+        resized = False
+        if resize and max(image.size) > self.max_side:
+            image.thumbnail((self.max_side, self.max_side))
+            resized = True
+        if not resized and image.format == self.image_format:
+            return None
+        if self.image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, self.image_format, quality=self.quality)
+        new_data = output.getvalue()
+        if len(new_data) >= len(data):
+            return None
+        return new_data
+
+    def update_photo(self, command, values):
+        """ Выполнить команду над act_photos.
+
+        :return: Сколько строк она затронула. """
+        cursor, conn = self.sql_shell.get_cursor_conn()
+        try:
+            cursor.execute(command, values)
+            conn.commit()
+            return cursor.rowcount
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def remove_unreferenced(self, photo_path, min_age=None):
+        """ Удалить файл фото, если на него больше не ссылается act_photos
+        (одно фото в ShardedPhotoStore может принадлежать нескольким
+        записям) и его недавно не переиспользовали (min_age, по умолчанию
+        blob_min_age). Место фото в пачках освобождает compact_photo_packs.
+        """
+        if photo_path.startswith(photo_store.PACK_PREFIX):
+            return
+        cursor, conn = self.sql_shell.get_cursor_conn()
+        try:
+            cursor.execute("SELECT 1 FROM act_photos WHERE photo_path = %s "
+                           "LIMIT 1", (photo_path,))
+            referenced = cursor.fetchall()
+            conn.rollback()
+        finally:
+            conn.close()
+        if not referenced:
+            self.store.remove(photo_path, self.blob_min_age
+                              if min_age is None else min_age)
+
+    def throttle(self):
+        """ Выдержать ограничение скорости обработки. """
+        self.done += 1
+        if not self.max_photos_per_sec:
+            return
+        wait = self.done / self.max_photos_per_sec - (time.monotonic() -
+                                                      self.started)
+        if wait > 0:
+            self.stop_event.wait(wait)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Перекодирование, уменьшение и удаление старых фото')
+    parser.add_argument('--once', action='store_true',
+                        help='Один проход вместо постоянной работы')
+    args = parser.parse_args()
+    sql_shell = pool.PooledWsqluse(
+        dbname=os.environ.get('GDBNAME'), user=os.environ.get('GDBUSER'),
+        password=os.environ.get('GDBPASS'), host=os.environ.get('GDBHOST'),
+        pool_min=1, pool_max=1)
+    pipeline = PhotoPipeline(
+        sql_shell, functions.photo_storage,
+        settings.PHOTO_PIPELINE_CHECKPOINT,
+        transcode_after_days=settings.PHOTO_TRANSCODE_AFTER_DAYS,
+        image_format=settings.PHOTO_PIPELINE_FORMAT,
+        quality=settings.PHOTO_PIPELINE_QUALITY,
+        downscale_after_days=settings.PHOTO_DOWNSCALE_AFTER_DAYS,
+        max_side=settings.PHOTO_DOWNSCALE_MAX_SIDE,
+        retention_days=settings.PHOTO_RETENTION_DAYS,
+        batch_size=settings.PHOTO_PIPELINE_BATCH_SIZE,
+        max_photos_per_sec=settings.PHOTO_PIPELINE_MAX_PHOTOS_PER_SEC,
+        blob_min_age=settings.PHOTO_PIPELINE_BLOB_MIN_AGE)
+    if args.once:
+        print(pipeline.run_once())
+    else:
+        pipeline.run_forever(settings.PHOTO_PIPELINE_INTERVAL)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,761 @@
+""" Модуль содержит хранилища фотографий WServer (FlatPhotoStore - все фото
+в одной папке, ShardedPhotoStore - по содержимому во вложенных папках,
+PackPhotoStore - подряд в больших файлах-пачках) и прием фотографий в
+двоичном виде.
+
+Фото записывается потоком через PhotoWriter: данные пишутся во временный
+файл по мере поступления, а на commit() файл атомарно переименовывается в
+итоговый путь, который и сохраняется в act_photos.photo_path. Большие фото
+AR может передавать частями (сеанс загрузки PhotoUploads), каждая часть -
+bytes в команде QPI, без base64. """
+import abc
+import binascii
+import collections
+import fcntl
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+# Ссылки на фото в пачках (act_photos.photo_path) начинаются с PACK_PREFIX,
+# сами пачки лежат в PACKS_DIR внутри папки хранилища
+PACK_PREFIX = 'pack:'
+PACKS_DIR = 'packs'
+
+
+class PhotoTooLarge(ValueError):
+    """ Фото превышает допустимый размер. """
+    pass
+
+
+class UploadNotFound(LookupError):
+    """ Сеанс загрузки фото не найден (завершен, отменен или истек). """
+    pass
+
+
+class UploadOffsetMismatch(ValueError):
+    """ Часть фото пришла не по порядку: ее смещение не равно числу уже
+    полученных байт. """
+    pass
+
+
+class PhotoWriter:
+    """ Запись одного фото в хранилище. Данные пишутся во временный файл,
+    который становится фото только после commit(). """
+
+    def __init__(self, path, max_size=None, tmp_path=None):
+        """
+        Инициализация.
+
+        :param path: Итоговый путь фото.
+        :param max_size: Максимальный размер фото в байтах (None - без
+            ограничения).
+        :param tmp_path: Путь временного файла (по умолчанию рядом с path).
+        """
+        self.path = path
+        self.tmp_path = tmp_path or '{}.{}.part'.format(path,
+                                                        uuid.uuid4().hex)
+        self.max_size = max_size
+        self.size = 0
+        self.fobj = open(self.tmp_path, 'wb')
+
+    def write(self, data):
+        """ Дописать часть фото. """
+        if self.max_size is not None and self.size + len(data) > \
+                self.max_size:
+            self.abort()
+            raise PhotoTooLarge('Фото больше {} байт'.format(self.max_size))
+        self.fobj.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        """ Завершить запись.
+
+        :return: Путь сохраненного фото. """
+        self.fobj.close()
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        """ Отменить запись и удалить временный файл. """
+        if not self.fobj.closed:
+            self.fobj.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def write_base64_repr(writer, photo_obj, chunk_size=65536):
+    """
+    Декодировать фото, переданное старыми AR в виде строки "b'...'" (str()
+    от bytes в кодировке base64), и записать его в writer. Строка
+    обрабатывается частями по chunk_size символов, так что помимо самой
+    строки в памяти держится не больше одной части.
+
+    :param writer: PhotoWriter.
+    :param photo_obj: Строка с фото.
+    :param chunk_size: Размер части (символов).
+    :return:
+    """
+    start, end = 0, len(photo_obj)
+    if photo_obj[:2] in ("b'", 'b"') and photo_obj[-1:] == photo_obj[1]:
+        start, end = 2, end - 1
+    tail = ''
+    for position in range(start, end, chunk_size):
+        chunk = tail + photo_obj[position:min(position + chunk_size, end)]
+        # Экранированный перенос строки (base64.encodebytes) может
+        # разорваться между частями
+        escape = ''
+        if chunk.endswith('\\'):
+            chunk, escape = chunk[:-1], '\\'
+        chunk = chunk.replace('\\n', '').replace('\\r', '')
+        usable = len(chunk) - len(chunk) % 4
+        writer.write(binascii.a2b_base64(chunk[:usable]))
+        tail = chunk[usable:] + escape
+    if tail:
+        writer.write(binascii.a2b_base64(tail))
+
+
+class HashingPhotoWriter(PhotoWriter):
+    """ Запись фото в хранилище по содержимому: итоговый путь известен только
+    после commit(), когда посчитан sha256 фото. Если такое фото уже есть,
+    временный файл удаляется, и возвращается путь существующего. """
+
+    def __init__(self, store, max_size=None, suffix='.png'):
+        """
+        Инициализация.
+
+        :param store: ShardedPhotoStore.
+        :param max_size: Максимальный размер фото в байтах.
+        :param suffix: Расширение файла фото.
+        """
+        super().__init__(None, max_size, tmp_path=os.path.join(
+            store.tmp_dir, uuid.uuid4().hex + '.part'))
+        self.store = store
+        self.suffix = suffix
+        self.hash = hashlib.sha256()
+        self.deduplicated = False
+
+    def write(self, data):
+        super().write(data)
+        self.hash.update(data)
+
+    def commit(self):
+        self.fobj.close()
+        self.path = self.store.get_blob_path(self.hash.hexdigest(),
+                                             self.suffix)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            # Обновить mtime существующего фото: недавно переиспользованные
+            # файлы не удаляются (ShardedPhotoStore.remove)
+            os.utime(self.path)
+        except FileNotFoundError:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+            self.deduplicated = True
+        self.store.count_write(self)
+        return self.path
+
+
+def fsync_path(path):
+    """ Сбросить на диск файл или папку path. """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PhotoStore(abc.ABC):
+    """ Базовое хранилище фото. Наследники реализуют open_writer. """
+
+    max_size = None
+    # Может ли один файл фото принадлежать нескольким строкам act_photos
+    shared_files = False
+
+    @abc.abstractmethod
+    def open_writer(self, record, suffix='.png'):
+        """ Начать запись фото к заезду record.
+
+        :param suffix: Расширение файла фото (если хранилище хранит фото в
+            отдельных файлах).
+        :return: PhotoWriter. """
+
+    def write_with(self, record, fill, suffix='.png'):
+        """ Записать фото к заезду record функцией fill(writer).
+
+        :return: Путь (photo_path) сохраненного фото. """
+        writer = self.open_writer(record, suffix)
+        try:
+            fill(writer)
+        except Exception:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def save(self, record, photo_data, suffix='.png'):
+        """
+        Сохранить фото целиком.
+
+        :param record: ID заезда.
+        :param photo_data: Фото (bytes).
+        :param suffix: Расширение файла фото.
+        :return: Путь сохраненного фото.
+        """
+        return self.write_with(record, lambda writer: writer.write(
+            photo_data), suffix)
+
+    def save_base64_repr(self, record, photo_obj, chunk_size=65536):
+        """
+        Сохранить фото в старом формате set_photos (см. write_base64_repr).
+
+        :param record: ID заезда.
+        :param photo_obj: Строка с фото.
+        :param chunk_size: Сколько символов декодировать за один шаг.
+        :return: Путь сохраненного фото.
+        """
+        return self.write_with(record, lambda writer: write_base64_repr(
+            writer, photo_obj, chunk_size))
+
+    def remove(self, photo_path, min_age=0):
+        """ Удалить файл фото (на который больше не ссылается act_photos).
+
+        :param min_age: Не удалять файл, изменявшийся последние min_age
+            секунд (см. ShardedPhotoStore.remove).
+        :return: True, если файл удален. """
+        try:
+            os.remove(photo_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def sync(self, photo_paths):
+        """ Сбросить на диск (fsync) сохраненные фото photo_paths и папки, в
+        которых они лежат (каждую папку - один раз). """
+        dirs = set()
+        for photo_path in photo_paths:
+            fsync_path(photo_path)
+            dirs.add(os.path.dirname(photo_path))
+        for photo_dir in dirs:
+            fsync_path(photo_dir)
+
+    def open_photo(self, photo_path):
+        """ Открыть фото по act_photos.photo_path на чтение. Пути хранилищ на
+        файлах (в том числе старые записи плоской папки) - обычные пути,
+        фото из пачек (PackPhotoStore) - ссылки вида
+        pack:<пачка>:<смещение>:<длина>. """
+        if photo_path.startswith(PACK_PREFIX):
+            segment, offset, length = parse_pack_locator(photo_path)
+            with open(os.path.join(self.photos_dir, PACKS_DIR, segment),
+                      'rb') as fobj:
+                fobj.seek(offset)
+                return io.BytesIO(fobj.read(length))
+        return open(photo_path, 'rb')
+
+    def locate(self, photo_path):
+        """ Найти фото на диске.
+
+        :return: (путь файла, смещение фото в файле, размер фото) """
+        if photo_path.startswith(PACK_PREFIX):
+            segment, offset, length = parse_pack_locator(photo_path)
+            return os.path.join(self.photos_dir, PACKS_DIR, segment), \
+                offset, length
+        return photo_path, 0, os.path.getsize(photo_path)
+
+    def photo_size(self, photo_path):
+        return self.locate(photo_path)[2]
+
+    def read_range(self, photo_path, offset=0, length=None):
+        """
+        Прочитать часть фото через mmap: в память процесса копируется только
+        запрошенный диапазон, а не весь файл (или вся пачка).
+
+        :param photo_path: act_photos.photo_path.
+        :param offset: Смещение от начала фото.
+        :param length: Сколько байт прочитать (None - до конца фото).
+        :return: (данные, размер всего фото)
+        """
+        path, base, size = self.locate(photo_path)
+        offset = min(max(offset, 0), size)
+        end = size if length is None else min(size, offset + length)
+        if end <= offset:
+            return b'', size
+        with open(path, 'rb') as fobj, \
+                mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped[base + offset:base + end], size
+
+
+class PhotoCache:
+    """ Кэш недавно прочитанных фото, ограниченный суммарным размером. Фото
+    больше max_photo_size не кэшируются. Ключ - act_photos.photo_path: по
+    одному пути всегда лежит одно и то же фото (новое фото получает новый
+    путь). """
+
+    def __init__(self, max_bytes, max_photo_size):
+        """
+        Инициализация.
+
+        :param max_bytes: Максимальный суммарный размер фото в кэше.
+        :param max_photo_size: Максимальный размер кэшируемого фото.
+        """
+        self.max_bytes = max_bytes
+        self.max_photo_size = min(max_photo_size, max_bytes)
+        self.photos = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, photo_path):
+        with self.lock:
+            data = self.photos.get(photo_path)
+            if data is None:
+                self.misses += 1
+                return None
+            self.photos.move_to_end(photo_path)
+            self.hits += 1
+            return data
+
+    def put(self, photo_path, data):
+        if len(data) > self.max_photo_size:
+            return
+        with self.lock:
+            if photo_path in self.photos:
+                return
+            self.photos[photo_path] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.photos.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get_stats(self):
+        with self.lock:
+            return {'photos': len(self.photos), 'bytes': self.size,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses}
+
+
+class FlatPhotoStore(PhotoStore):
+    """ Хранилище фото в одной папке, файлы называются
+    <ID заезда>___<uuid4>.png. """
+
+    def __init__(self, photos_dir, max_size=None):
+        """
+        Инициализация.
+
+        :param photos_dir: Папка для фото.
+        :param max_size: Максимальный размер фото в байтах.
+        """
+        self.photos_dir = photos_dir
+        self.max_size = max_size
+        os.makedirs(photos_dir, exist_ok=True)
+
+    def get_photo_path(self, record, suffix='.png'):
+        photo_name = '___'.join((str(record), str(uuid.uuid4())))
+        return os.path.join(self.photos_dir, photo_name + suffix)
+
+    def open_writer(self, record, suffix='.png'):
+        return PhotoWriter(self.get_photo_path(record, suffix),
+                           self.max_size)
+
+
+class ShardedPhotoStore(PhotoStore):
+    """ Хранилище фото по содержимому: файл называется sha256 фото и лежит
+    во вложенных папках по первым символам хэша
+    (<photos_dir>/ab/cd/abcd....png), так что в одной папке не копятся
+    миллионы файлов. Одинаковые фото (например, повторно отправленные AR)
+    хранятся один раз, и act_photos.photo_path всех записей указывает на
+    один файл. """
+
+    shared_files = True
+
+    def __init__(self, photos_dir, max_size=None, depth=2, width=2):
+        """
+        Инициализация.
+
+        :param photos_dir: Корневая папка хранилища.
+        :param max_size: Максимальный размер фото в байтах.
+        :param depth: Уровней вложенных папок.
+        :param width: Символов хэша в названии папки каждого уровня.
+        """
+        self.photos_dir = photos_dir
+        self.max_size = max_size
+        self.depth = depth
+        self.width = width
+        self.tmp_dir = os.path.join(photos_dir, '.tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.deduplicated = 0
+
+    def get_blob_path(self, digest, suffix='.png'):
+        shards = [digest[level * self.width:(level + 1) * self.width]
+                  for level in range(self.depth)]
+        return os.path.join(self.photos_dir, *shards, digest + suffix)
+
+    def open_writer(self, record, suffix='.png'):
+        return HashingPhotoWriter(self, self.max_size, suffix)
+
+    def remove(self, photo_path, min_age=0):
+        """ Удалить файл фото, если его не переиспользовали последние
+        min_age секунд. Сохранение такого же фото может переиспользовать
+        файл (HashingPhotoWriter.commit обновляет его mtime) уже после
+        того, как вызывающий убедился, что на файл нет ссылок в act_photos.
+        Поэтому файл сначала переименовывается, и mtime проверяется еще
+        раз: если файл успели переиспользовать, он возвращается на место,
+        а сохранение, пришедшее после переименования, не найдет файл и
+        запишет фото заново.
+
+        :return: True, если файл удален. """
+        removed_path = '{}.{}.removed'.format(photo_path, uuid.uuid4().hex)
+        try:
+            if time.time() - os.path.getmtime(photo_path) < min_age:
+                return False
+            os.rename(photo_path, removed_path)
+        except FileNotFoundError:
+            return False
+        if time.time() - os.path.getmtime(removed_path) < min_age:
+            os.replace(removed_path, photo_path)
+            return False
+        os.remove(removed_path)
+        return True
+
+    def count_write(self, writer):
+        with self.lock:
+            self.writes += 1
+            if writer.deduplicated:
+                self.deduplicated += 1
+
+    def get_stats(self):
+        return {'writes': self.writes, 'deduplicated': self.deduplicated}
+
+
+def parse_pack_locator(photo_path):
+    """ Разобрать ссылку на фото в пачке.
+
+    :return: (название пачки, смещение, длина) """
+    _, segment, offset, length = photo_path.split(':')
+    return segment, int(offset), int(length)
+
+
+class PackPhotoWriter(PhotoWriter):
+    """ Запись фото в пачку. Фото накапливается в памяти (или во временном
+    файле, если оно больше spool_size), а на commit() одним куском
+    дописывается в конец текущей пачки. """
+
+    def __init__(self, store, max_size=None):
+        self.store = store
+        self.path = None
+        self.max_size = max_size
+        self.size = 0
+        self.fobj = tempfile.SpooledTemporaryFile(store.spool_size,
+                                                  dir=store.packs_dir)
+
+    def commit(self):
+        self.fobj.seek(0)
+        try:
+            self.path = self.store.append(self.fobj, self.size)
+        finally:
+            self.fobj.close()
+        return self.path
+
+    def abort(self):
+        self.fobj.close()
+
+
+class PackPhotoStore(PhotoStore):
+    """ Хранилище фото в пачках: фото дописываются подряд в большие файлы
+    <photos_dir>/packs/<uuid4>.pack, а в act_photos.photo_path сохраняется
+    ссылка pack:<пачка>:<смещение>:<длина>, так что act_photos служит
+    индексом пачек. Вместо миллионов маленьких файлов - последовательная
+    запись в несколько больших.
+
+    Каждый процесс (в том числе обработчики prefork) пишет в свою пачку и
+    держит на ней flock, пока не начнет новую (пачка больше segment_size).
+    Пачки без блокировки закрыты для записи, их можно уплотнять (compact).
+    """
+
+    def __init__(self, photos_dir, max_size=None,
+                 segment_size=256 * 1024 * 1024, spool_size=1024 * 1024):
+        """
+        Инициализация.
+
+        :param photos_dir: Корневая папка хранилища.
+        :param max_size: Максимальный размер фото в байтах.
+        :param segment_size: После какого размера начинать новую пачку.
+        :param spool_size: Фото до этого размера перед записью в пачку
+            держатся в памяти, больше - во временном файле.
+        """
+        self.photos_dir = photos_dir
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.spool_size = spool_size
+        self.packs_dir = os.path.join(photos_dir, PACKS_DIR)
+        os.makedirs(self.packs_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_name = None
+        self.segment_end = 0
+
+    def open_writer(self, record, suffix='.png'):
+        return PackPhotoWriter(self, self.max_size)
+
+    def rotate(self):
+        """ Закрыть текущую пачку и начать новую. """
+        if self.segment:
+            os.fsync(self.segment.fileno())
+            self.segment.close()
+        self.segment_name = uuid.uuid4().hex + '.pack'
+        self.segment = open(os.path.join(self.packs_dir, self.segment_name),
+                            'xb')
+        fcntl.flock(self.segment, fcntl.LOCK_EX)
+        self.segment_end = 0
+
+    def append(self, fobj, length):
+        """
+        Дописать фото из fobj в текущую пачку.
+
+        :param fobj: Файловый объект, из которого читается фото.
+        :param length: Длина фото.
+        :return: Ссылка на фото в пачке.
+        """
+        with self.lock:
+            if self.segment is None or self.segment_end >= self.segment_size:
+                self.rotate()
+            offset = self.segment_end
+            shutil.copyfileobj(fobj, self.segment)
+            self.segment.flush()
+            self.segment_end += length
+            return '{}{}:{}:{}'.format(PACK_PREFIX, self.segment_name,
+                                       offset, length)
+
+    def sync(self, photo_paths):
+        """ Сбросить на диск текущую пачку (предыдущие сбрасываются при
+        переходе к новой пачке) - один fsync на любое количество фото. """
+        with self.lock:
+            if self.segment:
+                os.fsync(self.segment.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.segment:
+                self.segment.close()
+                self.segment = None
+
+    def compact(self, sql_shell, min_live_ratio=0.5, min_age=3600):
+        """
+        Уплотнить пачки: фото, на которые еще ссылается act_photos, из пачек,
+        где живых данных меньше min_live_ratio, переписываются в текущую
+        пачку, ссылки в act_photos обновляются, а старые пачки удаляются.
+        Пачки, в которые кто-то пишет, не трогаются. Не трогаются и пачки,
+        изменявшиеся последние min_age секунд: фото в них может быть уже
+        дописано, а строка act_photos для него еще не вставлена (например,
+        ждет записи пачкой в PhotoWriterPool) - такое фото выглядело бы
+        мертвым и пропало бы.
+
+        :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+        :param min_live_ratio: Доля живых данных, ниже которой пачка
+            уплотняется.
+        :param min_age: Сколько секунд после последней записи в пачку ее
+            нельзя уплотнять.
+        :return: {'segments': ..., 'compacted': ..., 'photos_moved': ...,
+            'bytes_freed': ...}
+        """
+        stats = {'segments': 0, 'compacted': 0, 'photos_moved': 0,
+                 'bytes_freed': 0}
+        for segment in sorted(os.listdir(self.packs_dir)):
+            if not segment.endswith('.pack') or segment == self.segment_name:
+                continue
+            stats['segments'] += 1
+            segment_path = os.path.join(self.packs_dir, segment)
+            try:
+                if time.time() - os.path.getmtime(segment_path) < min_age:
+                    continue
+            except FileNotFoundError:
+                continue
+            with open(segment_path, 'rb') as fobj:
+                try:
+                    fcntl.flock(fobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # В пачку пишут или ее уже уплотняет другой процесс
+                    continue
+                if not os.path.exists(segment_path):
+                    continue
+                moved = self.compact_segment(sql_shell, segment, fobj,
+                                             min_live_ratio)
+                if moved is None:
+                    continue
+                stats['compacted'] += 1
+                stats['photos_moved'] += moved[0]
+                stats['bytes_freed'] += moved[1]
+                os.remove(segment_path)
+        return stats
+
+    def compact_segment(self, sql_shell, segment, fobj, min_live_ratio):
+        """ Уплотнить одну пачку (см. compact).
+
+        :return: (сколько фото переписано, сколько байт освобождено) или
+            None, если уплотнять пачку не нужно. """
+        cursor, conn = sql_shell.get_cursor_conn()
+        try:
+            cursor.execute("SELECT id, photo_path FROM act_photos "
+                           "WHERE photo_path LIKE %s",
+                           ('{}{}:%'.format(PACK_PREFIX, segment),))
+            rows = cursor.fetchall()
+            segment_size = os.fstat(fobj.fileno()).st_size
+            live_size = sum(parse_pack_locator(photo_path)[2]
+                            for _, photo_path in rows)
+            if segment_size and live_size >= segment_size * min_live_ratio:
+                conn.rollback()
+                return None
+            new_paths = []
+            for photo_id, photo_path in rows:
+                _, offset, length = parse_pack_locator(photo_path)
+                fobj.seek(offset)
+                new_path = self.append(io.BytesIO(fobj.read(length)), length)
+                new_paths.append(new_path)
+                cursor.execute("UPDATE act_photos SET photo_path = %s "
+                               "WHERE id = %s AND photo_path = %s",
+                               (new_path, photo_id, photo_path))
+            # Ссылки переводятся на копии (а старая пачка удаляется), только
+            # когда копии уже на диске
+            self.sync(new_paths)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return len(rows), segment_size - live_size
+
+
+def get_photo_store(kind, photos_dir, max_size=None, **kwargs):
+    """
+    Создать хранилище фото.
+
+    :param kind: 'flat' - FlatPhotoStore, 'sharded' - ShardedPhotoStore,
+        'pack' - PackPhotoStore.
+    :param photos_dir: Папка хранилища.
+    :param max_size: Максимальный размер фото в байтах.
+    :param kwargs: Параметры PackPhotoStore.
+    :return:
+    """
+    if kind == 'flat':
+        return FlatPhotoStore(photos_dir, max_size)
+    if kind == 'sharded':
+        return ShardedPhotoStore(photos_dir, max_size)
+    if kind == 'pack':
+        return PackPhotoStore(photos_dir, max_size, **kwargs)
+    raise ValueError('Неизвестное хранилище фото: {}'.format(kind))
+
+
+class PhotoUploads:
+    """ Сеансы загрузки фото частями. Сеанс живет в памяти процесса (клиент
+    QPI обслуживается одним процессом, в том числе в режиме prefork), и
+    если части не приходят дольше ttl секунд, сеанс отменяется.
+
+    Команды клиента выполняются параллельно (QPI - поток на команду,
+    AsyncQPI - пул потоков), поэтому у каждой части есть смещение, а
+    части одного сеанса пишутся под его блокировкой: часть, пришедшая не
+    по порядку, отклоняется (UploadOffsetMismatch), а не портит фото. """
+
+    def __init__(self, store, ttl=300):
+        """
+        Инициализация.
+
+        :param store: Хранилище фото.
+        :param ttl: Сколько секунд ждать очередную часть фото.
+        """
+        self.store = store
+        self.ttl = ttl
+        # Сеансы: {upload_id: {'writer', 'record', 'photo_type', 'touched',
+        # 'lock'}}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def open(self, record, photo_type):
+        """ Открыть сеанс загрузки фото к заезду record.
+
+        :return: ID сеанса. """
+        self.expire()
+        upload_id = uuid.uuid4().hex
+        writer = self.store.open_writer(record)
+        with self.lock:
+            self.uploads[upload_id] = {'writer': writer, 'record': record,
+                                       'photo_type': photo_type,
+                                       'touched': time.monotonic(),
+                                       'lock': threading.Lock()}
+        return upload_id
+
+    def get(self, upload_id):
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            raise UploadNotFound('Сеанс загрузки фото {} не найден'.format(
+                upload_id))
+        return upload
+
+    def write(self, upload_id, chunk, offset):
+        """ Дописать часть фото в сеансе upload_id.
+
+        :param offset: Смещение части в фото (сколько байт передано до
+            нее).
+        :return: Сколько байт фото уже получено. """
+        upload = self.get(upload_id)
+        with upload['lock']:
+            if self.uploads.get(upload_id) is not upload:
+                # Сеанс завершили или отменили, пока часть ждала блокировки
+                raise UploadNotFound('Сеанс загрузки фото {} не '
+                                     'найден'.format(upload_id))
+            writer = upload['writer']
+            if offset != writer.size:
+                raise UploadOffsetMismatch(
+                    'Часть фото со смещением {} не принята: получено {} '
+                    'байт'.format(offset, writer.size))
+            upload['touched'] = time.monotonic()
+            try:
+                writer.write(chunk)
+            except PhotoTooLarge:
+                self.pop(upload_id)
+                raise
+            return writer.size
+
+    def finish(self, upload_id):
+        """ Завершить сеанс и сохранить фото.
+
+        :return: (ID заезда, путь сохраненного фото, тип фото) """
+        upload = self.pop(upload_id)
+        if upload is None:
+            raise UploadNotFound('Сеанс загрузки фото {} не найден'.format(
+                upload_id))
+        with upload['lock']:
+            return upload['record'], upload['writer'].commit(), \
+                upload['photo_type']
+
+    def pop(self, upload_id):
+        with self.lock:
+            return self.uploads.pop(upload_id, None)
+
+    def abort(self, upload_id):
+        """ Отменить сеанс, полученные части удаляются. """
+        upload = self.pop(upload_id)
+        if upload:
+            with upload['lock']:
+                upload['writer'].abort()
+
+    def expire(self):
+        """ Отменить сеансы, части в которые не приходили дольше ttl. """
+        now = time.monotonic()
+        with self.lock:
+            expired = [upload_id for upload_id, upload in self.uploads.items()
+                       if now - upload['touched'] > self.ttl]
+        for upload_id in expired:
+            self.abort(upload_id)
+
+    def abort_all(self):
+        for upload_id in list(self.uploads):
+            self.abort(upload_id)
@@ -0,0 +1,245 @@
+""" Модуль содержит фоновую запись фото (PhotoWriterPool).
+
+Вместо того чтобы декодировать и писать фото и вставлять строку act_photos
+в потоке запроса, set_photos (при PHOTO_WRITER_WORKERS > 0) только
+резервирует ID фото в act_photos и ставит фото в очередь, ограниченную
+числом фото и их общим объемом.
+Обработчики забирают фото пачками: пишут их в хранилище, одним заходом
+сбрасывают на диск (fsync) и регистрируют всю пачку одним многострочным
+INSERT. Клиент сразу получает ID фото, а состояние записи можно узнать по
+нему через get_photo_status. """
+import queue
+import threading
+import time
+import traceback
+
+import psycopg2
+
+from wserver_compound import functions
+from wserver_compound import statements
+
+# Состояния записи фото
+QUEUED = 'queued'
+WRITTEN = 'written'
+SAVED = 'saved'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    """ Очередь записи фото переполнена. """
+    pass
+
+
+class PhotoWriterPool:
+    """ Пул фоновых обработчиков записи фото. """
+
+    def __init__(self, sql_shell, store, workers=2, queue_size=1000,
+                 batch_size=20, flush_interval=0.05, tickets_size=10000,
+                 queue_bytes=None):
+        """
+        Инициализация.
+
+        :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+        :param store: Хранилище фото (photo_store).
+        :param workers: Количество потоков-обработчиков.
+        :param queue_size: Сколько фото может ждать записи, сверх этого
+            числа новые фото отклоняются.
+        :param batch_size: Максимум фото в одной пачке.
+        :param flush_interval: Сколько секунд собирать пачку после первого
+            фото.
+        :param tickets_size: Сколько последних фото помнить для
+            get_photo_status.
+        :param queue_bytes: Сколько байт фото может ждать записи, сверх
+            этого объема новые фото отклоняются (None - без ограничения).
+        """
+        self.sql_shell = sql_shell
+        self.store = store
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.queue_bytes = queue_bytes
+        # Объем фото в очереди и в обрабатываемых пачках
+        self.queued_bytes = 0
+        self.tickets = functions.LRUCache(tickets_size)
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.counters_lock = threading.Lock()
+        self.submitted = 0
+        self.saved = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.latency_total = 0
+        self.latency_max = 0
+        self.sync_time_total = 0
+
+    def start(self):
+        """ Запустить обработчиков. """
+        self.stop_event.clear()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.mainloop, daemon=True,
+                                      name='PhotoWriter-{}'.format(number))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """ Остановить обработчиков, дописав фото, оставшиеся в очереди. """
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = [thread for thread in self.threads
+                        if thread.is_alive()]
+
+    def submit(self, record, photo_type, fill, size=0):
+        """
+        Поставить фото в очередь на запись.
+
+        :param record: ID заезда.
+        :param photo_type: Тип фото.
+        :param fill: Функция fill(writer), пишущая фото в PhotoWriter.
+        :param size: Объем данных фото, которые держит fill (байт).
+        :return: Зарезервированный ID фото в act_photos.
+        """
+        with self.counters_lock:
+            # Одно фото принимается в пустую очередь, даже если оно больше
+            # queue_bytes
+            if self.queue_bytes is not None and self.queued_bytes and \
+                    self.queued_bytes + size > self.queue_bytes:
+                self.rejected += 1
+                raise QueueFull('Очередь записи фото переполнена, повторите '
+                                'запрос позже.')
+            self.queued_bytes += size
+        try:
+            return self.enqueue(record, photo_type, fill, size)
+        except BaseException:
+            with self.counters_lock:
+                self.queued_bytes -= size
+            raise
+
+    def enqueue(self, record, photo_type, fill, size):
+        response = statements.try_execute(
+            self.sql_shell, 'next_act_photo_id',
+            "SELECT nextval(pg_get_serial_sequence('act_photos', 'id'))")
+        if response['status'] != 'success':
+            raise psycopg2.OperationalError(response['info'])
+        photo_id = response['info'][0][0]
+        job = {'photo_id': photo_id, 'record': record,
+               'photo_type': photo_type, 'fill': fill, 'size': size,
+               'submitted': time.monotonic()}
+        self.tickets.put(photo_id, {'state': QUEUED, 'photo_path': None,
+                                    'error': None})
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.tickets.pop(photo_id)
+            with self.counters_lock:
+                self.rejected += 1
+            raise QueueFull('Очередь записи фото переполнена, повторите '
+                            'запрос позже.')
+        with self.counters_lock:
+            self.submitted += 1
+        return photo_id
+
+    def get_status(self, photo_id):
+        """ Вернуть состояние записи фото photo_id или None, если о нем ничего
+        не известно (давно записано или не ставилось в очередь). """
+        return self.tickets.get(photo_id)
+
+    def mainloop(self):
+        while True:
+            try:
+                job = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    return
+                continue
+            batch = [job]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.queue.get(timeout=max(remaining, 0)))
+                except queue.Empty:
+                    break
+            try:
+                with functions.connection_scope(self.sql_shell):
+                    self.process_batch(batch)
+            except Exception:
+                error = traceback.format_exc()
+                print(error)
+                for job in batch:
+                    status = self.get_status(job['photo_id']) or {}
+                    if status.get('state') != SAVED:
+                        self.fail(job, error)
+            finally:
+                with self.counters_lock:
+                    self.queued_bytes -= sum(job['size'] for job in batch)
+
+    def process_batch(self, batch):
+        """ Записать пачку фото, сбросить их на диск и зарегистрировать в
+        act_photos одним запросом. """
+        written = []
+        for job in batch:
+            try:
+                job['photo_path'] = self.store.write_with(job['record'],
+                                                          job['fill'])
+                written.append(job)
+            except Exception as error:
+                self.fail(job, str(error))
+            # Данные фото больше не нужны
+            job['fill'] = None
+        if not written:
+            return
+        started = time.monotonic()
+        self.store.sync([job['photo_path'] for job in written])
+        with self.counters_lock:
+            self.sync_time_total += time.monotonic() - started
+        for job in written:
+            self.set_state(job, WRITTEN)
+        values_list = [(job['photo_id'], job['record'], job['photo_path'],
+                        job['photo_type']) for job in written]
+        results = functions.try_execute_batch(
+            self.sql_shell, "INSERT INTO act_photos "
+                            "(id, record, photo_path, photo_type) "
+                            "VALUES %s RETURNING id", values_list)
+        now = time.monotonic()
+        for job, result in zip(written, results):
+            if result['status'] != 'success':
+                self.fail(job, result['info'])
+                continue
+            self.set_state(job, SAVED)
+            latency = now - job['submitted']
+            with self.counters_lock:
+                self.saved += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+        with self.counters_lock:
+            self.batches += 1
+
+    def set_state(self, job, state, error=None):
+        self.tickets.put(job['photo_id'], {'state': state,
+                                           'photo_path': job.get('photo_path'),
+                                           'error': error})
+
+    def fail(self, job, error):
+        self.set_state(job, FAILED, error)
+        with self.counters_lock:
+            self.failed += 1
+
+    def get_stats(self):
+        """ Вернуть метрики: глубину очереди, счетчики и задержку записи
+        (от постановки в очередь до регистрации в act_photos). """
+        with self.counters_lock:
+            return {'queue_depth': self.queue.qsize(),
+                    'queue_size': self.queue.maxsize,
+                    'queued_bytes': self.queued_bytes,
+                    'queue_bytes': self.queue_bytes,
+                    'submitted': self.submitted, 'saved': self.saved,
+                    'failed': self.failed, 'rejected': self.rejected,
+                    'batches': self.batches,
+                    'latency_avg': self.latency_total / (self.saved or 1),
+                    'latency_max': self.latency_max,
+                    'sync_time_avg': self.sync_time_total / (self.batches
+                                                             or 1),
+                    'workers': len(self.threads)}
@@ -0,0 +1,304 @@
+""" Модуль содержит пул соединений с GDB.
+
+Wsqluse открывает новое соединение на каждую команду и никогда его не
+закрывает. PooledWsqluse вместо этого на время запроса (request_scope)
+выдает одно соединение из потокобезопасного пула ConnectionPool, и все
+команды запроса, в том числе выполняемые функциями methods.* через
+sql_shell, идут через него. Вне request_scope PooledWsqluse ведет себя как
+обычный Wsqluse. """
+import contextlib
+import sys
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from wsqluse.wsqluse import Wsqluse
+
+
+class ConnectionPool:
+    """ Потокобезопасный пул соединений с PostgreSQL. Соединения открываются
+    по мере надобности, но не больше maxconn. Если все заняты, getconn ждет
+    освобождения не дольше checkout_timeout. Перед выдачей соединение
+    проверяется, разорванные соединения заменяются новыми. Свободные
+    соединения сверх minconn закрываются, если простаивают дольше
+    max_idle. """
+
+    def __init__(self, minconn, maxconn, checkout_timeout=30,
+                 check_interval=30, max_idle=300, **connect_kwargs):
+        """
+        Инициализация.
+
+        :param minconn: Сколько свободных соединений держать открытыми.
+        :param maxconn: Максимум соединений.
+        :param checkout_timeout: Сколько секунд ждать свободного соединения.
+        :param check_interval: Соединение, простоявшее дольше, перед выдачей
+            проверяется запросом SELECT 1.
+        :param max_idle: Через сколько секунд простоя закрывать свободные
+            соединения сверх minconn.
+        :param connect_kwargs: Аргументы psycopg2.connect.
+        """
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.check_interval = check_interval
+        self.max_idle = max_idle
+        self.connect_kwargs = connect_kwargs
+        # Свободные соединения: [(соединение, время освобождения)]
+        self.idle = []
+        self.size = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+        self.timeouts = 0
+        self.reconnects = 0
+
+    def connect(self):
+        return psycopg2.connect(**self.connect_kwargs)
+
+    def getconn(self):
+        """ Выдать соединение из пула.
+
+        :return: Соединение psycopg2. """
+        started = time.monotonic()
+        waited = False
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise psycopg2.pool.PoolError('Пул соединений закрыт')
+                if self.idle:
+                    conn, released = self.idle.pop()
+                    break
+                if self.size < self.maxconn:
+                    self.size += 1
+                    conn, released = None, None
+                    break
+                waited = True
+                remaining = self.checkout_timeout - (time.monotonic() -
+                                                     started)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise psycopg2.pool.PoolError(
+                        'Нет свободных соединений с GDB за {} сек.'.format(
+                            self.checkout_timeout))
+                self.cond.wait(remaining)
+            wait_time = time.monotonic() - started
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        try:
+            if conn is not None and not self.check(conn, released):
+                self.reconnects += 1
+                self.discard(conn)
+                conn = None
+            if conn is None:
+                conn = self.connect()
+        except psycopg2.Error:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+        return conn
+
+    def check(self, conn, released):
+        """ Проверить, что соединение живо. """
+        if conn.closed:
+            return False
+        if time.monotonic() - released < self.check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def putconn(self, conn):
+        """ Вернуть соединение в пул. Незавершенная транзакция откатывается,
+        разорванное соединение закрывается. """
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != \
+                        psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                pass
+        if conn.closed or self.closed:
+            self.discard(conn)
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            return
+        now = time.monotonic()
+        with self.cond:
+            self.idle.append((conn, now))
+            expired = []
+            while (len(self.idle) > self.minconn
+                   and now - self.idle[0][1] > self.max_idle):
+                expired.append(self.idle.pop(0)[0])
+                self.size -= 1
+            self.cond.notify()
+        for expired_conn in expired:
+            self.discard(expired_conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def closeall(self):
+        """ Закрыть все свободные соединения и больше не выдавать новых.
+        Занятые соединения закроются при возврате в пул. """
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.cond.notify_all()
+        for conn, _ in idle:
+            self.discard(conn)
+
+    def get_stats(self):
+        """ Вернуть метрики пула. """
+        with self.cond:
+            in_use = self.size - len(self.idle)
+            return {'size': self.size, 'idle': len(self.idle),
+                    'in_use': in_use, 'max': self.maxconn,
+                    'utilization': in_use / self.maxconn,
+                    'checkouts': self.checkouts, 'waits': self.waits,
+                    'wait_time_total': self.wait_time,
+                    'wait_time_avg': self.wait_time / (self.checkouts or 1),
+                    'wait_time_max': self.max_wait_time,
+                    'timeouts': self.timeouts,
+                    'reconnects': self.reconnects}
+
+
+class TransactionAborted(psycopg2.Error):
+    """ Откат, запрошенный внутри PooledWsqluse.transaction. """
+
+
+def abort_transaction():
+    """ Прервать PooledWsqluse.transaction: перевыбросить обрабатываемую
+    ошибку (или TransactionAborted), чтобы transaction откатил всю
+    транзакцию, а вызывающий получил ошибку. """
+    if sys.exc_info()[1] is not None:
+        raise
+    raise TransactionAborted('Откат внутри транзакции')
+
+
+class BorrowedConnection:
+    """ Соединение из пула, выданное на время запроса. close() не закрывает
+    соединение (его вернет в пул request_scope), остальное передается
+    самому соединению. Внутри PooledWsqluse.transaction commit() тоже ничего
+    не делает - транзакцию фиксирует transaction на выходе, а rollback()
+    прерывает transaction (abort_transaction): откат только части команд
+    молча отменил бы и предыдущие. """
+
+    def __init__(self, conn, deferred=False):
+        self.conn = conn
+        self.deferred = deferred
+
+    def close(self):
+        pass
+
+    def commit(self):
+        if not self.deferred:
+            self.conn.commit()
+
+    def rollback(self):
+        if self.deferred:
+            abort_transaction()
+        self.conn.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class PooledWsqluse(Wsqluse):
+    """ Wsqluse, выполняющий команды через пул соединений. """
+
+    def __init__(self, *args, pool_min=1, pool_max=10, checkout_timeout=30,
+                 check_interval=30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ConnectionPool(pool_min, pool_max,
+                                   checkout_timeout=checkout_timeout,
+                                   check_interval=check_interval,
+                                   dbname=self.dbname, user=self.user,
+                                   password=self.password, host=self.host,
+                                   port=self.port)
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def request_scope(self):
+        """ Все команды внутри выполняются через одно соединение из пула,
+        которое берется при первой команде и возвращается в пул на выходе.
+        Вложенные request_scope используют соединение внешнего. """
+        if getattr(self.local, 'in_scope', False):
+            yield
+            return
+        self.local.in_scope = True
+        self.local.conn = None
+        try:
+            yield
+        finally:
+            conn = self.local.conn
+            self.local.conn = None
+            self.local.in_scope = False
+            if conn is not None:
+                self.pool.putconn(conn)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Все команды внутри выполняются через одно соединение в одной
+        транзакции: их commit() откладывается до выхода, где транзакция
+        фиксируется (или откатывается, если вылетело исключение).
+        Вложенные transaction входят в транзакцию внешнего. """
+        with self.request_scope():
+            if getattr(self.local, 'deferred', False):
+                yield
+                return
+            self.local.deferred = True
+            try:
+                yield
+                if self.local.conn is not None:
+                    self.local.conn.commit()
+            except BaseException:
+                if self.local.conn is not None:
+                    self.local.conn.rollback()
+                raise
+            finally:
+                self.local.deferred = False
+
+    def transaction_fail(self, cursor):
+        """ Внутри transaction ошибка команды не откатывается на месте
+        (ROLLBACK отменил бы и предыдущие команды транзакции, а метод вернул
+        бы только свою ошибку), а прерывает transaction. """
+        if getattr(self.local, 'deferred', False):
+            abort_transaction()
+        return super().transaction_fail(cursor)
+
+    def pooled(self, func):
+        """ Декоратор: выполнить func внутри request_scope. """
+
+        def wrapper(*args, **kwargs):
+            with self.request_scope():
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def get_cursor_conn(self):
+        if not getattr(self.local, 'in_scope', False):
+            return super().get_cursor_conn()
+        if self.local.conn is None:
+            self.local.conn = self.pool.getconn()
+        return self.local.conn.cursor(), BorrowedConnection(
+            self.local.conn, getattr(self.local, 'deferred', False))
@@ -0,0 +1,123 @@
+""" Модуль содержит многопроцессный режим WServer (prefork): супервизор
+заранее открывает слушающий сокет и запускает несколько процессов-
+обработчиков, которые принимают клиентов на этом общем сокете. У каждого
+обработчика свой WServer и свои соединения с GDB. Упавший обработчик
+перезапускается. """
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+
+def create_listen_socket(ip, port, backlog=128):
+    """
+    Открыть слушающий сокет, который затем унаследуют процессы-обработчики.
+
+    :param ip: Адрес.
+    :param port: Порт.
+    :param backlog: Размер очереди входящих подключений.
+    :return:
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((ip, port))
+    server.listen(backlog)
+    return server
+
+
+class Supervisor:
+    """ Супервизор процессов-обработчиков. Запускает workers процессов
+    (fork), каждый выполняет worker_target и завершается с возвращенным им
+    кодом. Обработчик, завершившийся не по команде супервизора,
+    перезапускается; если обработчики падают сразу после старта, пауза
+    перед перезапуском растет до max_restart_delay. По SIGTERM/SIGINT
+    супервизор пересылает SIGTERM обработчикам и ждет их завершения. """
+
+    def __init__(self, workers, worker_target, restart_delay=1,
+                 max_restart_delay=30, min_uptime=5):
+        """
+        Инициализация.
+
+        :param workers: Количество процессов-обработчиков.
+        :param worker_target: Функция без аргументов, выполняемая в
+            процессе-обработчике и возвращающая код выхода.
+        :param restart_delay: Начальная пауза перед перезапуском (сек.)
+        :param max_restart_delay: Максимальная пауза перед перезапуском.
+        :param min_uptime: Обработчик, проработавший меньше, считается
+            упавшим при старте.
+        """
+        self.workers = workers
+        self.worker_target = worker_target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.children = {}
+        self.stopping = False
+        self.exit_code = 0
+
+    def spawn(self):
+        """ Запустить нового обработчика. """
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            exit_code = 1
+            try:
+                exit_code = self.worker_target()
+            except Exception:
+                print(traceback.format_exc())
+            finally:
+                # os._exit не сбрасывает буферы, traceback не должен
+                # потеряться
+                sys.stdout.flush()
+                os._exit(exit_code or 0)
+        self.children[pid] = time.monotonic()
+        print('[Supervisor] Запущен обработчик {}'.format(pid))
+        return pid
+
+    def request_shutdown(self, signum=None, *args, **kwargs):
+        """ Остановить всех обработчиков (годится как обработчик сигнала).
+        """
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """
+        Запустить обработчиков и следить за ними до остановки.
+
+        :return: Код выхода: 0, если все обработчики завершились корректно.
+        """
+        signal.signal(signal.SIGTERM, self.request_shutdown)
+        signal.signal(signal.SIGINT, self.request_shutdown)
+        for _ in range(self.workers):
+            self.spawn()
+        delay = self.restart_delay
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+            exit_code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                if exit_code:
+                    self.exit_code = 1
+                continue
+            print('[Supervisor] Обработчик {} завершился с кодом {}, '
+                  'перезапуск'.format(pid, exit_code))
+            if time.monotonic() - started < self.min_uptime:
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_restart_delay)
+            else:
+                delay = self.restart_delay
+            if not self.stopping:
+                self.spawn()
+        return self.exit_code
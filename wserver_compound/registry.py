@@ -0,0 +1,197 @@
+""" Модуль содержит реестр методов API WServer (MethodRegistry).
+
+Методы WServer, открытые для QPI, помечаются декоратором реестра:
+    @api.method()
+    def set_auto(self, car_number, polygon: int, ...):
+Сигнатура метода разбирается один раз, при импорте: какие аргументы
+обязательны, какие значения по умолчанию, к какому типу приводить
+аргумент (по аннотации int, float, bool, str). При вызове из QPI аргументы
+проверяются и приводятся за один проход, без повторного разбора
+сигнатуры. Реестр же отдает описание всех методов (get_catalog). """
+import collections
+import inspect
+
+# Признак отсутствия значения по умолчанию
+REQUIRED = inspect.Parameter.empty
+# Строковые значения, которые приводятся к bool
+BOOL_STRINGS = {'true': True, '1': True, 'false': False, '0': False}
+
+
+class ArgumentsError(ValueError):
+    """ Аргументы вызова не подходят методу. """
+    pass
+
+
+def to_bool(value):
+    if isinstance(value, str):
+        try:
+            return BOOL_STRINGS[value.strip().lower()]
+        except KeyError:
+            raise ValueError(value)
+    if isinstance(value, (int, float)):
+        return bool(value)
+    raise ValueError(value)
+
+
+def to_int(value):
+    """ Привести к int строку или float без дробной части (bool, float с
+    дробной частью и прочие типы не подходят). """
+    if isinstance(value, bool):
+        raise TypeError(value)
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    if isinstance(value, (str, int)):
+        return int(value)
+    raise TypeError(value)
+
+
+def to_float(value):
+    """ Привести к float строку или int. """
+    if isinstance(value, bool):
+        raise TypeError(value)
+    if isinstance(value, (str, int, float)):
+        return float(value)
+    raise TypeError(value)
+
+
+def to_str(value):
+    """ Привести к str число (списки, словари и т.п. не подходят). """
+    if isinstance(value, bool):
+        raise TypeError(value)
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    raise TypeError(value)
+
+
+# Приведение аргументов по аннотации: {тип: функция приведения}
+COERCERS = {int: to_int, float: to_float, str: to_str, bool: to_bool}
+
+
+class MethodSpec:
+    """ Разобранная сигнатура метода API. """
+
+    def __init__(self, name, func):
+        """
+        Инициализация.
+
+        :param name: Имя метода в API.
+        :param func: Метод класса (первый аргумент - self).
+        """
+        self.name = name
+        self.func = func
+        self.accepts_kwargs = False
+        # [(имя, тип или None, значение по умолчанию или REQUIRED)]
+        self.params = []
+        parameters = list(inspect.signature(func).parameters.values())[1:]
+        for parameter in parameters:
+            if parameter.kind is inspect.Parameter.VAR_KEYWORD:
+                self.accepts_kwargs = True
+            elif parameter.kind is not inspect.Parameter.VAR_POSITIONAL:
+                annotation = parameter.annotation
+                self.params.append((parameter.name,
+                                    annotation if annotation in COERCERS
+                                    else None,
+                                    parameter.default))
+        self.names = {name for name, _, _ in self.params}
+
+    def prepare(self, values):
+        """
+        Проверить аргументы вызова и привести их к типам метода.
+        Лишние аргументы (QPI добавляет свои, например connection)
+        передаются, только если метод принимает **kwargs.
+
+        :param values: Аргументы вызова.
+        :return: Аргументы для метода.
+        """
+        if self.accepts_kwargs:
+            kwargs = dict(values)
+        else:
+            kwargs = {}
+        missing = []
+        for name, annotation, default in self.params:
+            if name not in values:
+                if default is REQUIRED:
+                    missing.append(name)
+                continue
+            value = values[name]
+            if (annotation is not None and value is not None and
+                    type(value) is not annotation):
+                try:
+                    value = COERCERS[annotation](value)
+                except (TypeError, ValueError):
+                    raise ArgumentsError(
+                        'Аргумент {} метода {} должен быть {}, получено '
+                        '{!r}'.format(name, self.name, annotation.__name__,
+                                      value))
+            kwargs[name] = value
+        if missing:
+            raise ArgumentsError('Методу {} не переданы аргументы: {}'.format(
+                self.name, ', '.join(missing)))
+        return kwargs
+
+    def bind(self, instance):
+        """ Вернуть функцию, вызывающую метод у instance с проверенными
+        аргументами. Если аргументы не подходят, она возвращает ответ
+        {'status': False, 'info': описание ошибки}. """
+
+        def call(**values):
+            try:
+                kwargs = self.prepare(values)
+            except ArgumentsError as error:
+                return {'status': False, 'info': str(error)}
+            return self.func(instance, **kwargs)
+
+        call.__name__ = self.func.__name__
+        call.__doc__ = self.func.__doc__
+        return call
+
+    def describe(self):
+        """ Вернуть описание метода: аргументы, их типы, обязательность и
+        значения по умолчанию, первую строку документации. """
+        doc = inspect.getdoc(self.func) or ''
+        return {'name': self.name,
+                'doc': doc.split('\n')[0],
+                'params': [{'name': name,
+                            'type': annotation.__name__ if annotation
+                            else None,
+                            'required': default is REQUIRED,
+                            'default': None if default is REQUIRED
+                            else default}
+                           for name, annotation, default in self.params]}
+
+
+class MethodRegistry:
+    """ Реестр методов API. """
+
+    def __init__(self):
+        self.specs = collections.OrderedDict()
+
+    def method(self, name=None):
+        """
+        Декоратор: зарегистрировать метод класса в API.
+
+        :param name: Имя метода в API (по умолчанию - имя функции).
+        :return:
+        """
+
+        def decorator(func):
+            api_name = name or func.__name__
+            if api_name in self.specs:
+                raise ValueError('Метод {} уже зарегистрирован'.format(
+                    api_name))
+            self.specs[api_name] = MethodSpec(api_name, func)
+            return func
+
+        return decorator
+
+    def bind(self, instance):
+        """ Вернуть методы для QPI ({имя: {'method': функция}}), вызываемые
+        у instance. """
+        return {name: {'method': spec.bind(instance)}
+                for name, spec in self.specs.items()}
+
+    def get_catalog(self):
+        """ Вернуть описание всех методов (MethodSpec.describe). """
+        return [spec.describe() for spec in self.specs.values()]
@@ -9,4 +9,175 @@ CUR_DIR = os.path.dirname(os.path.abspath(__file__))
 PHOTOS_DIR = os.path.join(CUR_DIR, 'photos')
 TEST_PHOTO = os.path.join(PHOTOS_DIR, 'test_act_photo.png')
 
+# Сколько секунд жить кэшу настроек отправки актов во внешние системы
+# (0 - не кэшировать)
+ACT_SEND_SETTINGS_CACHE_TTL = int(os.environ.get(
+    'ACT_SEND_SETTINGS_CACHE_TTL', 60))
+# Канал PostgreSQL NOTIFY, по сигналу в котором кэш сбрасывается досрочно
+# (пусто - не слушать)
+ACT_SEND_SETTINGS_CHANNEL = os.environ.get('ACT_SEND_SETTINGS_CHANNEL')
 
+# Если 1 - set_act только сохраняет акт и ставит его в очередь
+# acts_post_processing_queue, а фиксацию отправки во внешние системы делают
+# фоновые обработчики (act_queue)
+ACT_POST_PROCESSING_DEFERRED = os.environ.get(
+    'ACT_POST_PROCESSING_DEFERRED') == '1'
+ACT_QUEUE_WORKERS = int(os.environ.get('ACT_QUEUE_WORKERS', 2))
+ACT_QUEUE_BATCH_SIZE = int(os.environ.get('ACT_QUEUE_BATCH_SIZE', 100))
+# Пауза между опросами пустой очереди (сек.)
+ACT_QUEUE_POLL_INTERVAL = float(os.environ.get('ACT_QUEUE_POLL_INTERVAL', 1))
+# Через сколько секунд повторить обработку акта после ошибки
+ACT_QUEUE_RETRY_DELAY = int(os.environ.get('ACT_QUEUE_RETRY_DELAY', 30))
+# Сколько последних ключей (полигон, ex_id) принятых актов держать в памяти
+# для ответа на повторные set_act без обращения к GDB
+ACT_DEDUP_CACHE_SIZE = int(os.environ.get('ACT_DEDUP_CACHE_SIZE', 10000))
+# Если 1 и в records нет уникального индекса (polygon, ex_id), WServer при
+# запуске создает его (если в records нет повторов). Без индекса повторно
+# присланные акты отсекаются только среди ACT_DEDUP_CACHE_SIZE последних
+# принятых
+ACT_CREATE_UNIQUE_INDEX = os.environ.get('ACT_CREATE_UNIQUE_INDEX') == '1'
+# Сколько секунд при остановке ждать завершения выполняющихся запросов и
+# фоновых обработчиков
+SHUTDOWN_DRAIN_TIMEOUT = int(os.environ.get('SHUTDOWN_DRAIN_TIMEOUT', 30))
+# Количество процессов-обработчиков WServer на одном порту (prefork).
+# 1 - один процесс без супервизора
+WSERVER_WORKERS = int(os.environ.get('WSERVER_WORKERS', 1))
+# Прием клиентов: 'qpi' - QPI (поток на клиента и на команду),
+# 'asyncio' - AsyncQPI (один цикл событий и ограниченный пул потоков)
+WSERVER_FRONTEND = os.environ.get('WSERVER_FRONTEND', 'qpi')
+# Сколько методов AsyncQPI выполняет одновременно
+ASYNC_QPI_MAX_WORKERS = int(os.environ.get('ASYNC_QPI_MAX_WORKERS', 16))
+# Сколько команд может ждать выполнения в AsyncQPI
+ASYNC_QPI_MAX_PENDING = int(os.environ.get('ASYNC_QPI_MAX_PENDING', 256))
+ASYNC_QPI_MAX_CONNECTIONS = int(os.environ.get('ASYNC_QPI_MAX_CONNECTIONS',
+                                               5000))
+# Пул соединений с GDB: сколько свободных соединений держать открытыми,
+# максимум соединений на процесс, сколько секунд ждать свободного
+# соединения и через сколько секунд простоя проверять соединение перед
+# выдачей
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_CHECKOUT_TIMEOUT = int(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', 30))
+DB_POOL_CHECK_INTERVAL = int(os.environ.get('DB_POOL_CHECK_INTERVAL', 30))
+# Максимальный размер одной фотографии (байт)
+PHOTO_MAX_SIZE = int(os.environ.get('PHOTO_MAX_SIZE', 20 * 1024 * 1024))
+# Сколько секунд ждать очередную часть фото при загрузке частями, после
+# чего сеанс загрузки отменяется
+PHOTO_UPLOAD_TTL = int(os.environ.get('PHOTO_UPLOAD_TTL', 300))
+# Сколько символов фото в старом формате (строка base64 от set_photos)
+# декодировать за один шаг - ограничивает память на один запрос
+PHOTO_DECODE_CHUNK_SIZE = int(os.environ.get('PHOTO_DECODE_CHUNK_SIZE',
+                                             64 * 1024))
+# Хранилище фото в PHOTOS_DIR: 'sharded' - по содержимому (sha256) во
+# вложенных папках, одинаковые фото хранятся один раз; 'flat' - все фото в
+# одной папке под случайными именами; 'pack' - подряд в больших файлах-
+# пачках (много мелких фото)
+PHOTO_STORE = os.environ.get('PHOTO_STORE', 'sharded')
+# После какого размера (байт) начинать новую пачку фото
+PHOTO_PACK_SEGMENT_SIZE = int(os.environ.get('PHOTO_PACK_SEGMENT_SIZE',
+                                             256 * 1024 * 1024))
+# Пачки, в которых доля фото, на которые еще ссылается act_photos, ниже
+# этого значения, уплотняются (compact_photo_packs)
+PHOTO_PACK_MIN_LIVE_RATIO = float(os.environ.get('PHOTO_PACK_MIN_LIVE_RATIO',
+                                                 0.5))
+# Сколько секунд после последней записи в пачку ее нельзя уплотнять (должно
+# быть заметно больше PHOTO_WRITER_FLUSH_INTERVAL и времени сохранения фото)
+PHOTO_PACK_COMPACT_MIN_AGE = int(os.environ.get('PHOTO_PACK_COMPACT_MIN_AGE',
+                                                3600))
+# Фоновая запись фото: сколько потоков пишут фото (0 - писать в потоке
+# запроса), сколько фото может ждать записи и какого общего объема (байт,
+# 0 - без ограничения), максимум фото в одной пачке (один fsync и один
+# INSERT в act_photos на пачку) и сколько секунд собирать пачку
+PHOTO_WRITER_WORKERS = int(os.environ.get('PHOTO_WRITER_WORKERS', 0))
+PHOTO_WRITER_QUEUE_SIZE = int(os.environ.get('PHOTO_WRITER_QUEUE_SIZE', 1000))
+PHOTO_WRITER_QUEUE_BYTES = int(os.environ.get('PHOTO_WRITER_QUEUE_BYTES',
+                                              256 * 1024 * 1024))
+PHOTO_WRITER_BATCH_SIZE = int(os.environ.get('PHOTO_WRITER_BATCH_SIZE', 20))
+PHOTO_WRITER_FLUSH_INTERVAL = float(os.environ.get(
+    'PHOTO_WRITER_FLUSH_INTERVAL', 0.05))
+# Сколько фото одного акта set_photos_batch пишет параллельно
+PHOTO_BATCH_WORKERS = int(os.environ.get('PHOTO_BATCH_WORKERS', 4))
+# Максимум байт фото, возвращаемых get_photo за один вызов (большие фото
+# клиент читает частями)
+PHOTO_READ_MAX_CHUNK = int(os.environ.get('PHOTO_READ_MAX_CHUNK',
+                                          4 * 1024 * 1024))
+# Кэш недавно прочитанных фото: суммарный размер и максимальный размер
+# одного кэшируемого фото (байт)
+PHOTO_CACHE_SIZE = int(os.environ.get('PHOTO_CACHE_SIZE', 64 * 1024 * 1024))
+PHOTO_CACHE_MAX_PHOTO = int(os.environ.get('PHOTO_CACHE_MAX_PHOTO',
+                                           2 * 1024 * 1024))
+# Обработка старых фото (python -m wserver_compound.photo_pipeline): через
+# сколько дней после заезда перекодировать фото в PHOTO_PIPELINE_FORMAT с
+# качеством PHOTO_PIPELINE_QUALITY, уменьшать до PHOTO_DOWNSCALE_MAX_SIDE
+# точек по большей стороне и удалять. Не заданный срок выключает этап.
+PHOTO_TRANSCODE_AFTER_DAYS = os.environ.get('PHOTO_TRANSCODE_AFTER_DAYS')
+PHOTO_DOWNSCALE_AFTER_DAYS = os.environ.get('PHOTO_DOWNSCALE_AFTER_DAYS')
+PHOTO_RETENTION_DAYS = os.environ.get('PHOTO_RETENTION_DAYS')
+if PHOTO_TRANSCODE_AFTER_DAYS is not None:
+    PHOTO_TRANSCODE_AFTER_DAYS = int(PHOTO_TRANSCODE_AFTER_DAYS)
+if PHOTO_DOWNSCALE_AFTER_DAYS is not None:
+    PHOTO_DOWNSCALE_AFTER_DAYS = int(PHOTO_DOWNSCALE_AFTER_DAYS)
+if PHOTO_RETENTION_DAYS is not None:
+    PHOTO_RETENTION_DAYS = int(PHOTO_RETENTION_DAYS)
+PHOTO_PIPELINE_FORMAT = os.environ.get('PHOTO_PIPELINE_FORMAT', 'WEBP')
+PHOTO_PIPELINE_QUALITY = int(os.environ.get('PHOTO_PIPELINE_QUALITY', 80))
+PHOTO_DOWNSCALE_MAX_SIDE = int(os.environ.get('PHOTO_DOWNSCALE_MAX_SIDE',
+                                              1280))
+# Файл контрольной точки, размер пачки, ограничение скорости (фото в
+# секунду, 0 - без ограничения) и пауза между проходами (секунд)
+PHOTO_PIPELINE_CHECKPOINT = os.environ.get(
+    'PHOTO_PIPELINE_CHECKPOINT',
+    os.path.join(PHOTOS_DIR, 'photo_pipeline.json'))
+PHOTO_PIPELINE_BATCH_SIZE = int(os.environ.get('PHOTO_PIPELINE_BATCH_SIZE',
+                                               100))
+PHOTO_PIPELINE_MAX_PHOTOS_PER_SEC = float(os.environ.get(
+    'PHOTO_PIPELINE_MAX_PHOTOS_PER_SEC', 5))
+PHOTO_PIPELINE_INTERVAL = int(os.environ.get('PHOTO_PIPELINE_INTERVAL', 3600))
+# Файлы фото, сохраненные или переиспользованные (одинаковое фото в
+# ShardedPhotoStore) за последние столько секунд, PhotoPipeline не удаляет
+PHOTO_PIPELINE_BLOB_MIN_AGE = int(os.environ.get(
+    'PHOTO_PIPELINE_BLOB_MIN_AGE', 3600))
+# Доставка справочных данных на полигоны (WTA): сколько полигонов
+# обслуживать параллельно и сколько секунд ждать ответа полигона
+WTA_DELIVERY_WORKERS = int(os.environ.get('WTA_DELIVERY_WORKERS', 8))
+WTA_DELIVERY_TIMEOUT = float(os.environ.get('WTA_DELIVERY_TIMEOUT', 10))
+# Если 1 - справочные данные (set_auto, update_company и т.д.) не
+# доставляются на полигоны в запросе, а ставятся в очередь wta_outbox в той
+# же транзакции, и их доставляют фоновые обработчики (wta_outbox)
+WTA_OUTBOX = os.environ.get('WTA_OUTBOX') == '1'
+WTA_OUTBOX_WORKERS = int(os.environ.get('WTA_OUTBOX_WORKERS', 1))
+WTA_OUTBOX_BATCH_SIZE = int(os.environ.get('WTA_OUTBOX_BATCH_SIZE', 100))
+# Пауза между опросами пустой очереди (сек.)
+WTA_OUTBOX_POLL_INTERVAL = float(os.environ.get('WTA_OUTBOX_POLL_INTERVAL',
+                                                1))
+# Пауза перед первым повтором недоставленных данных, дальше она удваивается
+# до WTA_OUTBOX_MAX_RETRY_DELAY (сек.)
+WTA_OUTBOX_RETRY_DELAY = int(os.environ.get('WTA_OUTBOX_RETRY_DELAY', 10))
+WTA_OUTBOX_MAX_RETRY_DELAY = int(os.environ.get('WTA_OUTBOX_MAX_RETRY_DELAY',
+                                                3600))
+# После скольких неудачных попыток строка wta_outbox помечается dead и
+# больше не доставляется (0 - повторять без ограничения)
+WTA_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('WTA_OUTBOX_MAX_ATTEMPTS', 20))
+# На сколько секунд обработчик арендует забранные строки wta_outbox (должно
+# с запасом хватать на доставку пачки)
+WTA_OUTBOX_LEASE = int(os.environ.get('WTA_OUTBOX_LEASE', 600))
+# Соединения с полигонами (WTA): через сколько секунд простоя закрывать
+# соединение, сколько секунд ждать подключения и ответа полигона
+WTA_CLIENT_MAX_IDLE = int(os.environ.get('WTA_CLIENT_MAX_IDLE', 300))
+WTA_CONNECT_TIMEOUT = float(os.environ.get('WTA_CONNECT_TIMEOUT', 5))
+WTA_RESPONSE_TIMEOUT = float(os.environ.get('WTA_RESPONSE_TIMEOUT', 30))
+# После скольких неудачных доставок подряд приостанавливать доставки на
+# полигон (0 - никогда) и через сколько секунд пробовать снова
+WTA_BREAKER_FAILURES = int(os.environ.get('WTA_BREAKER_FAILURES', 5))
+WTA_BREAKER_RESET_TIMEOUT = float(os.environ.get('WTA_BREAKER_RESET_TIMEOUT',
+                                                 30))
+# Окно склейки изменений одной записи перед доставкой на полигоны (сек.):
+# изменения записи в этом окне доставляются одной доставкой с ее итоговым
+# состоянием. 0 - доставлять каждое изменение сразу
+WTA_COALESCE_WINDOW = float(os.environ.get('WTA_COALESCE_WINDOW', 0))
+# Сколько секунд жить кэшу списка полигонов (duo_polygons), на которые
+# доставляются справочные данные без полигона (0 - не кэшировать)
+POLYGON_DIRECTORY_TTL = int(os.environ.get('POLYGON_DIRECTORY_TTL', 300))
+# Канал PostgreSQL NOTIFY, по сигналу в котором кэш полигонов сбрасывается
+# досрочно (пусто - не слушать)
+POLYGON_DIRECTORY_CHANNEL = os.environ.get('POLYGON_DIRECTORY_CHANNEL')
@@ -0,0 +1,125 @@
+""" Модуль содержит реестр подготовленных команд (PREPARE/EXECUTE).
+
+Часто выполняемые команды с неизменным текстом (сохранение актов, фото,
+комментариев, алертов) подготавливаются на соединении один раз, а затем
+выполняются через EXECUTE, без повторного разбора и планирования на стороне
+PostgreSQL. Подготовка имеет смысл только для долгоживущих соединений из
+пула (pool.PooledWsqluse), для остальных команда выполняется как обычно. """
+import hashlib
+import itertools
+import re
+import threading
+import weakref
+
+import psycopg2
+
+from wserver_compound import pool
+
+
+class Statement:
+    """ Подготавливаемая команда. Хранит счетчики выполнений. """
+
+    def __init__(self, name, command):
+        """
+        Инициализация.
+
+        :param name: Имя команды (для счетчиков).
+        :param command: Текст команды с параметрами %s.
+        """
+        self.name = name
+        self.command = command
+        self.prepared_name = 'wserver_{}_{}'.format(
+            name, hashlib.md5(command.encode()).hexdigest()[:8])
+        numbers = itertools.count(1)
+        self.prepare_command = 'PREPARE {} AS {}'.format(
+            self.prepared_name,
+            re.sub('%s', lambda match: '${}'.format(next(numbers)), command))
+        params_count = command.count('%s')
+        if params_count:
+            self.execute_command = 'EXECUTE {} ({})'.format(
+                self.prepared_name, ', '.join(['%s'] * params_count))
+        else:
+            self.execute_command = 'EXECUTE {}'.format(self.prepared_name)
+        self.executions = 0
+        self.prepared_executions = 0
+        self.prepares = 0
+        self.errors = 0
+
+    def execute(self, cursor, conn, values):
+        """ Выполнить команду на курсоре cursor соединения conn. Если
+        соединение из пула - через PREPARE/EXECUTE. """
+        self.executions += 1
+        if not isinstance(conn, pool.BorrowedConnection):
+            cursor.execute(self.command, values)
+            return
+        with prepared_lock:
+            prepared = prepared_on_connections.setdefault(conn.conn, set())
+        if self.prepared_name not in prepared:
+            cursor.execute(self.prepare_command)
+            prepared.add(self.prepared_name)
+            self.prepares += 1
+        cursor.execute(self.execute_command, values)
+        self.prepared_executions += 1
+
+    def get_stats(self):
+        return {'executions': self.executions,
+                'prepared_executions': self.prepared_executions,
+                'prepares': self.prepares, 'errors': self.errors}
+
+
+# Подготовленные команды на каждом соединении {соединение: {имена}}
+prepared_on_connections = weakref.WeakKeyDictionary()
+prepared_lock = threading.Lock()
+# Реестр команд {(имя, текст): Statement}
+statements = {}
+statements_lock = threading.Lock()
+
+
+def get_statement(name, command):
+    """ Вернуть команду из реестра, зарегистрировав ее при первом вызове.
+    """
+    key = (name, command)
+    statement = statements.get(key)
+    if statement is None:
+        with statements_lock:
+            statement = statements.setdefault(key, Statement(name, command))
+    return statement
+
+
+def try_execute(sql_shell, name, command, values=None):
+    """
+    Выполнить подготавливаемую команду, зафиксировать транзакцию и вернуть
+    полученные строки (команда должна что-то возвращать, например,
+    RETURNING id).
+
+    :param sql_shell: Объект типа WSQluse для работы с БД.
+    :param name: Имя команды.
+    :param command: Текст команды с параметрами %s.
+    :param values: Значения параметров.
+    :return: Ответ в формате WSQLuse.
+    """
+    statement = get_statement(name, command)
+    cursor, conn = sql_shell.get_cursor_conn()
+    try:
+        statement.execute(cursor, conn, values)
+        records = cursor.fetchall()
+        conn.commit()
+        response = {'status': 'success', 'info': records}
+    except psycopg2.Error:
+        statement.errors += 1
+        response = sql_shell.transaction_fail(cursor)
+    finally:
+        conn.close()
+    return response
+
+
+def get_stats():
+    """ Вернуть счетчики выполнений всех команд реестра. """
+    stats = {}
+    for statement in list(statements.values()):
+        name_stats = stats.setdefault(statement.name, {
+            'executions': 0, 'prepared_executions': 0, 'prepares': 0,
+            'errors': 0})
+        for key, value in statement.get_stats().items():
+            name_stats[key] += value
+    return stats
@@ -0,0 +1,66 @@
+""" Тесты очереди отложенной обработки актов (act_queue) """
+import unittest
+
+import psycopg2
+
+from wserver_compound import act_queue
+from wserver_compound.tests import test_objects
+
+
+class ActQueueTest(unittest.TestCase):
+    """ Тесты act_queue без GDB. """
+
+    def test_act_queue_enqueue_command(self):
+        """ Команда set_act, ставящая вставленный акт в очередь обработки
+        """
+        command = act_queue.get_enqueue_command(
+            "INSERT INTO records (car) VALUES (%s)")
+        self.assertIn("INSERT INTO records (car) VALUES (%s) "
+                      "RETURNING id, polygon", command)
+        self.assertIn("INSERT INTO acts_post_processing_queue", command)
+        self.assertTrue(command.strip().endswith(
+            "SELECT id, inserted FROM new_records"))
+
+    def test_act_queue_process_batch(self):
+        """ Обработка очереди актов: если пачка не прошла, акты
+        обрабатываются по одному и откладывается только акт с ошибкой """
+        sql_shell = test_objects.FakeSqlShell(
+            {'SELECT record': [(1, 9), (2, 9), (3, 9)]})
+        processed = []
+
+        class Processor(act_queue.ActPostProcessor):
+            def process_records(self, cursor, records):
+                if (2, 9) in records:
+                    raise psycopg2.OperationalError('Ошибка акта 2')
+                processed.extend(records)
+
+        processor = Processor(sql_shell, batch_size=3, retry_delay=30)
+        self.assertEqual(processor.process_batch(), 3)
+        self.assertEqual(processed, [(1, 9), (3, 9)])
+        updates = sql_shell.executed('UPDATE')
+        self.assertEqual(len(updates), 1)
+        self.assertEqual((updates[0][0], updates[0][2]), (30, 2))
+        self.assertIn('Ошибка акта 2', updates[0][1])
+        self.assertEqual(len(sql_shell.executed('COMMIT')), 1)
+        self.assertEqual(processor.get_stats(),
+                         {'workers': 0, 'processed': 2, 'failed': 1})
+
+    def test_act_queue_mainloop_errors(self):
+        """ Любая ошибка пачки не останавливает обработчика """
+        processor = act_queue.ActPostProcessor(test_objects.FakeSqlShell(),
+                                               poll_interval=0)
+        errors = [KeyError('polygon'), psycopg2.OperationalError()]
+
+        def process_batch():
+            if errors:
+                raise errors.pop()
+            processor.stop_event.set()
+            return 0
+
+        processor.process_batch = process_batch
+        processor.mainloop()
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+""" Тесты AsyncQPI (async_qpi) """
+import pickle
+import socket
+import struct
+import unittest
+
+from wserver_compound import async_qpi
+from wserver_compound import prefork
+
+
+class AsyncQPITest(unittest.TestCase):
+    """ Тесты AsyncQPI на локальном сокете. """
+
+    def test_async_qpi(self):
+        """ AsyncQPI: кадр (8 байт длины '>Q' + pickle), супер-методы QPI и
+        методы ядра """
+
+        class Core:
+            def get_api_support_methods(self):
+                return {'echo': {'method': lambda text, **kwargs: text}}
+
+        listen_socket = prefork.create_listen_socket('127.0.0.1', 0)
+        server = async_qpi.AsyncQPI(Core(), '127.0.0.1', 0,
+                                    sock=listen_socket, max_workers=2)
+        server.start()
+        client = socket.create_connection(listen_socket.getsockname(), 5)
+
+        def call(method, **data):
+            payload = pickle.dumps({'method': method, 'data': data})
+            client.sendall(struct.pack('>Q', len(payload)) + payload)
+            header = client.recv(8, socket.MSG_WAITALL)
+            (length,) = struct.unpack('>Q', header)
+            return pickle.loads(client.recv(length, socket.MSG_WAITALL))
+
+        try:
+            self.assertEqual(call('echo', text='тест'),
+                             {'status': True, 'info': 'тест',
+                              'core_method': 'echo'})
+            self.assertTrue(call('hello_world')['info']['status'])
+            methods = call('get_methods')['info']['info']
+            self.assertIn('echo', methods)
+            self.assertIn('auth_me', methods)
+            self.assertTrue(call('subscribe')['info']['status'])
+            connection, = server.connections_dict.values()
+            self.assertTrue(connection['subscriber'])
+            self.assertFalse(call('no_such_method')['info']['status'])
+        finally:
+            client.close()
+            server.close_connections()
+            listen_socket.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,16 @@
 """ Модуль содержит тесты для всех функций из модуля functions,
 используемых в методах WServer """
+import base64
 import datetime
+import inspect
+import os
+import tempfile
+import time
 import unittest
+import unittest.mock
 from wserver_compound import functions
+from wserver_compound import methods
+from wserver_compound import photo_store
 from wserver_compound import settings
 from wserver_compound.tests import test_objects
 
@@ -43,6 +51,21 @@ class FunctionsTest(unittest.TestCase):
         new_photo_obj = functions.encode_photo(new_photo_path)
         self.assertEqual(photo_obj, new_photo_obj)
 
+    def test_save_photo_chunks(self):
+        """ Декодирование фото частями: переносы строк base64.encodebytes и
+        части, не кратные 4 символам """
+        with open(settings.TEST_PHOTO, 'rb') as fobj:
+            photo_data = fobj.read()
+        photo_obj = str(base64.encodebytes(photo_data))
+        for chunk_size in (7, 77, 1024):
+            with unittest.mock.patch.object(
+                    settings, 'PHOTO_DECODE_CHUNK_SIZE', chunk_size):
+                new_photo_path = functions.save_photo(
+                    photo_obj, functions.generate_photo_name(1))
+            with open(new_photo_path, 'rb') as fobj:
+                self.assertEqual(fobj.read(), photo_data)
+            os.remove(new_photo_path)
+
     def test_get_user_ip(self):
         correct_response = functions.get_user_ip(test_objects.test_sql_shell,
                                                  9)
@@ -61,7 +84,6 @@ class FunctionsTest(unittest.TestCase):
         self.assertTrue(response['status'] == 'success' and
                         isinstance(response['info'][0][0], int))
 
-
     def test_id_converter(self):
         """
         Тестирование декоратора, преобразующего wserver_id в ar_id
@@ -72,5 +94,162 @@ class FunctionsTest(unittest.TestCase):
             print('Body', a,b )
         some_func('gott mit', 'uns')
 
+    def test_act_send_settings_cache(self):
+        """ Тестирование кэша настроек отправки актов во внешние системы """
+        sql_shell = test_objects.FakeSqlShell(
+            {'': [(9, 1, True), (9, 2, False), (1, 1, True)]})
+        cache = functions.ActSendSettingsCache(ttl=60)
+        self.assertEqual(cache.get_polygon_settings(sql_shell, 9),
+                         [(1, True), (2, False)])
+        self.assertFalse(cache.get(sql_shell, 1, 2))
+        self.assertEqual(cache.get_polygon_settings(sql_shell, 13), [])
+        self.assertEqual(len(sql_shell.commands), 1)
+        cache.invalidate()
+        self.assertTrue(cache.get(sql_shell, 1, 1))
+        self.assertEqual(len(sql_shell.commands), 2)
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        disabled = functions.ActSendSettingsCache(ttl=0)
+        self.assertIsNone(disabled.get_polygon_settings(sql_shell, 9))
+
+    def test_lru_cache(self):
+        """ Тестирование вытеснения давно не использованных ключей """
+        cache = functions.LRUCache(2)
+        cache.put((9, 1), 100)
+        cache.put((9, 2), 200)
+        self.assertEqual(cache.get((9, 1)), 100)
+        cache.put((9, 3), 300)
+        self.assertIsNone(cache.get((9, 2)))
+        self.assertEqual(cache.get((9, 1)), 100)
+        self.assertEqual(len(cache), 2)
+
+    def test_deliver_to_polygons(self):
+        """ Параллельная доставка на полигоны с ограничением времени """
+        class FakeClientPool:
+            def deliver(self, sql_shell, data_type, polygon, wserver_id,
+                        payload):
+                if polygon == 2:
+                    raise ConnectionRefusedError
+                if polygon == 3:
+                    time.sleep(1)
+                return {'wserver_id': wserver_id, 'success_save': True}
+
+        original_pool = functions.wta_client_pool
+        functions.wta_client_pool = FakeClientPool()
+        try:
+            started = time.monotonic()
+            deliveries = functions.deliver_to_polygons(
+                test_objects.test_sql_shell, 'auto', [1, 2, 3], 10, {},
+                timeout=0.3)
+        finally:
+            functions.wta_client_pool = original_pool
+        self.assertTrue(time.monotonic() - started < 0.9)
+        self.assertTrue(deliveries[1]['success_save'])
+        self.assertFalse(deliveries[2]['ar_deliver_status'])
+        self.assertFalse(deliveries[3]['ar_deliver_status'])
+
+    def test_polygon_routing(self):
+        """ Выбор полигонов доставки без лишних запросов к GDB """
+        def set_method(sql_shell, name, polygon, active=True):
+            pass
+
+        sql_shell = test_objects.FakeSqlShell({'duo_polygons': [(1,), (9,)],
+                                               '': [(None,)]})
+        directory = functions.PolygonDirectory(ttl=60)
+        original_directory = functions.polygon_directory
+        functions.polygon_directory = directory
+        try:
+            all_args = functions.bind_args(
+                inspect.signature(set_method), sql_shell, 'Cat', polygon=9)
+            self.assertEqual(all_args, {'sql_shell': sql_shell, 'name': 'Cat',
+                                        'polygon': 9, 'active': True})
+            self.assertEqual(functions.get_target_polygons(
+                sql_shell, 'trash_cats', 5, 9, lookup_polygon=False), [9])
+            self.assertEqual(sql_shell.commands, [])
+            for _ in range(2):
+                self.assertEqual(functions.get_target_polygons(
+                    sql_shell, 'trash_cats', 5, None, lookup_polygon=False),
+                    [1, 9])
+            self.assertEqual(len(sql_shell.commands), 1)
+            self.assertEqual(functions.get_target_polygons(
+                sql_shell, 'trash_cats', 5), [1, 9])
+            self.assertEqual(len(sql_shell.commands), 2)
+            directory.invalidate()
+            functions.get_target_polygons(sql_shell, 'trash_cats', 5,
+                                          lookup_polygon=False)
+            self.assertEqual(len(sql_shell.commands), 3)
+        finally:
+            functions.polygon_directory = original_directory
+
+    def test_set_photos_batch_write_error(self):
+        """ Ошибка записи фото (OSError) возвращается в ответе по этому фото
+        """
+        with unittest.mock.patch.object(
+                functions, 'save_photo_to_store',
+                side_effect=OSError(28, 'No space left on device')):
+            result = methods.set_photos_batch(None, 1, [(b'photo', None)])
+        self.assertTrue(result['status'])
+        photo, = result['info']
+        self.assertFalse(photo['status'])
+        self.assertIn('No space left on device', photo['info'])
+
+    def test_act_unique_index(self):
+        """ ON CONFLICT в команде акта - только при уникальном индексе """
+        index = functions.ActUniqueIndex()
+        sql_shell = test_objects.FakeSqlShell({'count(*)': [(5, 7, 2)]})
+        self.assertFalse(index.check(sql_shell, create=True)['status'])
+        self.assertEqual(sql_shell.executed('CREATE'), [])
+        sql_shell = test_objects.FakeSqlShell()
+        self.assertFalse(index.check(sql_shell)['status'])
+        self.assertEqual(sql_shell.executed('CREATE'), [])
+        self.assertEqual(index.check(sql_shell, create=True)['status'], True)
+        self.assertEqual(len(sql_shell.executed('CREATE')), 1)
+        self.assertTrue(index.present)
+        with unittest.mock.patch.object(functions, 'act_unique_index',
+                                        index):
+            self.assertIn('ON CONFLICT', methods.get_act_command('%s'))
+            index.present = False
+            self.assertNotIn('ON CONFLICT', methods.get_act_command('%s'))
+
+    def test_set_photos_batch_discard(self):
+        """ Фото сбрасываются на диск до регистрации в act_photos, а фото,
+        которые зарегистрировать не удалось, удаляются из хранилища """
+        calls = []
+
+        def try_execute_batch(sql_shell, command, values_list):
+            calls.append(('INSERT', [values[1] for values in values_list]))
+            return [{'status': 'success', 'info': [(11,)]},
+                    {'status': 'failed', 'info': 'duplicate key'}]
+
+        with tempfile.TemporaryDirectory() as photos_dir:
+            store = photo_store.FlatPhotoStore(photos_dir)
+            store.sync = lambda photo_paths: calls.append(('sync',
+                                                           photo_paths))
+            with unittest.mock.patch.object(functions, 'photo_storage',
+                                            store), \
+                    unittest.mock.patch.object(functions,
+                                               'try_execute_batch',
+                                               try_execute_batch):
+                result = methods.set_photos_batch(
+                    test_objects.FakeSqlShell(), 1,
+                    [(b'first', 1), (b'second', 2)])
+            self.assertEqual(result['info'][0], {'status': True, 'info': 11})
+            self.assertFalse(result['info'][1]['status'])
+            (first, synced), (second, inserted) = calls
+            self.assertEqual((first, second), ('sync', 'INSERT'))
+            self.assertEqual(synced, inserted)
+            self.assertEqual([os.path.exists(photo_path)
+                              for photo_path in inserted], [True, False])
+
+    def test_get_photo_range_check(self):
+        """ get_photo отклоняет отрицательное смещение и пустую длину, не
+        обращаясь к GDB """
+        sql_shell = test_objects.FakeSqlShell()
+        for offset, length in ((-1, None), (0, 0), (5, -10)):
+            response = methods.get_photo(sql_shell, 7, offset, length)
+            self.assertFalse(response['status'])
+        self.assertEqual(sql_shell.commands, [])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,62 @@
+""" Тесты жизненного цикла процесса WServer (lifecycle) """
+import threading
+import unittest
+
+from wserver_compound import lifecycle
+
+
+class LifecycleTest(unittest.TestCase):
+    """ Тесты lifecycle. """
+
+    def test_lifecycle_track(self):
+        """ Жизненный цикл: выполняющиеся запросы учитываются, остановка
+        ждет их не дольше drain_timeout, новые запросы отклоняются """
+        life = lifecycle.Lifecycle(drain_timeout=0.1)
+        started = threading.Event()
+        release = threading.Event()
+
+        @life.track
+        def method():
+            started.set()
+            release.wait(5)
+            return {'status': True, 'info': None}
+
+        thread = threading.Thread(target=method)
+        thread.start()
+        started.wait(5)
+        self.assertEqual(life.in_flight, 1)
+        life.request_shutdown()
+        self.assertFalse(method()['status'])
+        self.assertFalse(life.wait_drained())
+        release.set()
+        thread.join(5)
+        self.assertTrue(life.wait_drained())
+        self.assertEqual(life.in_flight, 0)
+
+    def test_lifecycle_cleanup_order(self):
+        """ Жизненный цикл: шаги остановки выполняются по порядку, и
+        проваленный шаг не мешает следующим, но дает код выхода 1 """
+        life = lifecycle.Lifecycle()
+        calls = []
+
+        def failing():
+            calls.append('failing')
+            raise RuntimeError('Сбой шага')
+
+        life.add_cleanup(lambda: calls.append('first'), 'first')
+        life.add_cleanup(failing)
+        life.add_cleanup(lambda: calls.append('unfinished') or False,
+                         'unfinished')
+        life.add_cleanup(lambda: calls.append('last'), 'last')
+        self.assertEqual(life.shutdown(), 1)
+        self.assertEqual(calls, ['first', 'failing', 'unfinished', 'last'])
+        self.assertTrue(life.is_shutting_down())
+
+        life = lifecycle.Lifecycle()
+        life.add_cleanup(lambda: True, 'done')
+        life.request_shutdown()
+        self.assertEqual(life.run(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
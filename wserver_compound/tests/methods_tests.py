@@ -38,6 +38,21 @@ class FunctionsTest(unittest.TestCase):
         #methods.delete_record(test_sql_shell, 'id', response['info'],
         #                      'records')
 
+    def test_set_acts(self):
+        """ Тестирование пакетного добавления актов """
+        act = {'auto_id': 466961, 'gross': 13000, 'tare': 8000,
+               'cargo': 5000, 'time_in': '2021.08.24 14:33:39',
+               'time_out': '2099.08.24 21:22:19', 'carrier_id': None,
+               'trash_cat_id': 4, 'trash_type_id': 4, 'polygon_id': 1,
+               'operator': 22, 'ex_id': 1488}
+        response = methods.set_acts(test_sql_shell, [act, {'gross': 1}, act])
+        self.assertTrue(response['status'] and len(response['info']) == 3)
+        self.assertTrue(response['info'][0]['status'] and
+                        isinstance(response['info'][0]['info'], int))
+        self.assertFalse(response['info'][1]['status'])
+        self.assertTrue(response['info'][2]['info'] >
+                        response['info'][0]['info'])
+
     def test_set_photo(self):
         """ Тесты сохранения фотографии на винте """
         photo_obj = functions.encode_photo(settings.TEST_PHOTO)
@@ -48,6 +63,50 @@ class FunctionsTest(unittest.TestCase):
         methods.delete_record(test_sql_shell, 'id', result['info'],
                               'act_photos')
 
+    def test_set_photo_bytes(self):
+        """ Тесты сохранения фотографии в двоичном виде, целиком и частями
+        """
+        with open(settings.TEST_PHOTO, 'rb') as fobj:
+            photo_data = fobj.read()
+        result = methods.set_photo_bytes(test_sql_shell, None, photo_data,
+                                         None)
+        self.assertTrue(result['status'] and isinstance(result['info'], int))
+        methods.delete_record(test_sql_shell, 'id', result['info'],
+                              'act_photos')
+        upload_id = methods.open_photo_upload(test_sql_shell, None,
+                                              None)['info']
+        middle = len(photo_data) // 2
+        methods.upload_photo_chunk(test_sql_shell, upload_id,
+                                   photo_data[:middle], 0)
+        response = methods.upload_photo_chunk(test_sql_shell, upload_id,
+                                              photo_data[:middle], 0)
+        self.assertFalse(response['status'])
+        response = methods.upload_photo_chunk(test_sql_shell, upload_id,
+                                              photo_data[middle:], middle)
+        self.assertEqual(response['info'], len(photo_data))
+        result = methods.finish_photo_upload(test_sql_shell, upload_id)
+        self.assertTrue(result['status'] and isinstance(result['info'], int))
+        methods.delete_record(test_sql_shell, 'id', result['info'],
+                              'act_photos')
+        result = methods.finish_photo_upload(test_sql_shell, upload_id)
+        self.assertFalse(result['status'])
+
+    def test_set_photos_batch(self):
+        """ Сохранение нескольких фото заезда за один вызов """
+        with open(settings.TEST_PHOTO, 'rb') as fobj:
+            photo_data = fobj.read()
+        photo_obj = str(functions.encode_photo(settings.TEST_PHOTO))
+        result = methods.set_photos_batch(
+            test_sql_shell, None, [(photo_data, None), (photo_obj, None),
+                                   ("b'not base64'", None)])
+        self.assertTrue(result['status'])
+        first, second, broken = result['info']
+        self.assertTrue(first['status'] and second['status'])
+        self.assertFalse(broken['status'])
+        for photo in (first, second):
+            methods.delete_record(test_sql_shell, 'id', photo['info'],
+                                  'act_photos')
+
     def test_add_note(self):
         """ Тестирование добавления комментария к заезду """
         result = methods.add_operator_notes(test_sql_shell, None, 'TEST_NOTE',
@@ -197,6 +256,14 @@ class FunctionsTest(unittest.TestCase):
         print(response)
 
 
+    def test_wta_outbox(self):
+        """ Просмотр и повтор очереди доставки данных на полигоны """
+        response = methods.get_wta_outbox(test_sql_shell, limit=10)
+        self.assertTrue(response['status'] and
+                        'entries' in response['info'])
+        response = methods.replay_wta_outbox(test_sql_shell, outbox_id=0)
+        self.assertTrue(response['status'] and not response['info'])
+
     def test_check_legit(self):
         response = methods.check_legit(test_sql_shell, 'f4:6d:04:40:0a:fa')
         print(response)
@@ -0,0 +1,77 @@
+""" Тесты обработки хранимых фото (photo_pipeline) """
+import datetime
+import os
+import tempfile
+import unittest
+
+from wserver_compound import photo_pipeline
+from wserver_compound import photo_store
+from wserver_compound import settings
+from wserver_compound.tests import test_objects
+
+
+class PhotoPipelineTest(unittest.TestCase):
+    """ Тесты photo_pipeline. """
+
+    @unittest.skipIf(photo_pipeline.Image is None, 'Pillow не установлен')
+    def test_photo_pipeline_reencode(self):
+        """ Перекодирование и уменьшение фото """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pipeline = photo_pipeline.PhotoPipeline(
+                None, None, os.path.join(tmp_dir, 'checkpoint.json'),
+                transcode_after_days=30, image_format='WEBP',
+                downscale_after_days=90, max_side=100)
+        with open(settings.TEST_PHOTO, 'rb') as fobj:
+            photo_data = fobj.read()
+        transcoded = pipeline.reencode(photo_data)
+        self.assertTrue(len(transcoded) < len(photo_data))
+        self.assertIsNone(pipeline.reencode(transcoded))
+        image = photo_pipeline.Image.open(
+            photo_pipeline.io.BytesIO(pipeline.reencode(photo_data, True)))
+        self.assertEqual((image.format, max(image.size)), ('WEBP', 100))
+
+    @unittest.skipIf(photo_pipeline.Image is None, 'Pillow не установлен')
+    def test_photo_pipeline_reencode_photo(self):
+        """ Перекодированное фото сбрасывается на диск до перевода на него
+        записи; если запись за это время изменили, новое фото удаляется, а
+        старое остается """
+        with open(settings.TEST_PHOTO, 'rb') as fobj:
+            photo_data = fobj.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = photo_store.ShardedPhotoStore(tmp_dir)
+            photo_path = store.save(1, photo_data)
+            synced = []
+            store.sync = synced.append
+            for rows, replaced in (([(1,)], True), ([], False)):
+                sql_shell = test_objects.FakeSqlShell({'UPDATE': rows})
+                pipeline = photo_pipeline.PhotoPipeline(
+                    sql_shell, store, os.path.join(tmp_dir, 'checkpoint'),
+                    blob_min_age=0)
+                self.assertEqual(pipeline.reencode_photo(7, photo_path, 1),
+                                 replaced)
+                new_path = sql_shell.executed('UPDATE')[0][0]
+                self.assertEqual(synced[-1], [new_path])
+                self.assertEqual(os.path.exists(new_path), replaced)
+                self.assertEqual(os.path.exists(photo_path), not replaced)
+                if replaced:
+                    photo_path = store.save(1, photo_data)
+
+    def test_photo_pipeline_checkpoint(self):
+        """ Контрольная точка обхода фото: прежний формат [time_in, id]
+        читается без догоняющего обхода """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoint_path = os.path.join(tmp_dir, 'checkpoint.json')
+            with open(checkpoint_path, 'w') as fobj:
+                fobj.write('{"delete": ["2021-01-01T00:00:00", 7]}')
+            pipeline = photo_pipeline.PhotoPipeline(
+                None, None, checkpoint_path, retention_days=30)
+            self.assertEqual(pipeline.get_stage_checkpoint('delete'),
+                             {'position': ['2021-01-01T00:00:00', 7],
+                              'max_id': None})
+            self.assertEqual(pipeline.get_stage_checkpoint('transcode'),
+                             {'position': [datetime.datetime.min.isoformat(),
+                                           0], 'max_id': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
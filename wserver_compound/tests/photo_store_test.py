@@ -0,0 +1,160 @@
+""" Тесты хранилищ фото (photo_store) """
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from wserver_compound import photo_store
+from wserver_compound.tests import test_objects
+
+
+class PhotoStoreTest(unittest.TestCase):
+    """ Тесты хранилищ фото и загрузки фото частями. """
+
+    def test_photo_uploads(self):
+        """ Загрузка фото частями: части не по порядку отклоняются,
+        параллельные части одного сеанса не перемешиваются """
+        photo = bytes(range(256)) * 64
+        chunks = [(offset, photo[offset:offset + 512])
+                  for offset in range(0, len(photo), 512)]
+        with tempfile.TemporaryDirectory() as photos_dir:
+            uploads = photo_store.PhotoUploads(
+                photo_store.ShardedPhotoStore(photos_dir))
+            upload_id = uploads.open(1, 1)
+            with self.assertRaises(photo_store.UploadOffsetMismatch):
+                uploads.write(upload_id, chunks[1][1], chunks[1][0])
+
+            def send(offset, chunk):
+                # Клиент повторяет часть, пока до нее не дойдет очередь
+                while True:
+                    try:
+                        return uploads.write(upload_id, chunk, offset)
+                    except photo_store.UploadOffsetMismatch:
+                        time.sleep(0.001)
+
+            threads = [threading.Thread(target=send, args=chunk)
+                       for chunk in reversed(chunks)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+            _, photo_path, _ = uploads.finish(upload_id)
+            with open(photo_path, 'rb') as fobj:
+                self.assertEqual(fobj.read(), photo)
+            with self.assertRaises(photo_store.UploadNotFound):
+                uploads.write(upload_id, b'late', len(photo))
+
+    def test_sharded_photo_store(self):
+        """ Хранилище по содержимому: одинаковые фото хранятся один раз """
+        with tempfile.TemporaryDirectory() as photos_dir:
+            store = photo_store.ShardedPhotoStore(photos_dir)
+            first_path = store.save(1, b'photo')
+            second_path = store.save(2, b'photo')
+            other_path = store.save(3, b'other photo')
+            self.assertEqual(first_path, second_path)
+            self.assertNotEqual(first_path, other_path)
+            self.assertTrue(first_path.startswith(photos_dir))
+            with store.open_photo(first_path) as fobj:
+                self.assertEqual(fobj.read(), b'photo')
+            self.assertEqual(store.get_stats(),
+                             {'writes': 3, 'deduplicated': 1})
+            self.assertFalse(os.listdir(store.tmp_dir))
+
+    def test_sharded_photo_store_remove(self):
+        """ Файл фото, который только что переиспользовали при сохранении
+        такого же фото, не удаляется """
+        with tempfile.TemporaryDirectory() as photos_dir:
+            store = photo_store.ShardedPhotoStore(photos_dir)
+            photo_path = store.save(1, b'photo')
+            old = time.time() - 7200
+            os.utime(photo_path, (old, old))
+            self.assertEqual(store.save(2, b'photo'), photo_path)
+            self.assertFalse(store.remove(photo_path, min_age=3600))
+            self.assertTrue(os.path.exists(photo_path))
+            os.utime(photo_path, (old, old))
+            self.assertTrue(store.remove(photo_path, min_age=3600))
+            self.assertEqual(os.listdir(os.path.dirname(photo_path)), [])
+            self.assertEqual(store.save(3, b'photo'), photo_path)
+            with store.open_photo(photo_path) as fobj:
+                self.assertEqual(fobj.read(), b'photo')
+
+    def test_pack_photo_store(self):
+        """ Хранилище в пачках: фото дописываются в пачки, новая пачка
+        начинается после segment_size """
+        with tempfile.TemporaryDirectory() as photos_dir:
+            store = photo_store.PackPhotoStore(photos_dir, segment_size=10)
+            photos = [b'first photo', b'second', b'third']
+            photo_paths = [store.save(1, photo) for photo in photos]
+            self.assertTrue(all(photo_path.startswith(photo_store.PACK_PREFIX)
+                                for photo_path in photo_paths))
+            self.assertEqual(len(os.listdir(store.packs_dir)), 2)
+            for photo, photo_path in zip(photos, photo_paths):
+                with store.open_photo(photo_path) as fobj:
+                    self.assertEqual(fobj.read(), photo)
+            store.close()
+
+    def test_pack_photo_store_compact(self):
+        """ Уплотнение не трогает недавно дописанные пачки: строки
+        act_photos для их фото могут быть еще не вставлены """
+        with tempfile.TemporaryDirectory() as photos_dir:
+            store = photo_store.PackPhotoStore(photos_dir, segment_size=10)
+            store.save(1, b'first photo')
+            store.save(1, b'second')
+            stats = store.compact(test_objects.FakeSqlShell(),
+                                  min_age=3600)
+            self.assertEqual((stats['segments'], stats['compacted']), (1, 0))
+            self.assertEqual(len(os.listdir(store.packs_dir)), 2)
+            stats = store.compact(test_objects.FakeSqlShell(), min_age=0)
+            self.assertEqual(stats['compacted'], 1)
+            self.assertEqual(len(os.listdir(store.packs_dir)), 1)
+            store.close()
+
+    def test_pack_photo_store_compact_sync(self):
+        """ Живые фото уплотняемой пачки сбрасываются на диск до фиксации
+        новых ссылок на них """
+        with tempfile.TemporaryDirectory() as photos_dir:
+            store = photo_store.PackPhotoStore(photos_dir, segment_size=10)
+            store.save(1, b'dead')
+            photo_path = store.save(1, b'live photo')
+            store.save(1, b'second')
+            sql_shell = test_objects.FakeSqlShell(
+                {'SELECT': [(7, photo_path)]})
+            synced = []
+            sync = store.sync
+            store.sync = lambda paths: synced.append(
+                (paths, len(sql_shell.commands))) or sync(paths)
+            stats = store.compact(sql_shell, min_live_ratio=1, min_age=0)
+            self.assertEqual(stats['photos_moved'], 1)
+            new_path = sql_shell.executed('UPDATE')[0][0]
+            with store.open_photo(new_path) as fobj:
+                self.assertEqual(fobj.read(), b'live photo')
+            self.assertEqual(synced, [([new_path], 2)])
+            self.assertEqual(sql_shell.commands[2][0], 'COMMIT')
+            store.close()
+
+    def test_photo_store_read_range(self):
+        """ Чтение части фото из файла и из пачки, кэш фото """
+        with tempfile.TemporaryDirectory() as photos_dir:
+            photo = bytes(range(256)) * 4
+            for store in (photo_store.ShardedPhotoStore(photos_dir),
+                          photo_store.PackPhotoStore(photos_dir)):
+                store.save(1, b'another photo')
+                photo_path = store.save(1, photo)
+                self.assertEqual(store.read_range(photo_path, 100, 50),
+                                 (photo[100:150], len(photo)))
+                self.assertEqual(store.read_range(photo_path, 1000),
+                                 (photo[1000:], len(photo)))
+                self.assertEqual(store.read_range(photo_path, 2000),
+                                 (b'', len(photo)))
+        cache = photo_store.PhotoCache(max_bytes=10, max_photo_size=6)
+        cache.put('first', b'12345')
+        cache.put('big', b'1234567')
+        cache.put('second', b'123456')
+        self.assertIsNone(cache.get('first'))
+        self.assertIsNone(cache.get('big'))
+        self.assertEqual(cache.get('second'), b'123456')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+""" Тесты фоновой записи фото (photo_writer) """
+import unittest
+
+from wserver_compound import photo_writer
+from wserver_compound.tests import test_objects
+
+
+class FakePhotoStore:
+    """ Хранилище фото в памяти для тестов фоновой записи. """
+
+    def __init__(self):
+        self.photos = {}
+        self.paths = []
+        self.syncs = []
+
+    def write_with(self, record, fill, suffix='.png'):
+        data = []
+        fill(data)
+        path = '{}_{}{}'.format(record, len(self.paths), suffix)
+        self.photos[path] = b''.join(data)
+        self.paths.append(path)
+        return path
+
+    def sync(self, paths):
+        self.syncs.append(list(paths))
+
+
+class PhotoWriterTest(unittest.TestCase):
+    """ Тесты PhotoWriterPool без GDB. """
+
+    def test_photo_writer_batching(self):
+        """ Фоновая запись фото: пачки не больше batch_size, один sync и
+        один INSERT на пачку, остановка дописывает очередь """
+        store = FakePhotoStore()
+        sql_shell = test_objects.FakeSqlShell()
+        writer_pool = photo_writer.PhotoWriterPool(
+            sql_shell, store, workers=1, batch_size=3, flush_interval=0.2)
+        photo_ids = [writer_pool.submit(1, None,
+                                        lambda writer: writer.append(b'p'))
+                     for _ in range(5)]
+        self.assertEqual(photo_ids, [1, 2, 3, 4, 5])
+        writer_pool.start()
+        writer_pool.stop(5)
+        self.assertEqual(writer_pool.threads, [])
+        self.assertEqual([len(paths) for paths in store.syncs], [3, 2])
+        self.assertEqual([row[0] for row in sql_shell.inserted], photo_ids)
+        for photo_id in photo_ids:
+            self.assertEqual(writer_pool.get_status(photo_id)['state'],
+                             photo_writer.SAVED)
+        self.assertEqual(writer_pool.get_stats()['batches'], 2)
+
+    def test_photo_writer_flush_on_stop(self):
+        """ Фото, поставленное перед остановкой, записывается до ее
+        завершения """
+        store = FakePhotoStore()
+        sql_shell = test_objects.FakeSqlShell()
+        writer_pool = photo_writer.PhotoWriterPool(
+            sql_shell, store, workers=2, flush_interval=0.5)
+        writer_pool.start()
+        photo_id = writer_pool.submit(1, None,
+                                      lambda writer: writer.append(b'p'))
+        writer_pool.stop(5)
+        self.assertEqual(writer_pool.threads, [])
+        self.assertEqual(writer_pool.get_status(photo_id)['state'],
+                         photo_writer.SAVED)
+        self.assertEqual(sql_shell.inserted,
+                         [(photo_id, 1, store.paths[0], None)])
+
+    def test_photo_writer_queue_bytes(self):
+        """ Очередь записи фото ограничена общим объемом фото """
+        store = FakePhotoStore()
+        writer_pool = photo_writer.PhotoWriterPool(
+            test_objects.FakeSqlShell(), store, workers=1, queue_bytes=10)
+        writer_pool.submit(1, None, lambda writer: None, size=6)
+        with self.assertRaises(photo_writer.QueueFull):
+            writer_pool.submit(1, None, lambda writer: None, size=6)
+        self.assertEqual(writer_pool.get_stats()['rejected'], 1)
+        writer_pool.start()
+        writer_pool.stop(5)
+        self.assertEqual(writer_pool.get_stats()['queued_bytes'], 0)
+        # В пустую очередь принимается и фото больше queue_bytes
+        writer_pool.submit(1, None, lambda writer: None, size=20)
+        self.assertEqual(writer_pool.get_stats()['queued_bytes'], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
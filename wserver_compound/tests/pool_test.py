@@ -0,0 +1,104 @@
+""" Тесты пула соединений с GDB (pool) """
+import time
+import unittest
+
+import psycopg2.pool
+
+from wserver_compound import pool
+from wserver_compound.tests import test_objects
+
+
+class FakeConnectionPool(pool.ConnectionPool):
+    """ Пул соединений для тестов без GDB. """
+
+    def connect(self):
+        return test_objects.FakeConnection()
+
+
+class PoolTest(unittest.TestCase):
+    """ Тесты пула соединений без GDB. """
+
+    def test_pool_checkout_timeout(self):
+        """ Пул соединений: если все соединения заняты, getconn ждет не
+        дольше checkout_timeout """
+        connection_pool = FakeConnectionPool(0, 1, checkout_timeout=0.1)
+        conn = connection_pool.getconn()
+        started = time.monotonic()
+        with self.assertRaises(psycopg2.pool.PoolError):
+            connection_pool.getconn()
+        self.assertLess(time.monotonic() - started, 1)
+        connection_pool.putconn(conn)
+        self.assertIs(connection_pool.getconn(), conn)
+        stats = connection_pool.get_stats()
+        self.assertEqual((stats['timeouts'], stats['size']), (1, 1))
+
+    def test_pool_reconnect(self):
+        """ Пул соединений: разорванное соединение заменяется новым """
+        connection_pool = FakeConnectionPool(0, 1, check_interval=0)
+        conn = connection_pool.getconn()
+        connection_pool.putconn(conn)
+        conn.broken = True
+        new_conn = connection_pool.getconn()
+        self.assertIsNot(new_conn, conn)
+        self.assertTrue(conn.closed)
+        stats = connection_pool.get_stats()
+        self.assertEqual((stats['reconnects'], stats['size']), (1, 1))
+
+    def test_pool_idle_expiry(self):
+        """ Пул соединений: свободные соединения сверх minconn закрываются
+        после max_idle секунд простоя """
+        connection_pool = FakeConnectionPool(1, 3, max_idle=0.05)
+        first, second, third = [connection_pool.getconn()
+                                for _ in range(3)]
+        connection_pool.putconn(first)
+        connection_pool.putconn(second)
+        time.sleep(0.1)
+        connection_pool.putconn(third)
+        self.assertTrue(first.closed and second.closed)
+        self.assertFalse(third.closed)
+        stats = connection_pool.get_stats()
+        self.assertEqual((stats['size'], stats['idle']), (1, 1))
+
+    def test_pool_request_scope(self):
+        """ PooledWsqluse: вложенные request_scope работают через одно
+        соединение, которое возвращается в пул на выходе из внешнего """
+        sql_shell = pool.PooledWsqluse('gdb', 'user', 'password', 'host')
+        sql_shell.pool.connect = test_objects.FakeConnection
+        with sql_shell.request_scope():
+            _, outer_conn = sql_shell.get_cursor_conn()
+            with sql_shell.request_scope():
+                _, inner_conn = sql_shell.get_cursor_conn()
+            self.assertIs(inner_conn.conn, outer_conn.conn)
+            self.assertEqual(sql_shell.pool.get_stats()['in_use'], 1)
+        stats = sql_shell.pool.get_stats()
+        self.assertEqual((stats['in_use'], stats['idle'],
+                          stats['checkouts']), (0, 1, 1))
+        self.assertFalse(outer_conn.conn.closed)
+
+    def test_pool_transaction_abort(self):
+        """ PooledWsqluse: ошибка команды внутри transaction (transaction_fail
+        Wsqluse, rollback соединения) откатывает всю транзакцию и доходит
+        до вызывающего, а не откатывается молча на месте """
+        sql_shell = pool.PooledWsqluse('gdb', 'user', 'password', 'host')
+        sql_shell.pool.connect = test_objects.FakeConnection
+        with self.assertRaises(psycopg2.OperationalError):
+            with sql_shell.transaction():
+                _, conn = sql_shell.get_cursor_conn()
+                conn.conn.broken = True
+                sql_shell.try_execute_get('SELECT 1')
+        self.assertEqual(conn.conn.rollbacks, 1)
+        with self.assertRaises(pool.TransactionAborted):
+            with sql_shell.transaction():
+                sql_shell.get_cursor_conn()[1].rollback()
+        self.assertEqual(conn.conn.rollbacks, 2)
+        conn.conn.broken = False
+        with sql_shell.request_scope():
+            cursor, conn = sql_shell.get_cursor_conn()
+            conn.rollback()
+            self.assertEqual(sql_shell.transaction_fail(cursor)['status'],
+                             'failed')
+        self.assertEqual(conn.conn.rollbacks, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+""" Тесты многопроцессного режима WServer (prefork) """
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from wserver_compound import prefork
+
+
+class PreforkTest(unittest.TestCase):
+    """ Тесты prefork. """
+
+    def test_supervisor(self):
+        """ Упавший при старте обработчик перезапускается, по остановке
+        супервизор завершает обработчиков """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            starts_path = os.path.join(tmp_dir, 'starts')
+
+            def worker_target():
+                with open(starts_path, 'a') as fobj:
+                    fobj.write('{}\n'.format(os.getpid()))
+                with open(starts_path) as fobj:
+                    if len(fobj.readlines()) == 1:
+                        raise RuntimeError('Сбой при старте')
+                time.sleep(30)
+                return 0
+
+            def count_starts():
+                if not os.path.exists(starts_path):
+                    return 0
+                with open(starts_path) as fobj:
+                    return len(fobj.readlines())
+
+            supervisor = prefork.Supervisor(1, worker_target,
+                                            restart_delay=0.1)
+
+            def stop_after_restart():
+                deadline = time.monotonic() + 10
+                while count_starts() < 2 and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                supervisor.request_shutdown()
+
+            handlers = (signal.getsignal(signal.SIGTERM),
+                        signal.getsignal(signal.SIGINT))
+            stopper = threading.Thread(target=stop_after_restart)
+            stopper.start()
+            try:
+                exit_code = supervisor.run()
+            finally:
+                stopper.join()
+                signal.signal(signal.SIGTERM, handlers[0])
+                signal.signal(signal.SIGINT, handlers[1])
+            self.assertEqual(count_starts(), 2)
+            self.assertEqual(supervisor.children, {})
+            # Второй обработчик остановлен по SIGTERM
+            self.assertEqual(exit_code, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
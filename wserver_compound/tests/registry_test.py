@@ -0,0 +1,52 @@
+""" Тесты реестра методов API (registry) """
+import unittest
+
+from wserver_compound import registry
+
+
+class RegistryTest(unittest.TestCase):
+    """ Тесты MethodRegistry. """
+
+    def test_method_registry(self):
+        """ Проверка и приведение аргументов методов API по реестру """
+        api = registry.MethodRegistry()
+
+        class Core:
+            @api.method('set_cat')
+            def set_trash_cat(self, name: str, polygon: int,
+                              active: bool = True):
+                return {'status': True, 'info': (name, polygon, active)}
+
+            @api.method()
+            def get_stats(self, *args, **kwargs):
+                return {'status': True, 'info': kwargs}
+
+        methods = api.bind(Core())
+        self.assertEqual(methods['set_cat']['method'](
+            name='Cat', polygon='9', active='false', connection=None)['info'],
+            ('Cat', 9, False))
+        self.assertFalse(methods['set_cat']['method'](
+            name='Cat', polygon='x')['status'])
+        self.assertEqual(methods['set_cat']['method'](
+            name=7, polygon=9.0)['info'], ('7', 9, True))
+        for name, polygon in (('Cat', 9.5), ('Cat', True), ('Cat', [9]),
+                              (['Cat'], 9), ({'name': 'Cat'}, 9)):
+            response = methods['set_cat']['method'](name=name,
+                                                    polygon=polygon)
+            self.assertFalse(response['status'])
+            self.assertIn('должен быть', response['info'])
+        response = methods['set_cat']['method'](name='Cat')
+        self.assertFalse(response['status'])
+        self.assertIn('polygon', response['info'])
+        self.assertEqual(methods['get_stats']['method'](
+            connection=None)['info'], {'connection': None})
+        catalog = api.get_catalog()
+        self.assertEqual([method['name'] for method in catalog],
+                         ['set_cat', 'get_stats'])
+        self.assertEqual(catalog[0]['params'][2],
+                         {'name': 'active', 'type': 'bool',
+                          'required': False, 'default': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
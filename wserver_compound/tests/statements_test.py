@@ -0,0 +1,53 @@
+""" Тесты подготавливаемых команд (statements) """
+import unittest
+
+from wserver_compound import pool
+from wserver_compound import statements
+from wserver_compound.tests import test_objects
+
+
+class StatementsTest(unittest.TestCase):
+    """ Тесты statements без GDB. """
+
+    def test_statement_text(self):
+        """ Подготавливаемая команда: тексты PREPARE и EXECUTE """
+        statement = statements.Statement(
+            'test', "SELECT id FROM auto WHERE car_number = %s AND "
+                    "polygon = %s")
+        self.assertTrue(statement.prepared_name.startswith('wserver_test_'))
+        self.assertEqual(statement.prepare_command,
+                         'PREPARE {} AS SELECT id FROM auto WHERE '
+                         'car_number = $1 AND polygon = $2'.format(
+                             statement.prepared_name))
+        self.assertEqual(statement.execute_command,
+                         'EXECUTE {} (%s, %s)'.format(
+                             statement.prepared_name))
+        no_params = statements.Statement('test', 'SELECT 1')
+        self.assertEqual(no_params.execute_command,
+                         'EXECUTE {}'.format(no_params.prepared_name))
+        self.assertNotEqual(no_params.prepared_name, statement.prepared_name)
+
+    def test_statement_execute(self):
+        """ Подготавливаемая команда: на соединении из пула PREPARE
+        выполняется один раз, на обычном соединении - сама команда """
+        statement = statements.Statement('test', 'SELECT %s')
+        sql_shell = test_objects.FakeSqlShell()
+        cursor, conn = sql_shell.get_cursor_conn()
+        statement.execute(cursor, conn, (1,))
+        self.assertEqual(sql_shell.commands, [('SELECT %s', (1,))])
+        sql_shell = test_objects.FakeSqlShell()
+        cursor, _ = sql_shell.get_cursor_conn()
+        conn = pool.BorrowedConnection(test_objects.FakeConnection())
+        statement.execute(cursor, conn, (1,))
+        statement.execute(cursor, conn, (2,))
+        self.assertEqual(sql_shell.commands, [
+            (statement.prepare_command, None),
+            (statement.execute_command, (1,)),
+            (statement.execute_command, (2,))])
+        self.assertEqual(statement.get_stats(),
+                         {'executions': 3, 'prepared_executions': 2,
+                          'prepares': 1, 'errors': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
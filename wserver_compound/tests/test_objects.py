@@ -1,6 +1,141 @@
 """ Модуль содержит разнообразные объекты для тестов, например, WSQLuse """
+import itertools
 
+import psycopg2
+import psycopg2.extensions
 from wsqluse.wsqluse import Wsqluse
 
 
 test_sql_shell = Wsqluse('gdb', 'watchman', 'hect0r1337', '192.168.100.118')
+
+
+class FakeCursor:
+    """ Курсор FakeSqlShell: команды записываются в shell.commands,
+    выборки возвращают строки из shell.results. """
+
+    def __init__(self, shell):
+        self.shell = shell
+        self.connection = shell
+        self.page = []
+        self.records = []
+        self.rowcount = -1
+
+    def mogrify(self, template, args):
+        # Строка VALUES многострочного запроса (psycopg2 execute_values)
+        self.page.append(tuple(args))
+        return template
+
+    def execute(self, command, values=None):
+        if isinstance(command, bytes):
+            command = command.decode()
+        self.shell.commands.append((command, values))
+        if self.page:
+            # INSERT ... VALUES %s RETURNING id - вернуть первые значения
+            # строк
+            self.shell.inserted.extend(self.page)
+            self.records = [(row[0],) for row in self.page]
+            self.page = []
+        elif 'nextval' in command:
+            self.records = [(next(self.shell.ids),)]
+        else:
+            self.records = self.shell.fetch(command, values)
+        self.rowcount = len(self.records)
+
+    def fetchall(self):
+        return list(self.records)
+
+    def fetchone(self):
+        return self.records[0] if self.records else None
+
+    def close(self):
+        pass
+
+
+class FakeSqlShell:
+    """ Заменитель WSQLuse для тестов без GDB. Все команды (и фиксации
+    транзакций - как 'COMMIT') записываются в commands. Выборка возвращает
+    строки первого ключа results, который входит в текст команды; значение
+    может быть функцией f(command, values). На nextval возвращается
+    следующий ID, строки INSERT ... VALUES %s запоминаются в inserted. """
+
+    encoding = 'UTF8'
+
+    def __init__(self, results=None):
+        """
+        Инициализация.
+
+        :param results: {часть текста команды: строки результата}.
+        """
+        self.results = results or {}
+        self.commands = []
+        self.inserted = []
+        self.ids = itertools.count(1)
+
+    def fetch(self, command, values=None):
+        for part, rows in self.results.items():
+            if part in command:
+                return rows(command, values) if callable(rows) else rows
+        return []
+
+    def executed(self, keyword):
+        """ Вернуть значения всех выполненных команд, которые начинаются со
+        слова keyword (SELECT, UPDATE, COMMIT...). """
+        return [values for command, values in self.commands
+                if command.split()[0] == keyword]
+
+    def get_cursor_conn(self):
+        return FakeCursor(self), self
+
+    def try_execute_get(self, command):
+        self.commands.append((command, None))
+        return self.fetch(command)
+
+    def commit(self):
+        self.commands.append(('COMMIT', None))
+
+    def rollback(self):
+        self.commands.append(('ROLLBACK', None))
+
+    def close(self):
+        pass
+
+    def transaction_fail(self, cursor):
+        self.rollback()
+        return {'status': 'failed', 'info': 'Ошибка транзакции'}
+
+
+class FakeConnection:
+    """ Соединение psycopg2 для тестов пула без GDB. Если broken, запросы
+    проваливаются, как на разорванном соединении. """
+
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.autocommit = False
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeConnectionCursor(self)
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeConnectionCursor:
+    """ Курсор FakeConnection. """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, command, values=None):
+        if self.conn.broken:
+            raise psycopg2.OperationalError('server closed the connection')
@@ -0,0 +1,151 @@
+""" Тесты клиентов полигонов (wta_clients) """
+import concurrent.futures
+import socket
+import threading
+import time
+import unittest
+
+from wserver_compound import wta_clients
+
+
+class WTAClientsTest(unittest.TestCase):
+    """ Тесты клиентов полигонов, склейки доставок и приостановки доставок. """
+
+    def test_polygon_client(self):
+        """ Клиент полигона: замена разорванного простаивающего соединения
+        и отказ от повтора запроса, который уже ушел на полигон """
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        # Что делать с очередным запросом: ответить и закрыть соединение,
+        # ответить, закрыть без ответа
+        actions = ['reply-close', 'reply', 'close']
+        requests = []
+
+        def serve():
+            while actions:
+                conn, _ = server.accept()
+                with conn:
+                    while actions:
+                        request = conn.recv(7)
+                        if not request:
+                            break
+                        requests.append(request)
+                        action = actions.pop(0)
+                        if action == 'close':
+                            break
+                        conn.sendall(b'ok')
+                        if action == 'reply-close':
+                            break
+
+        class FakeWTAS:
+            sock = None
+
+        class Client(wta_clients.PolygonClient):
+            def get_operators(self, data_type):
+                return FakeWTAS(), None
+
+            def send(self, wtas, wtadb, wserver_id, payload):
+                wtas.sock.sendall(b'request')
+                if not wtas.sock.recv(2):
+                    raise ConnectionResetError
+                return {'wserver_id': wserver_id}
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        client = Client(None, 9, timeout=5)
+        client.address = server.getsockname()
+        try:
+            self.assertEqual(client.deliver('auto', 1, {}), {'wserver_id': 1})
+            time.sleep(0.1)
+            self.assertEqual(client.deliver('auto', 2, {}), {'wserver_id': 2})
+            self.assertEqual(client.connects, 2)
+            with self.assertRaises(ConnectionResetError):
+                client.deliver('auto', 3, {})
+            self.assertEqual(len(requests), 3)
+            self.assertEqual(client.connects, 2)
+            self.assertIsNone(client.sock)
+        finally:
+            client.close()
+            server.close()
+        thread.join(1)
+
+        pool = wta_clients.WTAClientPool(max_idle=0.05)
+        idle, other = socket.socketpair()
+        pool.clients[9] = client
+        client.sock = wta_clients.TrackedSocket(idle)
+        client.last_used = time.monotonic() - 1
+        pool.evict_idle()
+        self.assertIsNone(client.sock)
+        self.assertEqual(pool.evicted, 1)
+        other.close()
+
+    def test_delivery_coalescer(self):
+        """ Склейка изменений одной записи перед доставкой """
+        delivered = []
+
+        def deliver(sql_shell, data_type, polygon, wserver_id, payload):
+            delivered.append((data_type, polygon, wserver_id, payload))
+            return {'success_save': True}
+
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        coalescer = wta_clients.DeliveryCoalescer(deliver, executor,
+                                                  window=0.2)
+        self.assertFalse(coalescer.submit(
+            None, 'auto_upd', [9], 5,
+            {'auto_id': 5, 'new_car_number': 'A1', 'new_rg_weight': None}))
+        self.assertTrue(coalescer.submit(
+            None, 'auto_upd', [9], 5,
+            {'auto_id': 5, 'new_car_number': None, 'new_rg_weight': 100}))
+        coalescer.submit(None, 'auto_upd', [9], 6, {'auto_id': 6})
+        self.assertTrue(coalescer.flush(5))
+        self.assertEqual(delivered, [
+            ('auto_upd', 9, 5, {'auto_id': 5, 'new_car_number': 'A1',
+                                'new_rg_weight': 100}),
+            ('auto_upd', 9, 6, {'auto_id': 6})])
+        stats = coalescer.get_stats()
+        self.assertEqual((stats['superseded'], stats['delivered']), (1, 2))
+        self.assertIsNone(coalescer.submit(None, 'auto_upd', [9], 5, {}))
+        executor.shutdown()
+
+    def test_delivery_coalescer_flush_timeout(self):
+        """ Остановка склейки не ждет зависшую доставку дольше timeout """
+        release = threading.Event()
+
+        def deliver(sql_shell, data_type, polygon, wserver_id, payload):
+            release.wait(5)
+            return {'success_save': True}
+
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        coalescer = wta_clients.DeliveryCoalescer(deliver, executor,
+                                                  window=10)
+        coalescer.submit(None, 'auto_upd', [9, 10], 5, {'auto_id': 5})
+        started = time.monotonic()
+        self.assertFalse(coalescer.flush(0.2))
+        self.assertLess(time.monotonic() - started, 2)
+        release.set()
+        executor.shutdown()
+        self.assertEqual(coalescer.get_stats()['delivered'], 2)
+
+    def test_circuit_breaker(self):
+        """ Приостановка доставок на недоступный полигон """
+        breaker = wta_clients.CircuitBreaker(failure_threshold=2,
+                                             reset_timeout=0.1)
+        breaker.record_failure(ConnectionRefusedError())
+        self.assertTrue(breaker.allow())
+        breaker.record_failure(ConnectionRefusedError())
+        self.assertFalse(breaker.allow())
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure(ConnectionRefusedError())
+        self.assertEqual(breaker.get_stats()['state'], wta_clients.OPEN)
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.get_stats()['state'], wta_clients.CLOSED)
+        self.assertTrue(breaker.allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+""" Тесты доставки через wta_outbox """
+import time
+import unittest
+import unittest.mock
+
+import psycopg2
+
+from wserver_compound import functions
+from wserver_compound import wta_outbox
+from wserver_compound.tests import test_objects
+
+
+class WTAOutboxTest(unittest.TestCase):
+    """ Тесты OutboxDispatcher без GDB. """
+
+    def test_outbox_dispatcher(self):
+        """ Доставка пачки wta_outbox: склейка строк одной записи, порядок
+        строк полигона, откладывание всех строк полигона после неудачи """
+        entries = [(1, 'companies', 9, 5, '{"name": "old", "inn": "1"}'),
+                   (2, 'companies', 1, 7, '{"name": "x"}'),
+                   (3, 'companies', 9, 6, '{"name": "other"}'),
+                   (4, 'companies', 9, 5, '{"name": "new", "inn": null}'),
+                   (5, 'companies', 1, 8, '{"name": "y"}')]
+        sql_shell = test_objects.FakeSqlShell({'SELECT': entries})
+        calls = []
+
+        def deliver_to_polygon(sql_shell, data_type, polygon, wserver_id,
+                               payload):
+            calls.append((polygon, wserver_id, payload))
+            if polygon == 1:
+                return {'ar_deliver_status': False, 'error_info': 'down'}
+            return {'success_save': True}
+
+        original_deliver = functions.deliver_to_polygon
+        functions.deliver_to_polygon = deliver_to_polygon
+        try:
+            dispatcher = wta_outbox.OutboxDispatcher(sql_shell)
+            self.assertEqual(dispatcher.process_batch(), 5)
+        finally:
+            functions.deliver_to_polygon = original_deliver
+        self.assertEqual(
+            [call for call in calls if call[0] == 9],
+            [(9, 5, {'name': 'new', 'inn': '1'}), (9, 6, {'name': 'other'})])
+        self.assertEqual([call[1] for call in calls if call[0] == 1], [7])
+        lease, postpone = sql_shell.executed('UPDATE')
+        self.assertEqual(lease[1], [1, 2, 3, 4, 5])
+        self.assertEqual(postpone[-2:], ('down', [2, 5]))
+        self.assertEqual(sql_shell.executed('DELETE'), [([1, 4, 3],)])
+        # Аренда фиксируется до доставки, итоги - отдельной транзакцией
+        self.assertEqual([command for command, _ in sql_shell.commands
+                          if command == 'COMMIT'], ['COMMIT', 'COMMIT'])
+        self.assertEqual(sql_shell.commands[1][0].split()[0], 'UPDATE')
+        self.assertEqual(sql_shell.commands[2][0], 'COMMIT')
+        self.assertEqual(sql_shell.commands[-1][0], 'COMMIT')
+        self.assertEqual(dispatcher.get_stats()['superseded'], 1)
+        self.assertEqual(dispatcher.get_stats()['failed'], 2)
+
+    def test_outbox_dead_letter(self):
+        """ Строка с постоянной ошибкой или испорченными данными помечается
+        dead и не задерживает следующие строки полигона; доставки, не
+        начатые до конца половины аренды, возвращаются в очередь """
+        dispatcher = wta_outbox.OutboxDispatcher(None, max_attempts=3)
+        deliveries = dispatcher.coalesce(
+            [(1, 'auto', 9, 5, '{"car_number": "A1"}'),
+             (2, 'auto', 9, 6, '{broken'),
+             (3, 'auto', 9, 7, '{"car_number": "B2"}'),
+             (4, 'auto', 9, 8, '{"car_number": "C3"}')])
+
+        def deliver_to_polygon(sql_shell, data_type, polygon, wserver_id,
+                               payload):
+            if wserver_id == 5:
+                return {'ar_deliver_status': False, 'permanent': True,
+                        'error_info': 'NoWdbId'}
+            return {'success_save': True}
+
+        with unittest.mock.patch.object(functions, 'deliver_to_polygon',
+                                        deliver_to_polygon):
+            result = dispatcher.deliver_polygon(deliveries)
+            self.assertEqual(result['dead'], [1, 2])
+            self.assertEqual(result['delivered'], [[3], [4]])
+            self.assertEqual(result['postponed'], [])
+            result = dispatcher.deliver_polygon(deliveries[2:],
+                                                time.monotonic() - 1)
+            self.assertEqual(result['released'], [3, 4])
+            self.assertEqual(result['delivered'], [])
+        sql_shell = test_objects.FakeSqlShell()
+        dispatcher.postpone(sql_shell.get_cursor_conn()[0], [3, 4], 'down')
+        self.assertEqual(sql_shell.executed('UPDATE'),
+                         [(10, 3, 3600, 3, 3, 'down', [3, 4])])
+
+    def test_outbox_mainloop_errors(self):
+        """ Любая ошибка пачки не останавливает обработчика """
+        dispatcher = wta_outbox.OutboxDispatcher(None, poll_interval=0)
+        errors = [KeyError('data_type'), psycopg2.OperationalError()]
+
+        def process_batch():
+            if errors:
+                raise errors.pop()
+            dispatcher.stop_event.set()
+            return 0
+
+        dispatcher.process_batch = process_batch
+        dispatcher.mainloop()
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,579 @@
+""" Модуль содержит пул клиентов доставки данных на полигоны (WTA).
+
+wtas.operators.WTA на каждую доставку заново читает wta_connection_info,
+открывает новое соединение с GCore полигона и новые соединения с GDB для
+отчетов об отправке. WTAClientPool держит по одному клиенту на полигон:
+адрес GCore читается один раз, соединение с ним открывается при первой
+доставке и используется всеми доставками и всеми видами данных, а отчеты
+об отправке пишутся через соединения sql_shell (пул WServer). Соединения,
+простаивающие дольше max_idle секунд, закрываются, а разорванное
+соединение открывается заново при следующей доставке. Полигон, на
+который доставки раз за разом не проходят, временно исключается из доставки
+(CircuitBreaker), чтобы не тратить на него время каждого запроса.
+
+DeliveryCoalescer склеивает частые изменения одной записи (например,
+несколько update_auto подряд при синхронизации с 1С), чтобы на полигоны
+ушло только ее итоговое состояние. """
+import collections
+import concurrent.futures
+import select
+import socket
+import threading
+import time
+import traceback
+
+from wtas import functions as wtas_functions
+from wtas import main as wtas_main
+from wtas.operators import GetOperator
+
+
+class NoConnectionInfo(LookupError):
+    """ В wta_connection_info нет адреса полигона. """
+
+    def __init__(self, polygon):
+        super().__init__('Внесите данные о полигоне {} в '
+                         'wta_connection_info!'.format(polygon))
+
+
+class CircuitOpen(Exception):
+    """ Доставки на полигон приостановлены автоматом (CircuitBreaker). """
+
+    def __init__(self, polygon, retry_in):
+        super().__init__('Полигон {} недоступен, доставка на него '
+                         'приостановлена еще на {:.0f} сек.'.format(
+                             polygon, retry_in))
+
+
+# Состояния автомата
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """ Автомат здоровья полигона. После failure_threshold неудач подряд
+    автомат размыкается (open): доставки сразу отклоняются, не тратя время
+    на подключение. Через reset_timeout секунд пропускается одна пробная
+    доставка (half_open): если она прошла, автомат замыкается (closed), если
+    нет - снова размыкается на reset_timeout. """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        """
+        Инициализация.
+
+        :param failure_threshold: Сколько неудач подряд размыкают автомат
+            (0 - никогда).
+        :param reset_timeout: Через сколько секунд пробовать снова.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """ Можно ли выполнить доставку сейчас. В состоянии half_open
+        разрешается только одна (пробная) доставка. """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and \
+                    time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_in(self):
+        """ Через сколько секунд будет пробная доставка. """
+        with self.lock:
+            if self.state != OPEN:
+                return 0
+            return max(self.opened_at + self.reset_timeout -
+                       time.monotonic(), 0)
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.last_error = str(error)
+            if self.state == HALF_OPEN or (
+                    self.failure_threshold and
+                    self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """ Доставка завершилась ошибкой, не связанной с доступностью
+        полигона: пробная доставка ничего не показала, автомат снова
+        размыкается до следующей пробы. """
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def get_stats(self):
+        with self.lock:
+            return {'state': self.state, 'failures': self.failures,
+                    'last_error': self.last_error,
+                    'rejected': self.rejected,
+                    'open_for': time.monotonic() - self.opened_at
+                    if self.opened_at is not None else None}
+
+
+class TrackedSocket:
+    """ Сокет, считающий отправленные байты: по счетчику видно, успел ли
+    запрос хоть частично уйти на полигон. """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes_sent = 0
+
+    def send(self, data, *args):
+        sent = self.sock.send(data, *args)
+        self.bytes_sent += sent
+        return sent
+
+    def sendall(self, data, *args):
+        data = memoryview(data)
+        while data:
+            data = data[self.send(data, *args):]
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class PolygonClient:
+    """ Клиент одного полигона: соединение с GCore и операторы WTA для всех
+    видов данных. Доставки на полигон выполняются по одной. """
+
+    def __init__(self, sql_shell, polygon, connect_timeout=5, timeout=30,
+                 breaker=None):
+        """
+        Инициализация.
+
+        :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+        :param polygon: ID полигона.
+        :param connect_timeout: Сколько секунд ждать подключения к GCore.
+        :param timeout: Сколько секунд ждать ответа GCore.
+        :param breaker: Автомат здоровья полигона (CircuitBreaker).
+        """
+        self.sql_shell = sql_shell
+        self.polygon = polygon
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.operators = GetOperator()
+        self.address = None
+        self.sock = None
+        self.wtas = {}
+        self.wtadb = {}
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.connects = 0
+        self.deliveries = 0
+
+    def get_address(self):
+        """ Вернуть (ip, port) GCore полигона из wta_connection_info. """
+        if self.address is None:
+            cursor, conn = self.sql_shell.get_cursor_conn()
+            try:
+                cursor.execute("SELECT ip, port FROM wta_connection_info "
+                               "WHERE polygon = %s", (self.polygon,))
+                row = cursor.fetchone()
+                conn.rollback()
+            finally:
+                conn.close()
+            if not row:
+                raise NoConnectionInfo(self.polygon)
+            self.address = (row[0], int(row[1]))
+        return self.address
+
+    def connect(self):
+        try:
+            sock = socket.create_connection(self.get_address(),
+                                            self.connect_timeout)
+        except OSError:
+            # Адрес мог измениться - перечитать его при следующей попытке
+            self.address = None
+            raise
+        sock.settimeout(self.timeout)
+        self.sock = TrackedSocket(sock)
+        self.connects += 1
+
+    def is_alive(self):
+        """ Проверить простаивающее соединение перед доставкой: в нем не
+        должно быть ничего для чтения. Если полигон закрыл или сбросил
+        соединение (или прислал что-то без запроса), сокет читаем. """
+        try:
+            return not select.select([self.sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def get_operators(self, data_type):
+        """ Вернуть (WTAS, WTADB) вида данных data_type. Операторы не
+        открывают своих соединений: WTAS пишет в общее соединение клиента,
+        WTADB работает через sql_shell. """
+        if data_type not in self.wtas:
+            wtas_class = self.operators.get_wtas_class(data_type)
+            wtadb_class = self.operators.get_wtadb_class(data_type)
+            if not wtas_class or not wtadb_class:
+                raise KeyError('Неизвестный вид данных {}'.format(data_type))
+            ip, port = self.get_address()
+            wtas = wtas_class.__new__(wtas_class)
+            # WTAS.__init__ сам подключается к полигону - вызвать
+            # инициализацию ARQDK в обход него
+            super(wtas_main.WTAS, wtas).__init__(ip, port, debug=False)
+            wtadb = wtadb_class(dbname=self.sql_shell.dbname,
+                                user=self.sql_shell.user,
+                                password=self.sql_shell.password,
+                                host=self.sql_shell.host,
+                                polygon_id=self.polygon)
+            wtadb.get_cursor_conn = self.sql_shell.get_cursor_conn
+            self.wtadb[data_type] = wtadb
+            self.wtas[data_type] = wtas
+        return self.wtas[data_type], self.wtadb[data_type]
+
+    def deliver(self, data_type, wserver_id, payload):
+        """
+        Доставить данные на полигон и отметить это в отчетах об отправке
+        (как wtas.operators.WTA.deliver). Разорванное полигоном простаивающее
+        соединение заменяется новым до отправки. Если переиспользованное
+        соединение подвело при отправке, доставка повторяется через новое,
+        но только если ни один байт запроса не ушел: иначе полигон мог уже
+        добавить запись, а повтор создал бы дубль.
+
+        :param data_type: Вид данных (auto, companies_upd etc).
+        :param wserver_id: ID данных в GDB.
+        :param payload: Аргументы метода WServer для WTAS.send.
+        :return: Ответ в формате WTA.deliver.
+        """
+        with self.lock:
+            self.last_used = time.monotonic()
+            wtas, wtadb = self.get_operators(data_type)
+            if self.sock is not None and not self.is_alive():
+                self.disconnect()
+            reused = self.sock is not None
+            while True:
+                if self.sock is None:
+                    self.connect()
+                self.sock.bytes_sent = 0
+                wtas.sock = self.sock
+                try:
+                    return self.send(wtas, wtadb, wserver_id, payload)
+                except OSError:
+                    sent = self.sock.bytes_sent
+                    self.disconnect()
+                    if not reused or sent:
+                        raise
+                    reused = False
+                finally:
+                    self.last_used = time.monotonic()
+
+    def send(self, wtas, wtadb, wserver_id, payload):
+        try:
+            wtas.send(wserver_id=wserver_id, wtadb=wtadb, **payload)
+        except wtas_functions.NoWdbId:
+            return {'ar_deliver_status': False, 'permanent': True,
+                    'error_info': traceback.format_exc()}
+        report_id = wtadb.mark_send(gdb_id=wserver_id)
+        ar_response = wtas.get()
+        if ar_response is None:
+            raise ConnectionResetError('Полигон {} закрыл соединение'.format(
+                self.polygon))
+        self.deliveries += 1
+        response = {'report_id': report_id, 'wserver_id': wserver_id}
+        if ar_response['info']['status'] == 'success':
+            wtadb.mark_get(wdb_id=ar_response['info']['info'][0][0],
+                           report_id=report_id)
+            response['success_save'] = True
+        else:
+            response['success_save'] = False
+            wtadb.mark_fail(ar_response['info']['info'], report_id)
+        return response
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+
+class WTAClientPool:
+    """ Клиенты полигонов (PolygonClient), по одному на полигон. """
+
+    def __init__(self, max_idle=300, connect_timeout=5, timeout=30,
+                 failure_threshold=5, reset_timeout=30):
+        """
+        Инициализация.
+
+        :param max_idle: Через сколько секунд простоя закрывать соединение
+            с полигоном.
+        :param connect_timeout: Сколько секунд ждать подключения к GCore.
+        :param timeout: Сколько секунд ждать ответа GCore.
+        :param failure_threshold: После скольких неудач подряд
+            приостанавливать доставки на полигон (CircuitBreaker).
+        :param reset_timeout: Через сколько секунд после этого пробовать
+            снова.
+        """
+        self.max_idle = max_idle
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def get_client(self, sql_shell, polygon):
+        """ Вернуть клиента полигона polygon, попутно закрыв простаивающие
+        соединения других полигонов. """
+        with self.lock:
+            client = self.clients.get(polygon)
+            if client is None:
+                client = PolygonClient(
+                    sql_shell, polygon, self.connect_timeout, self.timeout,
+                    CircuitBreaker(self.failure_threshold,
+                                   self.reset_timeout))
+                self.clients[polygon] = client
+            clients = list(self.clients.values())
+        self.evict_idle(clients)
+        return client
+
+    def evict_idle(self, clients=None):
+        """ Закрыть соединения, простаивающие дольше max_idle. """
+        if clients is None:
+            with self.lock:
+                clients = list(self.clients.values())
+        deadline = time.monotonic() - self.max_idle
+        for client in clients:
+            if client.sock is not None and client.last_used < deadline \
+                    and client.lock.acquire(blocking=False):
+                try:
+                    client.disconnect()
+                    self.evicted += 1
+                finally:
+                    client.lock.release()
+
+    def deliver(self, sql_shell, data_type, polygon, wserver_id, payload):
+        """ Доставить данные на полигон polygon (см. PolygonClient.deliver).
+        Если полигон признан недоступным, сразу выбрасывает CircuitOpen. """
+        client = self.get_client(sql_shell, polygon)
+        if not client.breaker.allow():
+            raise CircuitOpen(polygon, client.breaker.retry_in())
+        try:
+            response = client.deliver(data_type, wserver_id, payload)
+        except (OSError, NoConnectionInfo) as error:
+            client.breaker.record_failure(error)
+            raise
+        except Exception:
+            client.breaker.release()
+            raise
+        client.breaker.record_success()
+        return response
+
+    def invalidate(self, polygon=None):
+        """ Забыть адрес полигона (или всех полигонов) и закрыть соединение,
+        например, после изменения wta_connection_info. """
+        with self.lock:
+            clients = [self.clients.pop(polygon)] \
+                if polygon in self.clients else []
+            if polygon is None:
+                clients = list(self.clients.values())
+                self.clients.clear()
+        for client in clients:
+            client.close()
+
+    def close_all(self):
+        """ Закрыть все соединения с полигонами. """
+        self.invalidate()
+
+    def get_stats(self):
+        """ Вернуть состояние клиентов по полигонам. """
+        with self.lock:
+            clients = list(self.clients.values())
+        return {'evicted': self.evicted,
+                'polygons': {client.polygon: {
+                    'connected': client.sock is not None,
+                    'address': client.address,
+                    'connects': client.connects,
+                    'deliveries': client.deliveries,
+                    'idle': time.monotonic() - client.last_used,
+                    'health': client.breaker.get_stats()}
+                    for client in clients}}
+
+    def get_health(self):
+        """ Вернуть состояние автоматов здоровья полигонов:
+        {polygon: {'state': 'closed'|'open'|'half_open', ...}} """
+        with self.lock:
+            clients = list(self.clients.values())
+        return {client.polygon: client.breaker.get_stats()
+                for client in clients}
+
+
+def merge_payloads(old, new):
+    """
+    Склеить аргументы двух вызовов метода WServer для одной записи:
+    значения нового вызова заменяют старые, кроме None (в методах update_*
+    None означает "не менять").
+
+    :param old: Аргументы более раннего вызова.
+    :param new: Аргументы более позднего вызова.
+    :return: Склеенные аргументы.
+    """
+    merged = dict(old)
+    merged.update({name: value for name, value in new.items()
+                   if value is not None or name not in merged})
+    return merged
+
+
+class DeliveryCoalescer:
+    """ Склейка частых изменений одной записи перед доставкой на полигоны.
+    Данные копятся window секунд с первого изменения записи (ключ -
+    (вид данных, ID записи)), последующие изменения в этом окне склеиваются
+    с ним (merge_payloads), и на полигоны доставляется только итоговое
+    состояние записи. Доставки на полигоны выполняются в пуле executor,
+    поток склейки их не ждет. """
+
+    def __init__(self, deliver, executor, window=0):
+        """
+        Инициализация.
+
+        :param deliver: Функция доставки на один полигон
+            deliver(sql_shell, data_type, polygon, wserver_id, payload).
+        :param executor: Пул потоков доставки.
+        :param window: Окно склейки (сек.), 0 - не склеивать.
+        """
+        self.deliver = deliver
+        self.executor = executor
+        self.window = window
+        # {(data_type, wserver_id): {'due': ..., 'sql_shell': ...,
+        #                            'polygons': ..., 'payload': ...}}
+        self.pending = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+        # Доставки, выполняющиеся в executor
+        self.in_flight = set()
+        self.submitted = 0
+        self.superseded = 0
+        self.delivered = 0
+        self.failed = 0
+
+    def submit(self, sql_shell, data_type, polygons, wserver_id, payload):
+        """
+        Поставить изменение записи на доставку. Если изменение этой же
+        записи уже ждет доставки, оно склеивается с новым.
+
+        :return: True, если изменение склеено с ожидающим, False, если
+            поставлено отдельно, None, если склейка уже остановлена (тогда
+            доставить надо самому).
+        """
+        key = (data_type, wserver_id)
+        with self.cond:
+            if self.stopped:
+                return None
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.mainloop,
+                                               daemon=True,
+                                               name='WTADeliveryCoalescer')
+                self.thread.start()
+            self.submitted += 1
+            entry = self.pending.get(key)
+            if entry:
+                entry['payload'] = merge_payloads(entry['payload'], payload)
+                entry['polygons'] = polygons
+                self.superseded += 1
+                return True
+            self.pending[key] = {'due': time.monotonic() + self.window,
+                                 'sql_shell': sql_shell,
+                                 'polygons': polygons, 'payload': payload}
+            self.cond.notify()
+            return False
+
+    def mainloop(self):
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    if self.pending:
+                        wait = next(iter(self.pending.values()))['due'] - \
+                               time.monotonic()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self.cond.wait(wait)
+                if self.stopped and not self.pending:
+                    return
+                key, entry = self.pending.popitem(last=False)
+            self.deliver_entry(key, entry)
+
+    def deliver_entry(self, key, entry):
+        """ Отдать доставку записи на каждый полигон в executor. """
+        data_type, wserver_id = key
+        for polygon in entry['polygons']:
+            future = self.executor.submit(
+                self.deliver, entry['sql_shell'], data_type, polygon,
+                wserver_id, entry['payload'])
+            with self.cond:
+                self.in_flight.add(future)
+            future.add_done_callback(self.count_delivery)
+
+    def count_delivery(self, future):
+        try:
+            delivery = future.result()
+            failed = delivery.get('ar_deliver_status', True) is False
+        except Exception:
+            print(traceback.format_exc())
+            failed = True
+        with self.cond:
+            self.in_flight.discard(future)
+            if failed:
+                self.failed += 1
+            else:
+                self.delivered += 1
+
+    def flush(self, timeout=None):
+        """ Доставить все ожидающие изменения, не дожидаясь конца окна, и
+        остановить склейку.
+
+        :param timeout: Сколько секунд ждать доставок (None - без предела).
+        :return: True, если все доставки завершились за timeout. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+            thread = self.thread
+        if thread:
+            thread.join(timeout)
+            if thread.is_alive():
+                return False
+        with self.cond:
+            in_flight = list(self.in_flight)
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0)
+        _, not_done = concurrent.futures.wait(in_flight, timeout)
+        return not not_done
+
+    def get_stats(self):
+        """ Вернуть счетчики: сколько изменений принято, сколько склеено с
+        более поздними (superseded), сколько доставок прошло и не прошло. """
+        with self.cond:
+            return {'window': self.window, 'pending': len(self.pending),
+                    'submitted': self.submitted,
+                    'superseded': self.superseded,
+                    'delivered': self.delivered, 'failed': self.failed}
@@ -0,0 +1,408 @@
+""" Модуль содержит очередь доставки справочных данных на полигоны.
+
+В режиме settings.WTA_OUTBOX методы, помеченные send_data_to_core (set_auto,
+update_company и т.д.), не доставляют данные на полигоны сами, а в той же
+транзакции, что и изменение в GDB, ставят их в wta_outbox - по строке на
+каждый целевой полигон. Доставку через WTA выполняют фоновые обработчики
+OutboxDispatcher: пачками, сгруппированными по полигонам, с повтором
+недоставленного через нарастающие паузы. Строки одной записи, попавшие в
+одну пачку, доставляются одной доставкой (см. OutboxDispatcher.coalesce),
+а чтобы частые изменения записи успели в нее попасть, строка становится
+доступной для доставки через settings.WTA_COALESCE_WINDOW секунд. Строки,
+которые не удалось доставить за settings.WTA_OUTBOX_MAX_ATTEMPTS попыток
+или с ошибкой, которую повтор не исправит, помечаются dead и больше не
+доставляются (и не задерживают остальные строки полигона), пока их не
+вернут в очередь через replay_outbox.
+
+Очередь хранится в GDB:
+    CREATE TABLE wta_outbox (
+        id serial PRIMARY KEY,
+        data_type text NOT NULL,
+        polygon integer NOT NULL,
+        wserver_id integer NOT NULL,
+        payload text NOT NULL,
+        created timestamp NOT NULL DEFAULT now(),
+        attempts integer NOT NULL DEFAULT 0,
+        next_try timestamp NOT NULL DEFAULT now(),
+        last_error text,
+        dead boolean NOT NULL DEFAULT false,
+        leased_until timestamp
+    );
+    CREATE INDEX wta_outbox_next_try_idx ON wta_outbox (next_try);
+Для существующей таблицы:
+    ALTER TABLE wta_outbox ADD COLUMN dead boolean NOT NULL DEFAULT false,
+        ADD COLUMN leased_until timestamp;
+"""
+import collections
+import json
+import threading
+import time
+import traceback
+
+import psycopg2
+
+from wserver_compound import functions
+from wserver_compound import wta_clients
+
+# Первый ключ рекомендательных блокировок полигонов (pg_advisory_xact_lock),
+# второй - ID полигона
+POLYGON_LOCK_SPACE = 20
+
+
+def get_outbox_stats(sql_shell):
+    """
+    Вернуть размер очереди, число строк с неудачными попытками, число
+    недоставляемых (dead) строк и возраст самой старой строки по каждому
+    полигону.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :return:
+    """
+    command = "SELECT polygon, count(*), " \
+              "count(*) FILTER (WHERE attempts > 0), " \
+              "count(*) FILTER (WHERE dead), " \
+              "extract(epoch FROM now() - min(created))::float " \
+              "FROM wta_outbox GROUP BY polygon ORDER BY polygon"
+    response = sql_shell.try_execute_get(command)
+    if isinstance(response, dict):
+        return response
+    polygons = {polygon: {'size': size, 'failed': failed, 'dead': dead,
+                          'oldest_age': oldest}
+                for polygon, size, failed, dead, oldest in response}
+    return {'status': 'success',
+            'info': {'size': sum(stats['size']
+                                 for stats in polygons.values()),
+                     'polygons': polygons}}
+
+
+def get_outbox_entries(sql_shell, polygon=None, limit=100):
+    """
+    Вернуть строки очереди (без данных), начиная с самых старых.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :param polygon: Только строки этого полигона.
+    :param limit: Сколько строк вернуть.
+    :return:
+    """
+    cursor, conn = sql_shell.get_cursor_conn()
+    try:
+        cursor.execute("SELECT id, data_type, polygon, wserver_id, "
+                       "created::text, attempts, next_try::text, last_error, "
+                       "dead "
+                       "FROM wta_outbox "
+                       "WHERE %(polygon)s IS NULL OR polygon = %(polygon)s "
+                       "ORDER BY id LIMIT %(limit)s",
+                       {'polygon': polygon, 'limit': limit})
+        columns = [column[0] for column in cursor.description]
+        entries = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        conn.rollback()
+        response = {'status': 'success', 'info': entries}
+    except psycopg2.Error:
+        response = sql_shell.transaction_fail(cursor)
+    finally:
+        conn.close()
+    return response
+
+
+def replay_outbox(sql_shell, polygon=None, outbox_id=None):
+    """
+    Повторить доставку строк очереди сейчас, не дожидаясь следующей попытки.
+    Недоставляемые (dead) строки возвращаются в очередь с нулевым счетчиком
+    попыток. Строки, которые сейчас доставляются, не трогаются.
+
+    :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+    :param polygon: Только строки этого полигона.
+    :param outbox_id: Только эту строку.
+    :return: Ответ в формате WSQLuse с ID строк.
+    """
+    cursor, conn = sql_shell.get_cursor_conn()
+    try:
+        cursor.execute("UPDATE wta_outbox SET next_try = now(), "
+                       "attempts = CASE WHEN dead THEN 0 ELSE attempts END, "
+                       "dead = false "
+                       "WHERE (%(polygon)s IS NULL OR polygon = %(polygon)s) "
+                       "AND (leased_until IS NULL OR leased_until <= now()) "
+                       "AND (%(id)s IS NULL OR id = %(id)s) RETURNING id",
+                       {'polygon': polygon, 'id': outbox_id})
+        records = cursor.fetchall()
+        conn.commit()
+        response = {'status': 'success',
+                    'info': [record[0] for record in records]}
+    except psycopg2.Error:
+        response = sql_shell.transaction_fail(cursor)
+    finally:
+        conn.close()
+    return response
+
+
+class OutboxDispatcher:
+    """ Пул фоновых обработчиков очереди wta_outbox. Каждый обработчик
+    забирает пачку строк (claim), группирует их по полигонам и доставляет
+    группы параллельно (через functions.delivery_executor), строки одного
+    полигона - по порядку. Доставленные строки удаляются из очереди. Если
+    доставка строки не удалась, она и оставшиеся строки ее полигона
+    откладываются вместе: пауза удваивается с каждой попыткой от
+    retry_delay до max_retry_delay. Строка, не доставленная за max_attempts
+    попыток, и строка с постоянной ошибкой (ответ доставки с 'permanent')
+    помечаются dead.
+
+    Забранные строки арендуются (leased_until) на lease секунд, и аренда
+    фиксируется до доставки: на время обращения к полигонам обработчик не
+    держит ни транзакции с блокировками строк, ни соединения с GDB. Если
+    обработчик упал, строки вернутся в очередь по истечении аренды, а
+    доставки, не успевшие начаться за половину аренды, возвращаются в
+    очередь сразу, чтобы их не забрал другой обработчик, пока они еще
+    доставляются.
+
+    Порядок доставки на полигон сохраняется и между пачками: строки
+    полигона забирает только один обработчик (рекомендательная блокировка
+    полигона до конца транзакции claim), и строка не берется, пока в
+    очереди есть более старая арендованная или отложенная строка ее
+    полигона - иначе повтор старой строки затер бы на полигоне более новые
+    данные. """
+
+    def __init__(self, sql_shell, workers=1, batch_size=100, poll_interval=1,
+                 retry_delay=10, max_retry_delay=3600, max_attempts=20,
+                 lease=600):
+        """
+        Инициализация.
+
+        :param sql_shell: Объект WSQLuse, для взаимодействия с GDB.
+        :param workers: Количество потоков-обработчиков.
+        :param batch_size: Сколько строк забирать за раз.
+        :param poll_interval: Пауза между опросами пустой очереди (сек.)
+        :param retry_delay: Пауза перед первым повтором (сек.)
+        :param max_retry_delay: Наибольшая пауза между повторами (сек.)
+        :param max_attempts: После скольких неудачных попыток помечать
+            строку dead (0 - повторять без ограничения).
+        :param lease: На сколько секунд арендуются забранные строки.
+        """
+        self.sql_shell = sql_shell
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.delivered = 0
+        self.superseded = 0
+        self.failed = 0
+        self.dead = 0
+        self.counters_lock = threading.Lock()
+
+    def start(self):
+        """ Запустить обработчиков. """
+        self.stop_event.clear()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.mainloop, daemon=True,
+                                      name='OutboxDispatcher-{}'.format(
+                                          number))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """ Остановить обработчиков, дождавшись завершения текущих пачек. """
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = [thread for thread in self.threads
+                        if thread.is_alive()]
+
+    def mainloop(self):
+        while not self.stop_event.is_set():
+            try:
+                processed = self.process_batch()
+            except Exception:
+                print(traceback.format_exc())
+                processed = 0
+            if processed < self.batch_size:
+                self.stop_event.wait(self.poll_interval)
+
+    def process_batch(self):
+        """ Доставить одну пачку строк очереди.
+
+        :return: Сколько строк было забрано из очереди. """
+        entries = self.claim()
+        if not entries:
+            return 0
+        deadline = time.monotonic() + self.lease / 2
+        by_polygon = collections.OrderedDict()
+        for entry in entries:
+            by_polygon.setdefault(entry[2], []).append(entry)
+        futures = [functions.delivery_executor.submit(
+            self.deliver_polygon, self.coalesce(polygon_entries), deadline)
+            for polygon_entries in by_polygon.values()]
+        results = [future.result() for future in futures]
+        self.finish(results)
+        delivered = [outbox_ids for result in results
+                     for outbox_ids in result['delivered']]
+        with self.counters_lock:
+            self.delivered += len(delivered)
+            self.superseded += sum(len(outbox_ids) - 1
+                                   for outbox_ids in delivered)
+            self.failed += sum(len(result['postponed'])
+                               for result in results)
+            self.dead += sum(len(result['dead']) for result in results)
+        return len(entries)
+
+    def claim(self):
+        """ Забрать и арендовать пачку строк очереди.
+
+        :return: [(id, data_type, polygon, wserver_id, payload)] """
+        with functions.connection_scope(self.sql_shell):
+            cursor, conn = self.sql_shell.get_cursor_conn()
+            try:
+                cursor.execute(
+                    "SELECT id, data_type, polygon, wserver_id, payload "
+                    "FROM wta_outbox o "
+                    "WHERE NOT dead AND next_try <= now() "
+                    "AND (leased_until IS NULL OR leased_until <= now()) "
+                    "AND NOT EXISTS (SELECT 1 FROM wta_outbox older "
+                    "WHERE older.polygon = o.polygon AND older.id < o.id "
+                    "AND NOT older.dead AND (older.next_try > now() "
+                    "OR older.leased_until > now())) "
+                    "AND pg_try_advisory_xact_lock(%s, o.polygon) "
+                    "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED",
+                    (POLYGON_LOCK_SPACE, self.batch_size))
+                entries = cursor.fetchall()
+                if entries:
+                    cursor.execute(
+                        "UPDATE wta_outbox SET leased_until = now() + "
+                        "%s * interval '1 sec' WHERE id = ANY(%s)",
+                        (self.lease, [entry[0] for entry in entries]))
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+        return entries
+
+    def finish(self, results):
+        """ Записать итоги доставки пачки (deliver_polygon) и снять аренду:
+        удалить доставленные строки, отложить или пометить dead
+        недоставленные, вернуть в очередь не начатые. """
+        with functions.connection_scope(self.sql_shell):
+            cursor, conn = self.sql_shell.get_cursor_conn()
+            try:
+                delivered = [outbox_id for result in results
+                             for outbox_ids in result['delivered']
+                             for outbox_id in outbox_ids]
+                if delivered:
+                    cursor.execute("DELETE FROM wta_outbox "
+                                   "WHERE id = ANY(%s)", (delivered,))
+                for result in results:
+                    if result['dead']:
+                        cursor.execute("UPDATE wta_outbox "
+                                       "SET attempts = attempts + 1, "
+                                       "dead = true, leased_until = NULL, "
+                                       "last_error = %s WHERE id = ANY(%s)",
+                                       (result['error'], result['dead']))
+                    if result['postponed']:
+                        self.postpone(cursor, result['postponed'],
+                                      result['error'])
+                    if result['released']:
+                        cursor.execute("UPDATE wta_outbox "
+                                       "SET leased_until = NULL "
+                                       "WHERE id = ANY(%s)",
+                                       (result['released'],))
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+
+    def postpone(self, cursor, outbox_ids, error):
+        """ Отложить строки одного полигона до одного и того же времени:
+        паузу задает число попыток первой (самой старой) из них. Строки,
+        исчерпавшие max_attempts попыток, помечаются dead. """
+        cursor.execute("UPDATE wta_outbox "
+                       "SET attempts = attempts + 1, "
+                       "next_try = now() + least(%s * 2 ^ ("
+                       "SELECT attempts FROM wta_outbox WHERE id = %s), "
+                       "%s) * interval '1 sec', "
+                       "dead = %s > 0 AND attempts + 1 >= %s, "
+                       "leased_until = NULL, "
+                       "last_error = %s WHERE id = ANY(%s)",
+                       (self.retry_delay, min(outbox_ids),
+                        self.max_retry_delay, self.max_attempts,
+                        self.max_attempts, error, outbox_ids))
+
+    @staticmethod
+    def coalesce(entries):
+        """ Склеить строки очереди одной записи (одного вида данных и
+        wserver_id) в одну доставку с итоговым состоянием записи
+        (wta_clients.merge_payloads). Доставка встает на место первой из
+        склеенных строк. Строка с испорченными данными не склеивается и
+        доставляется отдельно с payload None.
+
+        :return: [[ID строк, data_type, polygon, wserver_id, payload]] """
+        deliveries = collections.OrderedDict()
+        for outbox_id, data_type, polygon, wserver_id, payload in entries:
+            try:
+                payload = json.loads(payload)
+            except ValueError:
+                deliveries[outbox_id] = [[outbox_id], data_type, polygon,
+                                         wserver_id, None]
+                continue
+            delivery = deliveries.get((data_type, wserver_id))
+            if delivery:
+                delivery[0].append(outbox_id)
+                delivery[4] = wta_clients.merge_payloads(delivery[4],
+                                                         payload)
+            else:
+                deliveries[(data_type, wserver_id)] = [
+                    [outbox_id], data_type, polygon, wserver_id, payload]
+        return list(deliveries.values())
+
+    def deliver_polygon(self, deliveries, deadline=None):
+        """ Доставить данные на один полигон по порядку. После первой
+        неудачи остальные доставки не выполняются, а откладываются вместе с
+        ней. Доставка с постоянной ошибкой (или с испорченными данными)
+        помечается dead, а следующие за ней выполняются. Доставки, не
+        начатые до deadline (time.monotonic), возвращаются в очередь.
+
+        :param deliveries: Результат coalesce.
+        :param deadline: Время, после которого не начинать доставки.
+        :return: {'delivered': [ID строк каждой выполненной доставки],
+            'dead': [ID строк], 'postponed': [ID строк],
+            'released': [ID строк], 'error': последняя ошибка}
+        """
+        result = {'delivered': [], 'dead': [], 'postponed': [],
+                  'released': [], 'error': None}
+        for number, delivery in enumerate(deliveries):
+            outbox_ids, data_type, polygon, wserver_id, payload = delivery
+            if deadline is not None and time.monotonic() > deadline:
+                result['released'] = [outbox_id
+                                      for rest in deliveries[number:]
+                                      for outbox_id in rest[0]]
+                break
+            if payload is None:
+                response = {'ar_deliver_status': False, 'permanent': True,
+                            'error_info': 'Испорченные данные в очереди'}
+            else:
+                response = functions.deliver_to_polygon(
+                    self.sql_shell, data_type, polygon, wserver_id,
+                    payload)
+            if response.get('ar_deliver_status', True) is not False:
+                result['delivered'].append(outbox_ids)
+                continue
+            result['error'] = response.get('error_info')
+            if response.get('permanent'):
+                result['dead'] += outbox_ids
+                continue
+            result['postponed'] = [outbox_id
+                                   for rest in deliveries[number:]
+                                   for outbox_id in rest[0]]
+            break
+        return result
+
+    def get_stats(self):
+        """ Вернуть счетчики обработчиков. """
+        return {'workers': len(self.threads), 'delivered': self.delivered,
+                'superseded': self.superseded, 'failed': self.failed,
+                'dead': self.dead}